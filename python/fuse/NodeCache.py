@@ -36,6 +36,23 @@ class NodeCache(dict):
         """Factory for volatile objects."""
         return self.Volatile(self, uri.rstrip('/'))
 
+    def invalidate(self, uri):
+        """Remove a changed node, the nodes beneath it and its parent, whose
+           listing includes it, from the cache."""
+        uri = uri.rstrip('/')
+        parent = uri.rsplit('/', 1)[0]
+
+        def affected(key):
+            return key == uri or key.startswith(uri + '/') or key == parent
+
+        with self.lock:
+            for key in self.keys():
+                if affected(key):
+                    del self[key]
+            for watchedNode in self.watchedNodes:
+                if affected(watchedNode.uri):
+                    watchedNode.dirty = True
+
     def __missing__(self, key):
         """Attempting to access a non-cached node returns None rather than
            raising an exception."""
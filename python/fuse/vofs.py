@@ -253,6 +253,21 @@ class VOFS(Operations):
         # Create a condition variable to get rid of those nasty sleeps
         self.condition = CacheCondition(lock=None, timeout=VOFS.cacheTimeout)
 
+        # Follow the changes made elsewhere so that listings can be cached
+        if getattr(options, 'follow_changes', False):
+            self.client.change_listeners.append(self._changed)
+            self.client.follow_changes(root)
+
+    def _changed(self, uri, operation):
+        """Drop the cached bytes of a file changed elsewhere unless it is open."""
+        base = self.client.fix_uri(self.root).rstrip('/')
+        if operation == 'create' or not uri.startswith(base):
+            return
+        path = uri[len(base):] or '/'
+        if path in self.cache.fileHandleDict:
+            return
+        self.cache.unlinkFile(path)
+
     def __call__(self, op, *args):
         logger.debug('-> {0} {1}'.format(op, repr(args)))
         ret = None
@@ -585,7 +600,7 @@ class VOFS(Operations):
         This should always be run in a thread."""
         try:
             logger.debug("Starting getNodeList thread")
-            node_list = self.getNode(path, force=True, limit=None).node_list
+            node_list = self.getNode(path, force=not self.client.following, limit=None).node_list
             logger.debug("Got listing {0} for {1}".format(node_list, path))
         finally:
             self.loading_dir[path] = False
@@ -657,7 +672,12 @@ class VOFS(Operations):
         n_bytes = 2 ** 33
         free = 2 ** 33
 
-        if 'quota' in node.props:
+        if 'availableSpace' in node.props:
+            # The service keeps running totals so no listing is needed
+            used = int(node.props.get('length') or 0)
+            free = int(node.props.get('availableSpace'))
+            n_bytes = int(node.props.get('quota') or used + free)
+        elif 'quota' in node.props:
             n_bytes = int(node.props.get('quota', 2 ** 33))
             used = int(node.props.get('length', 2 ** 33))
             free = n_bytes - used
@@ -10,9 +10,9 @@ import copy
 import errno
 import fnmatch
 import hashlib
-from cStringIO import StringIO
 import requests
 import html2text
+import json
 import logging
 import mimetypes
 import os
@@ -20,6 +20,7 @@ import re
 import stat
 import string
 import sys
+import threading
 import time
 import urllib
 import urlparse
@@ -224,6 +225,8 @@ class Node(object):
         self.xattr = {}
         self._node_list = None
         self._endpoints = None
+        self.etag = None
+        self.listing = None
 
         if not subnodes:
             subnodes = []
@@ -1066,6 +1069,8 @@ class EndPoints(object):
 
     VONodes = "vospace/nodes"
 
+    VOChanges = "vospace/changes"
+
     VOProperties = {NOAO_TEST_SERVER: "/vospace",
                     CADC_SERVER: "/vospace/nodeprops",
                     LOCAL_TEST_SERVER: "/vospace"}
@@ -1141,6 +1146,14 @@ class EndPoints(object):
         """
         return "{0}/{1}".format(self.server, EndPoints.VONodes)
 
+    @property
+    def changes(self):
+        """
+
+        :return: The change feed endpoint.
+        """
+        return "{0}/{1}".format(self.server, EndPoints.VOChanges)
+
 
 class Client(object):
     """The Client object does the work"""
@@ -1150,6 +1163,8 @@ class Client(object):
     VO_HTTPSGET_PROTOCOL = 'ivo://ivoa.net/vospace/core#httpsget'
     VO_HTTPSPUT_PROTOCOL = 'ivo://ivoa.net/vospace/core#httpsput'
     DWS = '/data/pub/'
+    JOB_WAIT = 60 # Seconds to block on a job before asking again
+    LISTING_TYPE = 'application/x-ndjson' # Line-delimited form of a container listing
 
     #  reserved vospace properties, not to be used for extended property setting
     vosProperties = ["description", "type", "encoding", "MD5", "length",
@@ -1208,6 +1223,10 @@ class Client(object):
         self.nodeCache = NodeCache()
         self.transfer_shortcut = transfer_shortcut
         self.secure_get = secure_get
+        # Set while the node cache is kept current from the change feed
+        self.following = False
+        # Called with the uri and operation of each change read from the feed
+        self.change_listeners = []
         return
 
     def glob(self, pathname):
@@ -1443,6 +1462,91 @@ class Client(object):
         logger.debug("Returning URI: {0}".format(uri))
         return uri
 
+    def follow_changes(self, uri=None, wait=60):
+        """Start a background thread which reads the change feed of the service
+        and drops changed nodes from the node cache, so that cached nodes stay
+        current without being fetched again.
+
+        :param uri: the part of the VOSpace to follow, by default the root node
+        :type uri: str
+        :param wait: seconds each request to the feed waits for a change
+        :type wait: int
+        """
+        uri = self.fix_uri(uri or self.rootNode or 'vos:')
+        follower = threading.Thread(target=self._follow_changes, args=(uri, wait))
+        follower.setDaemon(True)
+        follower.start()
+
+    def _follow_changes(self, uri, wait):
+        """Read the change feed for ever, resuming after the last change seen
+        when a request fails.
+
+        :param uri: the part of the VOSpace to follow
+        :type uri: str
+        :param wait: seconds each request to the feed waits for a change
+        :type wait: int
+        """
+        parts = URLParser(uri)
+        base = "{0}://{1}".format(parts.scheme, parts.netloc)
+        prefix = parts.path.strip('/')
+        url = "{0}://{1}".format(self.protocol, EndPoints(uri).changes)
+        since = None
+        delay = 5
+        while True:
+            params = {'wait': wait}
+            if since is not None:
+                params['since'] = since
+            if prefix:
+                params['prefix'] = prefix
+            try:
+                start = time.time()
+                response = self.conn.session.get(url, params=params, timeout=(5, wait + 30))
+                if response.status_code == 410:
+                    logger.warning("Changes to {0} since {1} are no longer available".format(uri, since))
+                    since = None
+                    continue
+                response.raise_for_status()
+                lines = response.content.splitlines()
+                latest = int(lines[-1])
+                changes = [line.split('\t', 2) for line in lines[:-1]]
+            except Exception as ex:
+                logger.debug("Failed reading changes to {0}: {1}".format(uri, ex))
+                self.following = False
+                time.sleep(delay)
+                delay = min(delay * 2, 300)
+                continue
+            delay = 5
+            if since is None:
+                # Nodes cached so far may have changed unseen
+                self._changed(base, 'reset')
+            for seq, operation, identifier in changes:
+                path = identifier.split('/', 3)[3:]
+                self._changed(path and "{0}/{1}".format(base, path[0]) or base, operation)
+            since = latest
+            self.following = True
+            if 'since' in params and not changes and time.time() - start < wait / 2:
+                # The service answers at once when too many requests are waiting
+                time.sleep(min(wait, 5))
+
+    def _changed(self, uri, operation):
+        """Drop a changed node from the node cache and tell the listeners.
+
+        :param uri: the node which changed
+        :type uri: str
+        :param operation: the change: 'create', 'update', 'move', 'delete' or 'reset' if anything may have changed
+        :type operation: str
+        """
+        if operation == 'reset':
+            with self.nodeCache.volatile(uri):
+                pass
+        else:
+            self.nodeCache.invalidate(uri)
+        for listener in self.change_listeners:
+            try:
+                listener(uri, operation)
+            except Exception as ex:
+                logger.error("Change listener failed for {0}: {1}".format(uri, ex))
+
     def get_node(self, uri, limit=0, force=False):
         """connect to VOSpace and download the definition of vospace node
 
@@ -1457,8 +1561,9 @@ class Client(object):
         logger.debug("Getting node {0}".format(uri))
         uri = self.fix_uri(uri)
         node = None
-        if not force and uri in self.nodeCache:
-            node = self.nodeCache[uri]
+        cached = self.nodeCache[uri]
+        if not force:
+            node = cached
         if node is None:
             logger.debug("Getting node {0} from ws".format(uri))
             with self.nodeCache.watch(uri) as watch:
@@ -1466,12 +1571,11 @@ class Client(object):
                 # using the uri directly, but if this a URL then the metadata
                 # comes from the HTTP header.
                 if uri.startswith('vos:'):
-                    vo_fobj = self.open(uri, os.O_RDONLY, limit=limit)
-                    vo_xml_string = vo_fobj.read()
-                    xml_file = StringIO(vo_xml_string)
-                    xml_file.seek(0)
-                    dom = ElementTree.parse(xml_file)
-                    node = Node(dom.getroot())
+                    node = self._read_node(uri, limit, cached)
+                    if node is cached:
+                        # Not modified: the cached copy is already complete
+                        watch.insert(node)
+                        return node
                 elif uri.startswith('http'):
                     header = self.open(None, url=uri, mode=os.O_RDONLY, head=True)
                     header.read()
@@ -1498,9 +1602,8 @@ class Client(object):
                     next_uri = None
                     while next_uri != node.node_list[-1].uri:
                         next_uri = node.node_list[-1].uri
-                        xml_file = StringIO(self.open(uri, os.O_RDONLY, next_uri=next_uri, limit=limit).read())
-                        xml_file.seek(0)
-                        next_page = Node(ElementTree.parse(xml_file).getroot())
+                        next_page = Node(ElementTree.parse(self.open(uri, os.O_RDONLY, next_uri=next_uri,
+                                                                     limit=limit)).getroot())
                         if len(next_page.node_list) > 0 and next_uri == next_page.node_list[0].uri:
                             next_page.node_list.pop(0)
                         node.node_list.extend(next_page.node_list)
@@ -1509,6 +1612,39 @@ class Client(object):
                 childWatch.insert(childNode)
         return node
 
+    def _read_node(self, uri, limit=0, cached=None):
+        """Download the definition of a vospace node, revalidating a cached copy
+        with its ETag if it has one.
+
+        :param uri: the VOSpace node to download
+        :type uri: str
+        :param limit: load children nodes in batches of limit
+        :type limit: int, None
+        :param cached: the previously retrieved version of the node
+        :type cached: Node, None
+        :return: cached if it is still current, otherwise the downloaded Node
+        :rtype: Node
+        """
+        if cached is not None and cached.etag is not None:
+            url = self.get_node_url(uri, method='GET', limit=limit)
+            response = self.conn.session.get(url, headers={'If-None-Match': cached.etag}, stream=True)
+            logger.debug("Revalidated node {0}: {1}".format(uri, response.status_code))
+            try:
+                if response.status_code == 304:
+                    return cached
+                if response.status_code == 200:
+                    # Parse the listing as it arrives
+                    response.raw.decode_content = True
+                    node = Node(ElementTree.parse(response.raw).getroot())
+                    node.etag = response.headers.get('ETag', None)
+                    return node
+            finally:
+                response.close()
+        vo_fobj = self.open(uri, os.O_RDONLY, limit=limit)
+        node = Node(ElementTree.parse(vo_fobj).getroot())
+        node.etag = vo_fobj.resp.headers.get('ETag', None)
+        return node
+
     def get_node_url(self, uri, method='GET', view=None, limit=0, next_uri=None, cutout=None, full_negotiation=None):
         """Split apart the node string into parts and return the correct URL for this node.
 
@@ -1739,26 +1875,31 @@ class Client(object):
                                       headers={'Content-Type': 'application/x-www-form-urlencoded'}) # 'text/xml'}) # MJG
         logging.debug("{0}".format(resp))
         logging.debug("{0}".format(resp.content))
-        if resp.status_code != 303 and resp.status_code != 302: # MJG
-            raise OSError(resp.status_code, "Failed to get transfer service response.")
-        transfer_url = resp.headers.get('Location', None)
+        if resp.status_code == 200 and view != 'move':
+            # The service returned the transfer document without a job
+            transfer_url = url
+            xml_string = resp.content
+        else:
+            if resp.status_code != 303 and resp.status_code != 302: # MJG
+                raise OSError(resp.status_code, "Failed to get transfer service response.")
+            transfer_url = resp.headers.get('Location', None)
 
-        if self.conn.session.auth is not None and "auth" not in transfer_url:
-            transfer_url = transfer_url.replace('/vospace/', '/vospace/auth/')
-        
-        logging.debug("Got back from transfer URL: %s" % transfer_url)
+            if self.conn.session.auth is not None and "auth" not in transfer_url:
+                transfer_url = transfer_url.replace('/vospace/', '/vospace/auth/')
+
+            logging.debug("Got back from transfer URL: %s" % transfer_url)
+
+            # For a move this is the end of the transaction.
+            if view == 'move':
+                return not self.get_transfer_error(transfer_url, uri)
+
+            # for get or put we need the protocol value
+            xfer_resp = self.conn.session.get(transfer_url, allow_redirects=False)
+            xfer_url = xfer_resp.headers.get('Location', transfer_url) # MJG
+            if self.conn.session.auth is not None and "auth" not in xfer_url:
+                xfer_url = xfer_url.replace('/vospace/', '/vospace/auth/')
+            xml_string = self.conn.session.get(xfer_url).content
 
-        # For a move this is the end of the transaction.
-        if view == 'move':
-            return not self.get_transfer_error(transfer_url, uri)
-
-        # for get or put we need the protocol value
-        xfer_resp = self.conn.session.get(transfer_url, allow_redirects=False)
-        xfer_url = xfer_resp.headers.get('Location', transfer_url) # MJG
-        if self.conn.session.auth is not None and "auth" not in xfer_url:
-            xfer_url = xfer_url.replace('/vospace/', '/vospace/auth/')
-        xml_string = self.conn.session.get(xfer_url).content
-        
         logging.debug("Transfer Document: %s" % xml_string)
         transfer_document = ElementTree.fromstring(xml_string)
         logging.debug("XML version: {0}".format(ElementTree.tostring(transfer_document)))
@@ -1801,8 +1942,17 @@ class Client(object):
             # do not remove the line below. It is used for testing
             logging.debug("Job URL: " + job_url + "/phase")
             while phase in ['PENDING', 'QUEUED', 'EXECUTING', 'UNKNOWN']:
-                # poll the job. Sleeping time in between polls is doubling
-                # each time until it gets to 32sec
+                # block on the job until its phase changes (UWS 1.1)
+                started = time.time()
+                previous = phase
+                phase = self.conn.session.get(phase_url, params={'WAIT': Client.JOB_WAIT, 'PHASE': phase},
+                                              allow_redirects=False, timeout=(5, Client.JOB_WAIT + 30)).content
+                logging.debug("Async transfer Phase for url %s: %s " % (url, phase))
+                if phase != previous or time.time() - started >= 1:
+                    continue
+                # the service answered at once so it does not block: poll the
+                # job. Sleeping time in between polls is doubling each time
+                # until it gets to 32sec
                 total_time_slept = 0
                 if sleep_time <= 32:
                     sleep_time *= 2
@@ -1818,8 +1968,6 @@ class Client(object):
                     sys.stdout.write("\r                    \n")
                 else:
                     time.sleep(sleep_time)
-                phase = self.conn.session.get(phase_url, allow_redirects=False).content
-                logging.debug("Async transfer Phase for url %s: %s " % (url, phase))
         except KeyboardInterrupt:
             # abort the job when receiving a Ctrl-C/Interrupt from the client
             logging.error("Received keyboard interrupt")
@@ -2053,16 +2201,107 @@ class Client(object):
         :rtype [str]
         """
         # logger.debug("getting a listing of %s " % (uri))
-        names = []
         logger.debug(str(uri))
-        node = self.get_node(uri, limit=None, force=force)
+        node = self.get_node(uri, limit=0, force=force)
         while node.type == "vos:LinkNode":
             uri = node.target
             # logger.debug(uri)
-            node = self.get_node(uri, limit=None, force=force)
-        for thisNode in node.node_list:
-            names.append(thisNode.name)
-        return names
+            node = self.get_node(uri, limit=0, force=force)
+        if not node.isdir():
+            return []
+        # The node is dropped from the cache when a child changes, taking its listing with it
+        if node.listing is None or force:
+            with self.nodeCache.watch(node.uri) as watch:
+                listing = self._read_listing(node.uri, node.listing)
+                if not watch.dirty:
+                    node.listing = listing
+        else:
+            listing = node.listing
+        return list(listing[1])
+
+    def _read_listing(self, uri, cached=None):
+        """Read the names of the children of a container, revalidating a
+        previously read listing with its ETag if it has one.
+
+        :param uri: the container to list
+        :type uri: str
+        :param cached: the ETag and names read before
+        :type cached: tuple, None
+        :return: cached if it is still current, otherwise the ETag and names
+        :rtype: tuple
+        """
+        headers = {}
+        if cached is not None and cached[0] is not None:
+            headers['If-None-Match'] = cached[0]
+        response = self._open_listing(uri, headers)
+        try:
+            if response.status_code == 304:
+                return cached
+            names = [entry['name'] for entry in self._iter_entries(response)]
+            return response.headers.get('ETag', None), names
+        finally:
+            response.close()
+
+    def iter_listing(self, uri):
+        """Read the listing of a container from VOSpace one child at a time,
+        as lines of JSON where the service offers them.
+
+        :param uri: the container to list
+        :type uri: str
+        :return: the name, type, length, date and MD5 of each child
+        :rtype: iterator of dict
+        """
+        response = self._open_listing(uri)
+        try:
+            for entry in self._iter_entries(response):
+                yield entry
+        finally:
+            response.close()
+
+    def _open_listing(self, uri, headers=None):
+        """Request the listing of a container, as lines of JSON where the
+        service offers them.
+
+        :param uri: the container to list
+        :type uri: str
+        :param headers: further request headers
+        :type headers: dict, None
+        :return: the streamed response
+        :rtype: requests.Response
+        """
+        uri = self.fix_uri(uri)
+        url = self.get_node_url(uri, method='GET', limit=None)
+        headers = dict(headers or {}, Accept=Client.LISTING_TYPE)
+        response = self.conn.session.get(url, headers=headers, stream=True)
+        if response.status_code != 304:
+            try:
+                response.raise_for_status()
+            except Exception:
+                response.close()
+                raise
+        return response
+
+    def _iter_entries(self, response):
+        """Read the children from a container listing as it arrives.
+
+        :param response: the streamed listing
+        :type response: requests.Response
+        :return: the name, type, length, date and MD5 of each child
+        :rtype: iterator of dict
+        """
+        if response.headers.get('Content-Type', '').split(';')[0].strip() == Client.LISTING_TYPE:
+            lines = response.iter_lines()
+            # The first line is the container itself
+            next(lines, None)
+            for line in lines:
+                if line:
+                    yield json.loads(line)
+        else:
+            response.raw.decode_content = True
+            node = Node(ElementTree.parse(response.raw).getroot())
+            for child in node.node_list:
+                yield {'name': child.name, 'type': child.type, 'length': child.props.get('length'),
+                       'date': child.props.get('date'), 'MD5': child.props.get('MD5')}
 
     def isdir(self, uri):
         """Check to see if the given uri points at a containerNode or is
@@ -5,16 +5,28 @@
 # admin.py
 # Python code to handle VOSpace operations
 
-import copy
+import base64
+import bisect
+from blobs import BlobStore
+from cache import TTLCache
+from collections import deque, OrderedDict
 from config import *
-from datetime import datetime
+from datetime import datetime, timedelta
+import fcntl
+import hashlib
+import hmac
+import json
+from multiprocessing.pool import ThreadPool
 import os
+import Queue
 import re
+from search import get_number, parse_query
 import shutil
 import sys
 from threading import *
-from time import sleep
+from time import sleep, time
 import uuid
+from xml.sax.saxutils import quoteattr
 from resources import *
 
 try:
@@ -46,7 +58,7 @@ def check_uri(uri, sm, shouldExist = True, ignoreExist = False):
   - is free (or a Container)
   - designates a node with a valid parent (Container)
   """
-  checks = {'exists': False, 'container': False}
+  checks = {'exists': False, 'container': False, 'parent': None}
   uriRegex = """vos://[\w\d][\w\d\-_\.!~\*'\(\)\+=]{2,}(![\w\d\-_\.!~\*'\(\)\+=]+(/[\w\d\-_\.!~\*'\(\)\+=]+)*)+"""
   if re.match(uriRegex, uri) == None:
     raise VOSpaceError(400, "The requested URI is invalid.", summary = INVALID_URI)
@@ -54,17 +66,25 @@ def check_uri(uri, sm, shouldExist = True, ignoreExist = False):
     if uri[-(len(AUTO) + 1)] != '/' and uri(-(len(NULL) + 1)) != '/':
       raise VOSpaceError(400, "The requested URI is invalid.", summary = INVALID_URI)
     return checks
-  exists = sm.already_exists('nodes', uri)
-  if exists:
+  # Look up the node and its parent together
+  parent = uri[:uri.rfind("/")]
+  node, parentNode = None, None
+  for row in sm.get_node_and_parent(uri, parent):
+    if row['target']:
+      node = row
+    else:
+      parentNode = row
+  if node is not None:
     checks['exists'] = True
-    if sm.get_node_type(uri)[0]['type'] == CONTAINER_NODE: checks['container'] = True
+    if node['type'] == CONTAINER_NODE: checks['container'] = True
     if not(shouldExist) and not(ignoreExist): 
       if not(checks['container']): raise VOSpaceError(409, "A Node already exists with the requested URI.", summary = DUPLICATE_NODE)
   else:
     if shouldExist and not(ignoreExist): raise VOSpaceError(409, "A Node does not exist with the requested URI: %s" % uri, summary = NODE_NOT_FOUND)
-  parent = uri[:uri.rfind("/")]
-  if parent != ROOT_NODE and sm.get_node_type(parent)[0]['type'] != CONTAINER_NODE:
-    raise VOSpaceError(500, "The parent node is not valid.", summary = INVALID_URI)
+  if parent != ROOT_NODE:
+    if parentNode is None or parentNode['type'] != CONTAINER_NODE:
+      raise VOSpaceError(500, "The parent node is not valid.", summary = INVALID_URI)
+  if parentNode is not None: checks['parent'] = parentNode['id']
   return checks
 
 def generate_uri(uri):
@@ -73,12 +93,65 @@ def generate_uri(uri):
   """
   return uri[:-5] + uuid.uuid4().hex
 
+# Linux ioctl to share a file's blocks with another file on the same filesystem
+FICLONE = 0x40049409
+
+def copy_file(source, destination):
+  """
+  Copy the specified file, sharing its blocks where the filesystem can
+  """
+  with open(source, 'rb') as src:
+    with open(destination, 'wb') as dst:
+      try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+      except IOError:
+        shutil.copyfileobj(src, dst, COPY_BUFFER)
+  shutil.copymode(source, destination)
+
 def get_location(identifier):
   """
   Get a valid location for the data (bytes)
   """
   return STORAGE_LOCATION + "/" + identifier[len(ROOT_NODE) + 1:]
 
+# Names of the stored node types
+TYPE_NAMES = dict([(NODETYPES[x], x) for x in NODETYPES])
+
+# Views offered by every data node
+SERVICE_PROVIDES = sorted(set.union(*[set(PROVIDES_VIEWS[x]) for x in SERVICE_VIEWS]))
+
+def _text(value):
+  """
+  Get the specified value read from the store as unicode: the store
+  returns utf-8 encoded strings, which are not written as XML
+  """
+  return isinstance(value, str) and value.decode('utf-8') or value
+
+def build_node(row):
+  """
+  Build the node held in the specified row of the store: only its type,
+  properties and any link target are stored, the rest is the same for
+  every node of its type
+  """
+  node = NodeFactory().new_node(TYPE_NAMES[row['type']])
+  node.set_uri(row['identifier'])
+  node.properties = dict([(_text(x), _text(y)) for x, y in row['properties'].items()])
+  if isinstance(node, LinkNode): node.set_target(_text(row['target'] or ''))
+  if isinstance(node, DataNode):
+    node.accepts = list(SERVICE_VIEWS)
+    node.provides = list(SERVICE_PROVIDES)
+  return node
+
+def listing_entry(identifier, type, length, date, md5):
+  """
+  Write the line for a node in the line-delimited form of a container
+  listing
+  """
+  length = get_number(length)
+  if length is not None: length = int(length)
+  entry = OrderedDict([('name', identifier[identifier.rfind('/') + 1:]), ('type', type), ('length', length), ('date', date), ('MD5', md5)])
+  return json.dumps(entry, separators = (',', ':')) + '\n'
+
 
 class NodeManager():
   """
@@ -88,33 +161,22 @@ class NodeManager():
   def __init__(self, sm):
     self.sm = sm
     self.nf = NodeFactory()
+    self.blobs = CONTENT_ADDRESSED and BlobStore(sm, BLOB_LOCATION) or None
+    self.reclaimer = Reclaimer(sm, self.blobs)
 
   def create_node(self, xmlnode):
     """ 
     Create a node in the space with the specified parameters.
     """
     node = self.nf.get_node(xmlnode)
-    # Check that the uri is valid
-    check_uri(node.uri, self.sm, shouldExist = False)
+    # Check that the uri is valid and free
+    checks = check_uri(node.uri, self.sm, shouldExist = False)
+    if checks['exists']: raise VOSpaceError(409, "A Node already exists with the requested URI.", summary = DUPLICATE_NODE)
     # Check for reserved URI
     if node.uri.endswith(AUTO): 
       node.set_uri(generate_uri(node.uri))
-    # Make sure capabilities is clear
-    node.clear_capabilities()
-    if isinstance(node, DataNode):
-      # Add service views
-      node.clear_accepts()
-      for uris in SERVICE_VIEWS:
-        node.add_accepts(uris)
-    # Make sure provides is clear
-      node.clear_provides()
-      views = [set(PROVIDES_VIEWS[x]) for x in SERVICE_VIEWS]
-      views = set.union(*views)
-      for view in list(views):
-        node.add_provides(view)
-    # Make sure nodes is clear
-    if isinstance(node, ContainerNode):
-      node.clear_nodes()
+    # Capabilities, views and children are not taken from the request: they
+    # follow from the node type and the store
     # Check properties
     for property in node.properties:
       if property in READ_ONLY_PROPERTIES: raise VOSpaceError(401, 'User does not have permissions to set a readonly property.', summary = PERMISSION_DENIED)
@@ -122,87 +184,405 @@ class NodeManager():
     location = get_location(node.uri)
     if isinstance(node, ContainerNode) and not os.path.exists(location): os.makedirs(location)
     # Store node
-    self.sm.create_node(node.tostring(), node.uri, NODETYPES[node.TYPE], location = location) 
-    # Register properties
-    self.sm.register_properties(node.uri, node.properties)
+    target = isinstance(node, LinkNode) and node.target or None
+    if not self.sm.create_node(node.uri, NODETYPES[node.TYPE], location = location, parent_id = checks['parent'], properties = node.properties, target = target):
+      raise VOSpaceError(500, "The parent node is not valid.", summary = INVALID_URI)
     return xmlnode
 
   def update_node(self, uri, xmlnode):
     """
     Update the specified node with the specified details.
     """
-    oldnode = self.sm.get_node(uri)
-    if len(oldnode) == 0: raise VOSpaceError(404, 'A Node does not exist with the requested URI.')
-    oldnode = self.nf.get_node(oldnode[0]['node'])
+    rows = self.sm.get_node(uri)
+    if len(rows) == 0: raise VOSpaceError(404, 'A Node does not exist with the requested URI.')
     newnode = self.nf.get_node(xmlnode)
-    # Check properties
-    for property in newnode.properties:
-      if property in READ_ONLY_PROPERTIES: raise VOSpaceError(401, 'User does not have permissions to set a readonly property.', summary = PERMISSION_DENIED)
-      if property in oldnode.properties: 
-        oldnode.properties[property] = newnode.properties[property]
-      else:
-        oldnode.add_property(property, newnode.properties[property])
     # Delete properties if applicable
     props = xmlnode.xpath('//vos:property[@xsi:nil = "true"]', namespaces = {'vos': VOSPACE_NS, 'xsi': XSI_NS})
-    for prop in props:
-      del oldnode.properties[prop.get('uri')]
-    # Store update
-    self.sm.update_node(oldnode.uri, oldnode.uri, oldnode.tostring())
-    return oldnode.tostring()
+    deleted = [prop.get('uri') for prop in props]
+    # Check properties: read only ones can be neither set nor deleted
+    for property in newnode.properties.keys() + deleted:
+      if property in READ_ONLY_PROPERTIES: raise VOSpaceError(401, 'User does not have permissions to set a readonly property.', summary = PERMISSION_DENIED)
+    changed = dict([(x, newnode.properties[x]) for x in newnode.properties if x not in deleted])
+    # Store update: only the changed property rows are written
+    self.sm.update_node(uri, changed, deleted)
+    node = build_node(rows[0])
+    node.properties.update(changed)
+    for property in deleted:
+      node.properties.pop(property, None)
+    return node.tostring()
+
+  def get_entries(self, node, start = None, limit = None):
+    """
+    Get the listing of the specified container as lines of JSON: one for
+    the container and then one for each child, read a page at a time
+    """
+    def stream():
+      properties = node.properties
+      yield listing_entry(node.uri, node.TYPE, properties.get(LENGTH), properties.get(DATE), properties.get(MD5))
+      for page in pages(self.sm.iter_children(node.uri, start = start, limit = limit, details = True)):
+        yield ''.join([listing_entry(x['identifier'], TYPE_NAMES[x['type']], x['length'], x['date'], x['md5']) for x in page])
+    return stream()
+
+  def get_space(self, uri):
+    """
+    Get the space properties of the specified container: the bytes stored
+    beneath it, any quota on it and the space left under every quota above
+    it and on disk
+    """
+    stat = os.statvfs(STORAGE_LOCATION)
+    available = stat.f_bavail * stat.f_frsize
+    properties = {LENGTH: '0'}
+    for row in self.sm.get_usage(uri):
+      if row['identifier'] == uri:
+        properties[LENGTH] = str(row['bytes'])
+        if row['quota'] is not None: properties[QUOTA] = str(row['quota'])
+      if row['quota'] is not None: available = min(available, row['quota'] - row['bytes'])
+    properties[AVAILABLE_SPACE] = str(max(available, 0))
+    return properties
+
+  def check_quota(self, uri, length, source = None):
+    """
+    Check that storing the specified number of bytes at the URI keeps every
+    container above it within its quota: containers also above the source
+    of moved bytes already count them
+    """
+    delta = length - self.sm.get_size(uri)['bytes']
+    if delta <= 0: return
+    for row in self.sm.get_usage(uri):
+      if source is not None and source.startswith(row['identifier'] + '/'): continue
+      if row['quota'] is not None and row['bytes'] + delta > row['quota']:
+        raise VOSpaceError(413, "The data would exceed the quota of %s." % row['identifier'], summary = QUOTA_EXCEEDED)
 
   def delete_node(self, uri):
     """
-    Delete the node from the space with the specified uri.
-    Should this just set a flag in the db? Should the bytes be deleted?
+    Delete the node from the space with the specified uri: only the node
+    itself is marked as deleted, its children and bytes are reclaimed in 
+    the background
     """
-    if self.sm.already_exists('nodes', uri):
-      self.sm.delete_node(uri)
-    else:
-      raise VOSpaceError(404, "The specified node does not exist.")
-
-
-class Future():
-  def __init__(self, func, name, *param):
-    # constructor
-    self.__done = 0
-    self.__result = None
-    self.__status = 'Working'
-    self.__excpt = None
-    self.name = name
-
-    self.__C = Condition()
-
-    self.__T = Thread(target = self.Wrapper, args = (func, param))
-    self.__T.setName("FutureThread")
-    self.__T.start()
-
-  def __repr__(self):
-    return '<Future (%s) at ' % self.name + hex(id(self)) + ':' + self.__status + '>'
-
-  def __call__(self):
-    self.__C.acquire()
-    while self.__done == 0:
-      self.__C.wait()
-    self.__C.release()
-    if self.__excpt: 
-      raise self.__excpt[0], self.__excpt[1], self.__excpt[2]
-    result = copy.deepcopy(self.__result)
-    return result
-
-  def isDone(self):
-    return self.__done
-
-  def Wrapper(self, func, param):
-    self.__C.acquire()
-    try: 
-      self.__result = func(*param)
-    except:
-      self.__result = "Exception raised within Future"
-      self.__excpt = sys.exc_info()
-    self.__done = 1
-    self.__status = `self.__result`
-    self.__C.notify()
-    self.__C.release()
+    tombstone = self.sm.delete_node(uri)
+    if tombstone is None: raise VOSpaceError(404, "The specified node does not exist.")
+    self.sm.after_commit(self.reclaimer.discard, tombstone['location'], tombstone['trash'])
+
+
+class SearchManager():
+  """
+  Class to manage searches within VOSpace: a search is recorded as a job
+  and its results are read from the property index page by page
+  """
+
+  def __init__(self, sm):
+    self.sm = sm
+
+  def add_search(self, request):
+    """
+    Record the search described by the parameters of the specified job
+    document
+    """
+    parameters = dict([(param.get('id'), param.text or '') for param in request.iter('{%s}parameter' % UWS_NS)])
+    if not parameters.get('query'): raise VOSpaceError(400, 'A search query must be specified.', summary = MISSING_PARAMETER)
+    try:
+      parse_query(parameters['query'])
+    except ValueError, e:
+      raise VOSpaceError(400, str(e), summary = INVALID_ARGUMENT)
+    parameters.setdefault('target', ROOT_NODE)
+    jobid = uuid.uuid4().hex
+    now = datetime.utcnow().isoformat()
+    job = Job()
+    job.set_job_id(jobid)
+    job.set_parameters(parameters)
+    job.set_phase('COMPLETED')
+    job.set_start_time(now)
+    job.set_end_time(now)
+    job.add_result('searchDetails', '%s/searches/%s/results/searchDetails' % (HOST, jobid))
+    self.sm.register_job(job.tostring(), jobid, phase = 'COMPLETED', resultid = 'searchDetails', method = 'search', type = 'searches')
+    return jobid
+
+  def get_results(self, jobid, start = None, limit = None, detail = 'min'):
+    """
+    Get the results of the specified search as a stream of XML fragments,
+    starting after the specified URI
+    """
+    res = self.sm.get_job(jobid, type = 'searches')
+    if len(res) == 0: raise VOSpaceError(404, 'The specified search does not exist.')
+    job = Job(res[0]['job'])
+    target = job.parameters.get('target', ROOT_NODE)
+    terms = parse_query(job.parameters['query'])
+    def stream(start):
+      yield '<searchDetails xmlns="%s" xmlns:xsi="%s"><nodes>' % (VOSPACE_NS, XSI_NS)
+      count = 0
+      while limit is None or count < limit:
+        size = limit is None and LISTING_PAGE_SIZE or min(LISTING_PAGE_SIZE, limit - count)
+        nodes, start = self.sm.find_nodes(target, terms, start, size)
+        if detail == 'max': properties = self.sm.get_node_properties([node['identifier'] for node in nodes])
+        for node in nodes:
+          if detail == 'max':
+            node['properties'] = properties[node['identifier']]
+            yield build_node(node).tostring()
+          else:
+            yield '<node uri=%s xsi:type="%s"/>' % (quoteattr(node['identifier']), TYPE_NAMES[node['type']])
+        count += len(nodes)
+        if start is None: break
+      yield '</nodes></searchDetails>'
+    return stream(start)
+
+
+class ChangeFeed():
+  """
+  Class to read the log of changes to nodes: each change has a sequence
+  number and clients ask for the changes after the last one they saw
+  """
+
+  def __init__(self, sm):
+    self.sm = sm
+
+  def get_changes(self, since = None, prefix = None, limit = CHANGES_LIMIT, wait = 0):
+    """
+    Get the changes after the specified sequence number, at or below the
+    specified URI, as a stream of lines, waiting up to the specified
+    number of seconds for one if there are none yet and fewer than
+    MAX_WAITERS requests are already waiting
+    """
+    range = self.sm.get_change_range()
+    latest = range['latest'] or 0
+    if since is None:
+      return iter(['%s\n' % latest])
+    if range['oldest'] is not None and since + 1 < range['oldest'] and since < latest:
+      raise VOSpaceError(410, 'Changes after %s are no longer available.' % since)
+    limit, wait = min(limit, CHANGES_LIMIT), min(wait, CHANGES_WAIT)
+    def stream(since):
+      deadline = time() + wait
+      waiting = False
+      try:
+        while True:
+          changes, since = self._read(since, prefix, limit)
+          for change in changes:
+            yield '%s\t%s\t%s\n' % (change['seq'], change['operation'], change['identifier'])
+          remaining = deadline - time()
+          if changes or remaining <= 0: break
+          if not waiting:
+            waiting = self.sm.waiters.acquire(False)
+            if not waiting: break
+          # Changes made by other processes are not signalled so poll as well
+          with self.sm.changes:
+            self.sm.changes.wait(min(remaining, 1))
+      finally:
+        if waiting: self.sm.waiters.release()
+      yield '%s\n' % since
+    return stream(since)
+
+  def _read(self, since, prefix, limit):
+    """
+    Read the changes after the specified sequence number up to the first gap
+    in the sequence: changes are numbered when made, not when committed, so
+    a gap may be a change still to commit
+    """
+    matches = []
+    for change in self.sm.get_changes(since, limit):
+      if change['seq'] != since + 1 and change['age'] < CHANGES_SETTLE: break
+      since = change['seq']
+      uri = change['identifier']
+      if prefix is None or uri == prefix or uri.startswith(prefix + '/'): matches.append(change)
+    return matches, since
+
+
+class Reclaimer():
+  """
+  Class to remove the rows and bytes of deleted nodes in the background,
+  a batch at a time
+  """
+
+  def __init__(self, sm, blobs = None):
+    self.sm = sm
+    self.blobs = blobs
+    self.lock = Lock()
+    self.wakeup = Event()
+    reclaimer = Thread(target = self._reclaim_all)
+    reclaimer.setName("Reclaimer")
+    reclaimer.setDaemon(True)
+    reclaimer.start()
+
+  def discard(self, location, trash):
+    """
+    Move the bytes of a deleted node out of the way and wake the reclaimer:
+    shared content addressed bytes stay put until no node refers to them
+    """
+    try:
+      if self.blobs is not None and self.blobs.contains(location):
+        pass
+      elif location and os.path.exists(location):
+        if not os.path.exists(TRASH_LOCATION): os.makedirs(TRASH_LOCATION)
+        os.rename(location, trash)
+    except OSError, e:
+      print "Error:", e
+    self.wakeup.set()
+
+  def drain(self, uri):
+    """
+    Reclaim now any deleted nodes at, above or below the specified URI
+    """
+    for tombstone in self.sm.get_tombstones():
+      prefix = tombstone['identifier']
+      if uri == prefix or uri.startswith(prefix + '/') or prefix.startswith(uri + '/'):
+        self._reclaim(tombstone, pause = 0)
+
+  def _reclaim_all(self):
+    """
+    Reclaim deleted nodes whenever woken, or every RECLAIM_FREQ seconds
+    """
+    while True:
+      self.wakeup.wait(RECLAIM_FREQ)
+      self.wakeup.clear()
+      try:
+        for tombstone in self.sm.get_tombstones():
+          self._reclaim(tombstone)
+        if self.blobs is not None: self.blobs.collect(RECLAIM_BATCH)
+        self.sm.prune_changes(CHANGES_RETENTION)
+        self.sm.prune_tokens()
+      except Exception, e:
+        print "Error:", e
+
+  def _reclaim(self, tombstone, pause = RECLAIM_PAUSE):
+    """
+    Remove the rows of a deleted subtree from the leaves up and then its
+    bytes, pausing between batches
+    """
+    with self.lock:
+      stack = [tombstone['rootid']]
+      while len(stack) > 0:
+        nested = self.sm.get_nested_child(stack[-1])
+        if nested is not None:
+          stack.append(nested)
+          continue
+        children = self.sm.get_child_ids(stack[-1], RECLAIM_BATCH)
+        if len(children) > 0:
+          self.sm.purge_nodes(children)
+          sleep(pause)
+        else:
+          self.sm.purge_nodes([stack.pop()])
+      self._unlink(tombstone['location'], pause)
+      self.sm.delete_tombstone(tombstone['id'])
+
+  def _unlink(self, location, pause):
+    """
+    Remove the specified file or directory tree, pausing between batches
+    """
+    if os.path.isdir(location):
+      count = 0
+      for root, dirs, files in os.walk(location, topdown = False):
+        for name in files:
+          self._remove(os.remove, os.path.join(root, name))
+          count += 1
+          if count % RECLAIM_BATCH == 0: sleep(pause)
+        self._remove(os.rmdir, root)
+    elif os.path.exists(location):
+      self._remove(os.remove, location)
+
+  def _remove(self, func, path):
+    try:
+      func(path)
+    except OSError, e:
+      print "Error:", e
+
+
+class JobScheduler():
+  """
+  Class to run jobs on a fixed pool of worker threads. Each method has its
+  own queue and concurrency limit; within a method, queued jobs are taken
+  by priority and then round-robin across users.
+  """
+
+  SYNC = 0
+  ASYNC = 1
+
+  def __init__(self, workers, limits, callback):
+    self.limits = limits
+    self.callback = callback
+    self.queues = {}
+    self.running = {}
+    self.started = {}
+    self.waited = {}
+    self.condition = Condition()
+    for i in range(workers):
+      worker = Thread(target = self._work)
+      worker.setName("JobWorker-%s" % i)
+      worker.setDaemon(True)
+      worker.start()
+
+  def submit(self, jobid, method, userid, priority, func, *param):
+    """
+    Queue the function to be run for the specified job
+    """
+    with self.condition:
+      users = self.queues.setdefault(method, [OrderedDict() for p in range(self.ASYNC + 1)])[priority]
+      users.setdefault(userid, deque()).append((jobid, method, func, param, time()))
+      self.condition.notify()
+
+  def queued(self):
+    """
+    Get the number of jobs waiting for a worker
+    """
+    with self.condition:
+      return sum([len(tasks) for queues in self.queues.values() for users in queues for tasks in users.values()])
+
+  def get_stats(self):
+    """
+    Get the queue depth, running count and waiting times for each method
+    """
+    stats = {}
+    now = time()
+    with self.condition:
+      for method in set(self.limits.keys() + self.queues.keys()):
+        tasks = [task for users in self.queues.get(method, []) for tasks in users.values() for task in tasks]
+        started = self.started.get(method, 0)
+        stats[method] = {'limit': self.limits.get(method, 1),
+                         'running': self.running.get(method, 0),
+                         'queued': len(tasks),
+                         'oldestWait': len(tasks) > 0 and now - min([task[4] for task in tasks]) or 0,
+                         'meanWait': started > 0 and self.waited.get(method, 0) / started or 0}
+    return stats
+
+  def _next_task(self):
+    """
+    Take the next runnable task off the queues
+    """
+    for priority in range(self.ASYNC + 1):
+      for method in self.queues:
+        if self.running.get(method, 0) >= self.limits.get(method, 1): continue
+        users = self.queues[method][priority]
+        if len(users) == 0: continue
+        # Serve the user at the head and move them to the back
+        userid, tasks = users.popitem(last = False)
+        task = tasks.popleft()
+        if len(tasks) > 0: users[userid] = tasks
+        return task
+    return None
+
+  def _work(self):
+    """
+    Run tasks as they become runnable
+    """
+    while True:
+      with self.condition:
+        task = self._next_task()
+        while task is None:
+          self.condition.wait()
+          task = self._next_task()
+        jobid, method, func, param, submitted = task
+        self.running[method] = self.running.get(method, 0) + 1
+        self.started[method] = self.started.get(method, 0) + 1
+        self.waited[method] = self.waited.get(method, 0) + time() - submitted
+      result, excpt = None, None
+      try:
+        result = func(*param)
+      except:
+        excpt = sys.exc_info()
+      with self.condition:
+        self.running[method] -= 1
+        self.condition.notify()
+      try:
+        self.callback(jobid, result, excpt)
+      except Exception, e:
+        print "Error:", e
 
 
 class JobManager():
@@ -210,15 +590,28 @@ class JobManager():
   Class to manage UWS jobs
   """
   
+  DEFERRED = object() # Result of a handler whose job completes on a later signal
+  ACTIVE = ('PENDING', 'QUEUED', 'EXECUTING') # Phases a blocking request waits to leave
+
   def __init__(self, sm):
     self.sm = sm
-    self.threads = []
+    self.active = set()
+    self.deferred = {}
+    self.signalled = {}
+    self.lock = Lock()
     self.handlers = {}
+    self.queue = Queue.Queue()
+    self.scheduler = JobScheduler(JOB_WORKERS, JOB_LIMITS, self._complete_job)
+    dispatcher = Thread(target = self._dispatch_jobs)
+    dispatcher.setName("JobDispatcher")
+    dispatcher.setDaemon(True)
+    dispatcher.start()
 
   def add_job(self, jobInfo, resultId, method, run = False):
     """
     Add a job to the queue
     """
+    if self.scheduler.queued() >= JOB_QUEUE_LIMIT: raise VOSpaceError(503, "The service is too busy to accept the job.", summary = INTERNAL_FAULT)
     job = Job()
     job.set_job_info(jobInfo)
     jobid = self._get_job_id()
@@ -229,59 +622,169 @@ class JobManager():
       job.set_phase('PENDING')
     self.sm.register_job(job.tostring(), job.jobId, phase = job.phase, resultid = resultId, method = method)
     if run:
-      self._launch_job(job)
+      self.queue_job(jobid, JobScheduler.SYNC)
     return jobid
 
+  def queue_job(self, jobid, priority = JobScheduler.ASYNC):
+    """
+    Hand a QUEUED job to the dispatcher once it has been committed
+    """
+    self.sm.after_commit(self.queue.put, (jobid, priority))
+
+  def recover_jobs(self):
+    """
+    Queue again the jobs left EXECUTING when the service last stopped: 
+    their handlers pick up from any checkpoint
+    """
+    for job in self.sm.get_job_ids(phase = 'EXECUTING'):
+      res = self.sm.get_job(job['identifier'])
+      if len(res) > 0:
+        job = Job(res[0]['job'])
+        job.set_phase('QUEUED')
+        self.sm.update_job(job = job)
+        self.queue_job(job.jobId)
+
   def check_jobs(self):
     """
-    Check for new/aborted jobs and completed jobs in the queue
+    Sweep the store for QUEUED jobs that were never dispatched, e.g. 
+    because the service was restarted
     """
-    # New/aborted jobs
     try:
-      jobs = self.sm.get_job('%', phase = 'QUEUED')
-      for job in jobs:
-        self._launch_job(Job(job['job']))
-      res = self.sm.get_aborted_jobs()
-      aborts = [x['identifier'] for x in res]
-      # Completed jobs
-      for t in self.threads:
-        if t.isDone() or t.name in aborts:
-          self.threads.remove(t)
-           # Set job status to COMPLETED
-          job = Job(self.sm.get_job(t.name)[0]['job'])
-          if t._Future__excpt == None:
-            job.set_phase('COMPLETED')
-            if t._Future__result != None:
-              job.set_results(t._Future__result)  
-            status = True
-          else:
-            job.set_phase('ERROR')
-            job.set_error_summary(str(t._Future__excpt[1]).replace("'", ""))
-            status = False
-          job.set_end_time(datetime.utcnow().isoformat())
-          self.sm.update_job(job = job, completed = status)
+      for job in self.sm.get_job_ids(phase = 'QUEUED'):
+        if job['identifier'] not in self.active:
+          self.queue_job(job['identifier'])
+      self._expire_jobs()
     except Exception, e:
       print "Error:", e
 
+  def defer_job(self, jobid):
+    """
+    Keep the specified job EXECUTING until it is signalled as complete,
+    returning False if the signal has already arrived
+    """
+    with self.lock:
+      if self.signalled.pop(jobid, None) is not None: return False
+      self.deferred[jobid] = time()
+      return True
+
+  def signal_job(self, jobid):
+    """
+    Complete the specified deferred job, or record the signal for when its 
+    handler runs
+    """
+    with self.lock:
+      if self.deferred.pop(jobid, None) is None:
+        self.signalled[jobid] = time()
+        return
+    self._complete_job(jobid, None, None)
+
+  def _expire_jobs(self):
+    """
+    Complete deferred jobs whose endpoints were never used and discard 
+    signals that were never claimed
+    """
+    cutoff = time() - TRANSFER_TIMEOUT
+    with self.lock:
+      expired = [jobid for jobid, deferred in self.deferred.items() if deferred < cutoff]
+      for jobid in expired:
+        del self.deferred[jobid]
+      for jobid in [jobid for jobid, signalled in self.signalled.items() if signalled < cutoff]:
+        del self.signalled[jobid]
+    for jobid in expired:
+      self.sm.complete_transfers(jobid)
+      self._complete_job(jobid, None, None)
+
+  def _dispatch_jobs(self):
+    """
+    Hand jobs to the scheduler as they are queued
+    """
+    while True:
+      jobid, priority = self.queue.get()
+      try:
+        # The job may have been aborted or submitted since it was queued
+        if jobid in self.active: continue
+        res = self.sm.get_job(jobid, phase = 'QUEUED')
+        if len(res) > 0:
+          self._launch_job(Job(res[0]['job']), priority)
+      except Exception, e:
+        print "Error:", e
+
+  def _complete_job(self, jobid, result, excpt):
+    """
+    Record the outcome of a finished job
+    """
+    with self.lock:
+      self.active.discard(jobid)
+    if result is JobManager.DEFERRED: return
+    job = Job(self.sm.get_job(jobid)[0]['job'])
+    status = False
+    if job.phase != 'ABORTED':
+      # Set job status to COMPLETED
+      if excpt == None:
+        job.set_phase('COMPLETED')
+        if result != None:
+          job.set_results(result)  
+        status = True
+      else:
+        job.set_phase('ERROR')
+        job.set_error_summary(str(excpt[1]).replace("'", ""))
+    job.set_end_time(datetime.utcnow().isoformat())
+    self.sm.update_job(job = job, completed = status)
+
   def _get_job_id(self):
     """
     Get a globally unique identifier
     """
     return uuid.uuid4().hex
 
-  def _launch_job(self, job):
+  def _launch_job(self, job, priority):
     """
-    Launch the specified job consisting of the specified method and arguments
+    Submit the specified job consisting of the specified method and arguments
     """
     details = self.sm.get_job_details(job.jobId)
-    handler = self.handlers[details[0]['method']]
-    type = details[0]['type']
-    resultId = details[0]['resultid']
+    method = details[0]['method']
+    with self.lock:
+      self.active.add(job.jobId)
+    self.scheduler.submit(job.jobId, method, details[0]['userid'], priority, self._run_job, job, details[0])
+
+  def _run_job(self, job, details):
+    """
+    Run the handler for the specified job once a worker is available
+    """
+    # The job may have been aborted while it was waiting
+    if self.sm.get_phase(job.jobId)[0]['phase'] != 'QUEUED': return None
     job.set_phase('EXECUTING')
-    job.set_start_time(datetime.utcnow().isoformat())
-    job.add_result(resultId, 'http://localhost:8000/%s/%s/results/details' % (type, job.jobId))
+    # A resumed job keeps its original start
+    if not job.startTime: job.set_start_time(datetime.utcnow().isoformat())
+    job.add_result(details['resultid'], 'http://localhost:8000/%s/%s/results/details' % (details['type'], job.jobId))
     self.sm.update_job(job = job)
-    self.threads.append(Future(handler, job.jobId, job))
+    job.checkpoint = details['checkpoint']
+    return self.handlers[details['method']](job)
+
+  def wait_job(self, jobid, phase = None, wait = 0):
+    """
+    Wait up to the specified number of seconds while the specified job is
+    active and in the specified phase, if any, returning its phase: the
+    phase is returned at once if MAX_WAITERS requests are already waiting
+    """
+    deadline = time() + min(wait, JOB_WAIT)
+    waiting = False
+    try:
+      while True:
+        res = self.sm.get_phase(jobid)
+        if len(res) == 0: return None
+        current = res[0]['phase']
+        if current not in JobManager.ACTIVE or (phase is not None and current != phase): return current
+        remaining = deadline - time()
+        if remaining <= 0: return current
+        if not waiting:
+          waiting = self.sm.waiters.acquire(False)
+          if not waiting: return current
+        # Jobs run by other processes are not signalled so poll as well
+        with self.sm.phases:
+          self.sm.phases.wait(min(remaining, 1))
+    finally:
+      if waiting: self.sm.waiters.release()
 
   def register_handler(self, method, handler):
     """
@@ -298,17 +801,27 @@ class JobManager():
       joblist.add_job(jobs['identifier'], jobs['phase'])
     return joblist.tostring()
 
+  def get_stats(self):
+    """
+    Get the state of the job queues
+    """
+    return self.scheduler.get_stats()
+
 
 class TransferManager():
   """
   Class to manage transfers within VOSpace
   """
 
+  SIGNED = {'pullFromVoSpace': 'g', 'pushToVoSpace': 'p'} # Directions with signed endpoints
+
   def __init__(self, sm, nm, jm):
     self.sm = sm
     self.nm = nm
     self.jm = jm
     self.nf = NodeFactory()
+    self.endpoints = TTLCache(ENDPOINT_CACHE_SIZE)
+    self.secret = SYNC_SECRET or os.urandom(32)
     self._register_handlers()
 
   def _register_handlers(self):
@@ -331,40 +844,171 @@ class TransferManager():
     external = not(transfer.direction.startswith('vos'))
     # External data transfers
     if external:
-      # Check transfer uri
-      checks = check_uri(transfer.target, self.sm, ignoreExist = True)
-      if checks['container']: raise VOSpaceError(500, "Data cannot be uploaded to a container")
-      if not checks['exists']:
-        if transfer.direction in ['pushToVoSpace', 'pullToVoSpace']:
-          node = DataNode()
-          # Reserved URI
-          if transfer.target.endswith(AUTO):
-            uri = generate_uri(transfer.target)
-            transfer.target = uri
-          else:
-            uri = transfer.target
-          node.set_uri(uri)
-          location = get_location(uri)
-          self.sm.create_node(node.tostring(), uri, NODETYPES[node.TYPE], location = location)
-        else:
-          raise VOSpaceError(409, "A Node does not exist with the requested URI.", summary = NODE_NOT_FOUND)
-      # Verify view
-      print transfer.view.uri
-      if transfer.view.uri != DEFAULT_VIEW and transfer.view.uri not in SERVICE_VIEWS and ANY_VIEW not in SERVICE_VIEWS: raise VOSpaceError(500, "Service does not support the requested View", summary = VIEW_NOT_SUPPORTED)
+      self._check_target(transfer)
       # Negotiate protocols
       transfer.set_protocols(self._negotiate_protocols(transfer.protocols, transfer.direction))
     # Accept job
     method = self._get_handler(transfer)
     jobid = self.jm.add_job(transfer.tostring(), 'transferDetails', method, run)
     if external:
+      served = transfer.direction in ['pullFromVoSpace', 'pushToVoSpace']
+      tokens = []
       for protocol in transfer.protocols:
-        self.sm.register_transfer(jobid, protocol.endpoint)
+        token = served and protocol.endpoint[protocol.endpoint.rfind('/') + 1:] or None
+        self.sm.register_transfer(jobid, protocol.endpoint, token)
+        if served: tokens.append(token)
       self.sm.register_details(jobid, transfer.tostring())
+      # Remember the service endpoints once the job is committed so data requests avoid looking it up
+      if served:
+        endpoint = {'jobid': jobid, 'direction': transfer.direction, 'target': transfer.target, 'tokens': tokens}
+        for token in tokens:
+          self.sm.after_commit(self.endpoints.put, token, endpoint, time() + TRANSFER_TIMEOUT)
     return jobid
 
-  def _negotiate_protocols(self, protocols, direction):
+  def sign_transfer(self, transfer):
+    """
+    Check a synchronous client mediated transfer and return its details 
+    with signed endpoints: no job is created and nothing is stored
+    """
+    self._check_target(transfer, create = False)
+    token = self._sign(transfer.direction, transfer.target, int(time()) + SYNC_LIFETIME)
+    transfer.set_protocols(self._negotiate_protocols(transfer.protocols, transfer.direction, token))
+    return transfer.tostring()
+
+  def _check_target(self, transfer, create = True):
+    """
+    Check the target and view of a client mediated transfer, creating the
+    target of an upload if required
+    """
+    checks = check_uri(transfer.target, self.sm, ignoreExist = True)
+    if checks['container']: raise VOSpaceError(500, "Data cannot be uploaded to a container")
+    if not checks['exists']:
+      if transfer.direction in ['pushToVoSpace', 'pullToVoSpace']:
+        # Reserved URI
+        if transfer.target.endswith(AUTO):
+          transfer.target = generate_uri(transfer.target)
+        if create: self._create_data_node(transfer.target, checks['parent'])
+      else:
+        raise VOSpaceError(409, "A Node does not exist with the requested URI.", summary = NODE_NOT_FOUND)
+    # Verify view
+    if transfer.view.uri != DEFAULT_VIEW and transfer.view.uri not in SERVICE_VIEWS and ANY_VIEW not in SERVICE_VIEWS: raise VOSpaceError(500, "Service does not support the requested View", summary = VIEW_NOT_SUPPORTED)
+
+  def _create_data_node(self, uri, parent_id = None):
     """
-    Negotiate the appropriate protocols
+    Create an empty data node with the specified URI
+    """
+    if not self.sm.create_node(uri, DATA_NODE, location = get_location(uri), parent_id = parent_id):
+      raise VOSpaceError(500, "The parent node is not valid.", summary = INVALID_URI)
+
+  def _sign(self, direction, target, expiry):
+    """
+    Get an endpoint token granting the transfer until the expiry time
+    """
+    payload = '%s.%d.%s' % (self.SIGNED[direction], expiry, base64.urlsafe_b64encode(target))
+    return payload + '.' + hmac.new(self.secret, payload, hashlib.sha256).hexdigest()
+
+  def _verify(self, token, direction):
+    """
+    Get the details of a signed endpoint token if it is genuine, has not
+    expired, is for the specified direction and has not been used: an
+    upload uses it up as it starts, a download once it has completed so
+    an interrupted one can be retried
+    """
+    try:
+      payload, signature = token.rsplit('.', 1)
+      code, expiry, target = payload.split('.')
+      expiry, target = int(expiry), base64.urlsafe_b64decode(target)
+    except (ValueError, TypeError):
+      return None
+    if not hmac.compare_digest(hmac.new(self.secret, payload, hashlib.sha256).hexdigest(), signature): return None
+    if expiry <= time() or self.SIGNED.get(direction) != code: return None
+    location = self.sm.get_location(target)
+    if len(location) > 0:
+      location = location[0]['location']
+    elif direction == 'pushToVoSpace':
+      location = get_location(target)
+    else:
+      return None
+    if direction == 'pushToVoSpace':
+      if not self.sm.use_token(signature, expiry): return None
+    elif self.sm.token_used(signature):
+      return None
+    return {'jobid': None, 'direction': direction, 'target': target, 'location': location, 'tokens': [], 'signature': signature, 'expiry': expiry}
+
+  def get_endpoint(self, token, direction):
+    """
+    Get the job, target and location for a transfer endpoint if it is 
+    unique, unused, has not expired and is for the specified direction
+    """
+    if '.' in token: return self._verify(token, direction)
+    endpoint = self.endpoints.get(token)
+    if endpoint is None:
+      result = self.sm.get_endpoint(token)
+      if len(result) != 1 or result[0]['completed'] is not None: return None
+      remaining = result[0]['created'] + timedelta(seconds = TRANSFER_TIMEOUT) - datetime.now()
+      if remaining.total_seconds() <= 0: return None
+      jobid = result[0]['jobid']
+      transfer = Transfer(self.sm.get_transfer(jobid).jobInfo)
+      endpoint = {'jobid': jobid, 'direction': transfer.direction, 'target': transfer.target, 'tokens': result[0]['tokens'].split(',')}
+      self.endpoints.put(token, endpoint, time() + remaining.total_seconds())
+    if endpoint['direction'] != direction: return None
+    # The target may have been overwritten or deleted since the endpoint was cached
+    location = self.sm.get_location(endpoint['target'])
+    if len(location) == 0: return None
+    return dict(endpoint, location = location[0]['location'])
+
+  def complete_endpoint(self, endpoint, meta = None):
+    """
+    Complete the transfer made through the specified endpoint, after which
+    none of the job's endpoints can be used
+    """
+    for token in endpoint['tokens']:
+      self.endpoints.remove(token)
+    # Signed downloads are used up once they have completed
+    if endpoint['jobid'] is None and meta is None:
+      self.sm.use_token(endpoint['signature'], endpoint['expiry'])
+      return
+    # Signed uploads create their target when the bytes arrive
+    if endpoint['jobid'] is None:
+      checks = check_uri(endpoint['target'], self.sm, ignoreExist = True)
+      if not checks['exists']: self._create_data_node(endpoint['target'], checks['parent'])
+    self.complete_transfer(endpoint['jobid'], meta is not None and endpoint['target'] or None, meta)
+
+  def complete_transfer(self, jobid, target = None, meta = None):
+    """
+    Log the transfer as completed, recording the MD5 and length of any
+    bytes that were stored with the target node
+    """
+    if meta is None:
+      self.sm.complete_transfers(jobid)
+      return
+    blobs = self.nm.blobs
+    staged = blobs is not None and meta['location'].startswith(blobs.staging + '/')
+    try:
+      self.nm.check_quota(target, meta['length'])
+    except VOSpaceError:
+      if staged: os.remove(meta['location'])
+      raise
+    properties = {MD5: meta['md5'], LENGTH: str(meta['length']), DATE: datetime.utcnow().isoformat()}
+    location = None
+    if staged:
+      # The node now refers to the stored copy of the new content
+      old_location = self.sm.get_location(target)[0]['location']
+      blobs.release(old_location)
+      location = blobs.ingest(meta['location'], meta['sha256'], meta['length'])
+      if not blobs.contains(old_location): self.sm.after_commit(self.nm.reclaimer._unlink, old_location, 0)
+    self.sm.complete_transfers(jobid, target, properties, location)
+
+  def get_upload_location(self, location):
+    """
+    Get where uploaded bytes for the specified location should be written
+    """
+    return self.nm.blobs is not None and self.nm.blobs.get_staging() or location
+
+  def _negotiate_protocols(self, protocols, direction, token = None):
+    """
+    Negotiate the appropriate protocols, optionally using the specified 
+    endpoint token
     """
     uris = [p.uri for p in protocols]
     if direction in ['pushFromVoSpace', 'pullToVoSpace']:
@@ -375,7 +1019,7 @@ class TransferManager():
     selected = [p for p in protocols if p.uri in supported]
     if direction in ['pullFromVoSpace', 'pushToVoSpace']:
       for protocol in selected:
-        protocol.set_endpoint(SERVER_PROTOCOLS[protocol.uri].get_endpoint())
+        protocol.set_endpoint(SERVER_PROTOCOLS[protocol.uri].get_endpoint(token))
     return selected
 
   def _get_handler(self, transfer):
@@ -405,38 +1049,33 @@ class TransferManager():
     transfer = Transfer(job.jobInfo)
     target = transfer.target
     direction = transfer.direction
-    result = None
+    # The move was committed before the service was restarted
+    if job.checkpoint: return self._destination(transfer, job.checkpoint)
     # Check uris
     check_uri(target, self.sm, shouldExist = True)
     checks = check_uri(direction, self.sm, shouldExist = False)
     null = direction.endswith(NULL)
-    # Retrieve existing record
-    node = self.sm.get_node(target)[0]['node']
-    node = self.nf.get_node(node)
     # Check whether endpoint is reserved URI
-    if null: self.nm.delete_node(target)
-    if direction.endswith(AUTO): 
-      direction = generate_uri(direction)
-      result = {'destination': direction}
+    if direction.endswith(AUTO): direction = generate_uri(direction)
     if not(null):
       # Check if endpoint is a container
       if checks['exists'] and checks['container']: direction += target[target.rfind('/'):]
-      # Change identifier
-      node.set_uri(direction)
-      # Update db
-      self.sm.update_node(target, direction, node.tostring())
-    # Check if target is a container
-    if isinstance(node, ContainerNode):
-      # Move children
-      for child in self.sm.get_children(target):
-        node = self.nf.get_node(self.sm.get_node(child)[0]['node'])
-        if null:
-          self.nm.delete_node(node.uri)
-        else:
-          new_uri = node.uri.replace(target, direction)
-          node.set_uri(new_uri)
-          self.sm.update_node(child, new_uri, node.tostring())
-    return result
+      # Deleted nodes still awaiting reclamation must not collide
+      self.nm.reclaimer.drain(direction)
+    self.sm.begin()
+    try:
+      if null:
+        self.nm.delete_node(target)
+      else:
+        # Update db: any children are moved with the node
+        self.nm.check_quota(direction, self.sm.get_size(target)['bytes'], target)
+        self.sm.move_node(target, direction)
+      self.sm.update_progress(job, direction)
+      self.sm.commit()
+    except:
+      self.sm.rollback()
+      raise
+    return self._destination(transfer, direction)
 
   def copy_node(self, job):
     """
@@ -445,65 +1084,84 @@ class TransferManager():
     transfer = Transfer(job.jobInfo)
     target = transfer.target
     direction = transfer.direction
-    result = None
+    cursor = None
     # Check uris
     check_uri(target, self.sm, shouldExist = True)
-    checks = check_uri(direction, self.sm, shouldExist = False)
-    # Retrieve existing record
-    node = self.sm.get_node(target)[0]['node']
-    node = self.nf.get_node(node)
-    # Check whether endpoint is reserved URI
-    if direction.endswith(AUTO): 
-      direction = generate_uri(direction)
-      result = {'destination': direction}
-    # Check if endpoint is a container
-    if checks['exists'] and checks['container']: direction += target[target.rfind('/'):]
-    # Copy it
-    old_location = self.sm.get_location(target)[0]['location']
-    new_location = self._create_copy(node, direction)
-    # Check if target is a container
-    if isinstance(node, ContainerNode):
-      # Copy children
-      for child in self.sm.get_all_children(target):
-        child_node = self.nf.get_node(self.sm.get_node(child)[0]['node'])
-        new_uri = child_node.uri.replace(target, direction)
-        self._create_copy(child_node, new_uri)
-    # Copy bytes    
-    if isinstance(node, ContainerNode):
-      shutil.copytree(old_location, new_location)
+    if job.checkpoint:
+      # The records were copied before the service was restarted
+      direction, cursor = (job.checkpoint.split('\t', 1) + [None])[:2]
     else:
-      shutil.copy(old_location, new_location)
-    return result
-    
-  def _create_copy(self, node, direction):
+      checks = check_uri(direction, self.sm, shouldExist = False)
+      # Check whether endpoint is reserved URI
+      if direction.endswith(AUTO): direction = generate_uri(direction)
+      # Check if endpoint is a container
+      if checks['exists'] and checks['container']: direction += target[target.rfind('/'):]
+      # Nodes deleted at either end must not be copied or collide with the copy
+      self.nm.reclaimer.drain(target)
+      self.nm.reclaimer.drain(direction)
+      # Copy the records in one go
+      parent = direction[:direction.rfind('/')]
+      self.sm.begin()
+      try:
+        self.nm.check_quota(direction, self.sm.get_size(target)['bytes'])
+        count = self.sm.copy_tree(target, direction, self.sm.get_node_id(parent), get_location(direction))
+        job.add_parameter('copiedNodes', str(count))
+        self.sm.update_progress(job, direction)
+        self.sm.commit()
+      except:
+        self.sm.rollback()
+        raise
+    # Copy bytes: content addressed bytes are shared rather than copied
+    self._copy_bytes(job, target, direction, cursor)
+    return self._destination(transfer, direction)
+
+  def _destination(self, transfer, direction):
+    """
+    Get the result of a move or copy to an autogenerated URI
+    """
+    return transfer.direction.endswith(AUTO) and {'destination': direction} or None
+
+  def _copy_bytes(self, job, target, direction, cursor):
+    """
+    Copy the bytes of every copied node from its original's location to
+    its own, skipping nodes up to the cursor and checkpointing progress in
+    the job as the rest are copied
+    """
+    copies = self.sm.get_copied_locations(target, direction)
+    for row in sorted([x for x in copies if x['type'] == CONTAINER_NODE], key = lambda x: x['copy']):
+      if not os.path.exists(row['copy']): os.makedirs(row['copy'])
+    files = sorted([(x['identifier'], x['location'], x['copy']) for x in copies if x['type'] != CONTAINER_NODE])
+    done = cursor is not None and bisect.bisect_right([x[0] for x in files], cursor) or 0
+    if done == len(files): return
+    def copy(file):
+      if os.path.exists(file[1]): copy_file(file[1], file[2])
+      return file[0]
+    pool = ThreadPool(min(COPY_WORKERS, len(files) - done))
+    try:
+      reported = time()
+      # Files are yielded in order so each one marks all before it as copied
+      for identifier in pool.imap(copy, files[done:]):
+        done += 1
+        if done % COPY_CHECKPOINT == 0 or time() - reported >= COPY_PROGRESS_FREQ:
+          self._report_progress(job, '%s\t%s' % (direction, identifier), done, len(files))
+          reported = time()
+    finally:
+      pool.close()
+    self._report_progress(job, '%s\t%s' % (direction, files[-1][0]), done, len(files))
+
+  def _report_progress(self, job, checkpoint, done, total):
     """
-    Create a copy of the specified node
+    Record the progress of a copy in the job parameters along with where
+    to resume it
     """
-    new_node = copy.copy(node)
-    new_node.set_uri(direction)
-    new_location = get_location(direction)
-    # Insert into db  
-    self.sm.create_node(new_node.tostring(), direction, NODETYPES[node.TYPE], location = new_location)
-    return new_location
+    job.add_parameter('progress', '%d/%d' % (done, total))
+    self.sm.update_progress(job, checkpoint)
 
   def push_to_vospace(self, job):
     """
     Transfer data to the service (client mediated)
     """
-    transfer = Transfer(job.jobInfo)
-    # Loop checking for upload until 1 hour has passed
-    starttime = datetime.now()
-    location = self.sm.get_location(transfer.target)[0]['location']
-    original = os.path.exists(location) and datetime.fromtimestamp(os.stat(location).st_mtime) or None
-    while (datetime.now() - starttime).seconds / 3600 == 0:
-      if os.path.exists(location):
-        statinfo = os.stat(location)
-        last_modified = datetime.fromtimestamp(statinfo.st_mtime)
-        if last_modified != original and (datetime.now() - last_modified).seconds > 5: break
-      sleep(1)    
-    # Log transfer as completed
-    self.sm.complete_transfers(job.jobId) 
-    return None
+    return self._await_client(job)
 
   def pull_to_vospace(self, job):
     """
@@ -511,10 +1169,12 @@ class TransferManager():
     """
     transfer = Transfer(job.jobInfo)
     # Loop through protocols trying to load data
-    location = self.sm.get_location(transfer.target)[0]['location']
+    location = self.get_upload_location(self.sm.get_location(transfer.target)[0]['location'])
+    meta = None
     for protocol in transfer.protocols:
       try:
-        if CLIENT_PROTOCOLS[protocol.uri].load_data(protocol.endpoint, location): 
+        meta = CLIENT_PROTOCOLS[protocol.uri].load_data(protocol.endpoint, location)
+        if meta: 
           break
       except Exception, e:
         if "Couldn't resolve host" in e[1]:
@@ -522,7 +1182,7 @@ class TransferManager():
         else:
           raise VOSpaceError(500, e[1])
     # Log transfer as completed
-    self.sm.complete_transfers(job.jobId) 
+    self.complete_transfer(job.jobId, transfer.target, meta) 
     return None
 
   def push_from_vospace(self, job):
@@ -550,16 +1210,18 @@ class TransferManager():
     """
     Transfer data from the service (client mediated)
     """
-    transfer = Transfer(job.jobInfo)
-    # Loop checking for download until 1 hour has passed
-    starttime = datetime.now()
-    while (datetime.now() - starttime).seconds / 3600 == 0:
+    return self._await_client(job)
+
+  def _await_client(self, job):
+    """
+    Leave the job EXECUTING until the client has used one of its endpoints
+    """
+    if self.jm.defer_job(job.jobId):
+      # An endpoint may have been used before the service was restarted
       status = self.sm.get_transfer_completed(job.jobId)
-      complete = len([x for x in status if x['completed'] is not None])
-      if complete == len(status): break
-      sleep(1)    
-    # Log transfer as completed
-    self.sm.complete_transfers(job.jobId) 
+      if len([x for x in status if x['completed'] is not None]) > 0:
+        self.jm.signal_job(job.jobId)
+      return JobManager.DEFERRED
     return None
 
 
@@ -1,8 +1,10 @@
 # 
 
 from syncVOSpace import Sync
+from pool import ConnectionPool
 from store import LocalStoreManager
-from node import NodeFactory
+from resources import NodeFactory, LinkNode
+from search import get_number
 import config as cfg
 from lineparser import Task, Option
 from dateutil import parser 
@@ -27,6 +29,7 @@ def registerNode(vosurl, token, node, location):
       print("Error registering %s" % location)
     else:
       print("%s registered" % location)
+    return r.status_code == 201
 #    if resp['status'] != 201:
 #      print 'Error with node %s' % node
 #      sys.exit(-1)
@@ -73,7 +76,10 @@ class AddUser(Task):
       url = '%s/register/%s' % (self.vosurl, self.name)
       conf = {'uri': uri, 'ispublic': 'false', 'group': ''}
       node = self.container.safe_substitute(conf)
-      registerNode(url, self.token, node, userdir)
+      # The quota applies to everything beneath the user directory: it is
+      # read only to the service so is set in the store
+      if registerNode(url, self.token, node, userdir) and self.quota.value:
+        LocalStoreManager().update_node(uri.replace('~', '!'), {cfg.QUOTA: str(int(self.quota.value))})
     else:
       print "User directory %s already exists" % userdir
 
@@ -116,12 +122,11 @@ class Validate(Task):
     
   def run(self):
     sync = Sync([])
-    nf = NodeFactory()
     store = LocalStoreManager()
     # Get data from metadata db
     start = self.start.value.replace('~', '!') # Both characters are allowed
-    query = "select identifier, location, node from nodes where identifier like '%s%%' order by identifier" % start
-    res = store.query(query)
+    query = "select identifier, location from nodes where identifier like %s order by identifier"
+    res = store.query(query, (start + '%',))
     # Check through nodes under starting point
     for record in res:
       vosid = record['identifier']
@@ -134,25 +139,115 @@ class Validate(Task):
         if self.fix.value: # Resolve by deleting record
           store.delete_node(vosid)
           continue
-      node = nf.get_node(etree.fromstring(record['node']))
+      properties = store.get_node(vosid)[0]['properties']
       # File size
-      if cfg.LENGTH not in node.properties:
+      if cfg.LENGTH not in properties:
         print("The file size is missing for: %s" % vosid)
-      elif node.properties[cfg.LENGTH] != meta['size']:
+      elif properties[cfg.LENGTH] != meta['size']:
         print("The sizes for %s and %s do not match" % (vosid, location))
         if self.fix.value:
-          node.properties[cfg.LENGTH] = meta['size']
-          store.update_node(vosid, node, vosid)
+          store.update_node(vosid, {cfg.LENGTH: meta['size']})
       # Date
-      if relativedelta(parser.parse(node.properties[cfg.DATE]) - utc.localize(parser.parse(meta['date']))).seconds > 1: # Current tolerance is 1s.
-        print("The dates for %s and %s do not match: %s %s" % (vosid, location, node.properties[cfg.DATE], meta['date']))
+      if relativedelta(parser.parse(properties[cfg.DATE]) - utc.localize(parser.parse(meta['date']))).seconds > 1: # Current tolerance is 1s.
+        print("The dates for %s and %s do not match: %s %s" % (vosid, location, properties[cfg.DATE], meta['date']))
         if self.fix.value:
-          node.properties[cfg.DATE] = meta['size']
-          store.update_node(vosid, node, vosid)
+          store.update_node(vosid, {cfg.DATE: meta['date']})
         
         
       
 
+class Quota(Task):
+  '''Set the quota on a container'''
+  def __init__(self, admin):
+    Task.__init__(self, admin, 'quota', 'set the quota on a container: clients cannot change it')
+    self.addOption('uri', Option('uri', '', 'container node in VOSpace', required = True))
+    self.addOption('quota', Option('quota', '', 'quota in bytes, none to remove it', required = True))
+
+  def run(self):
+    store = LocalStoreManager()
+    uri = self.uri.value.replace('~', '!') # Both characters are allowed
+    if len(store.get_node(uri)) == 0:
+      print("No node exists with the URI %s" % uri)
+    elif self.quota.value == 'none':
+      store.update_node(uri, None, [cfg.QUOTA])
+      print("Quota removed from %s" % uri)
+    else:
+      store.update_node(uri, {cfg.QUOTA: str(int(self.quota.value))})
+      print("Quota of %s set to %s bytes" % (uri, self.quota.value))
+
+
+class Migrate(Task):
+  '''Migrate the nodes and transfers tables to the current schema'''
+  def __init__(self, admin):
+    Task.__init__(self, admin, 'migrate', 'bring an existing database up to the current schema')
+    self.addOption('vosroot', Option('vosroot', '', 'root node of VOSpace', required = True, default = cfg.ROOT_NODE))
+
+  def run(self):
+    # The store expects the current schema so use a bare connection
+    pool = ConnectionPool(cfg.CONFIG.dbinfo().copy(), 1)
+    rootdepth = self.vosroot.value.count('/')
+    queries = [
+      # Node ids replace the identifier as primary key
+      "alter table nodes engine = InnoDB",
+      "alter table nodes drop primary key, add column id int not null auto_increment primary key first, add column parent_id int null default null after id, add column name varchar(128) not null default '' after parent_id, add column depth smallint not null default 0 after name, add unique index identifier_UNIQUE (identifier)",
+      # Names and depths follow from the identifier
+      "update nodes set name = substring_index(identifier, '/', -1), depth = length(identifier) - length(replace(identifier, '/', '')) - %d" % rootdepth,
+      # Parents are the nodes whose identifier is the path without the name
+      "update nodes n join nodes p on p.identifier = substring(n.identifier, 1, char_length(n.identifier) - char_length(n.name) - 1) set n.parent_id = p.id",
+      "alter table nodes add unique index parent_name (parent_id, name), add constraint fk_nodes_parent foreign key (parent_id) references nodes (id)",
+      # Transfer endpoints are looked up by their token
+      "alter table transfers add column token varchar(32) null after endpoint, add index token_INDEX (token)",
+      "update transfers set token = substring_index(endpoint, '/', -1) where endpoint like '%s/%%'" % cfg.TRANSFER_ENDPOINT,
+      # Deleted nodes are reclaimed in the background
+      "create table if not exists tombstones (id int not null auto_increment primary key, identifier varchar(128) not null, rootid int not null, maxid int not null, location varchar(128) not null, created datetime null, index identifier_INDEX (identifier)) engine = InnoDB",
+      # Content addressed bytes are reference counted
+      "create table if not exists blobs (location varchar(128) not null primary key, digest char(64) not null, length bigint not null, refcount int not null default 0, created datetime null, index refcount_INDEX (refcount)) engine = InnoDB",
+      # Long jobs record how far they got
+      "alter table jobs add column checkpoint text null",
+      # Containers keep running totals of the bytes and nodes beneath them
+      "create table if not exists usages (identifier varchar(128) not null primary key, bytes bigint not null default 0, files int not null default 0, quota bigint null default null) engine = InnoDB",
+      "insert into usages (identifier, bytes, files) select a.identifier, coalesce(sum(cast(p.value as unsigned)), 0), count(*) from nodes a join nodes n on n.identifier like concat(a.identifier, '/%%') left join properties p on p.identifier = n.identifier and p.property = '%s' where a.type = %d and a.identifier <> '%s' group by a.identifier" % (cfg.LENGTH, cfg.CONTAINER_NODE, self.vosroot.value),
+      "insert into usages (identifier, bytes, files) select '%s', coalesce(sum(cast(p.value as unsigned)), 0), count(*) from nodes n left join properties p on p.identifier = n.identifier and p.property = '%s' where n.identifier like '%s/%%'" % (self.vosroot.value, cfg.LENGTH, self.vosroot.value),
+      # Properties are searched through indexes, numerically where they are numbers
+      "alter table properties add column number double null default null, add index identifier_INDEX (identifier), add index property_value (property, value(128)), add index property_number (property, number)",
+      "update properties set number = value + 0 where value regexp '^[-+]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][-+]?[0-9]+)?$'",
+      # Signed sync endpoints are used once
+      "create table if not exists signed_tokens (signature char(64) not null primary key, uses int not null default 0, expires datetime not null, index expires_INDEX (expires)) engine = InnoDB",
+      # Every change to a node is logged for clients to follow
+      "create table if not exists changes (seq bigint not null auto_increment primary key, identifier varchar(128) not null, operation varchar(16) not null, created datetime null, index created_INDEX (created)) engine = InnoDB",
+      # Nodes are rendered from their columns and property rows
+      "alter table nodes add column target text null default null, add column version int not null default 0"]
+    for query in queries:
+      pool.execute([[query, None]])
+    self.normalize(pool)
+    queries = [
+      "alter table properties drop index identifier_INDEX, add primary key (identifier, property)",
+      "alter table nodes drop column node",
+      # Quotas are enforced from the usages of the containers they are set on
+      "insert into usages (identifier, bytes, files, quota) select identifier, 0, 0, cast(value as unsigned) from properties where property = '%s' on duplicate key update quota = values(quota)" % cfg.QUOTA]
+    for query in queries:
+      pool.execute([[query, None]])
+    print("Database migrated")
+
+  def normalize(self, pool):
+    '''Rewrite the property rows and link targets of each node from its stored document'''
+    nf = NodeFactory()
+    last = 0
+    while True:
+      rows = pool.execute([["select id, identifier, node from nodes where id > %s and node is not null order by id limit 1000", (last,)]])[0]
+      if len(rows) == 0: break
+      for row in rows:
+        node = nf.get_node(etree.fromstring(row['node']))
+        queries = [["delete from properties where identifier = %s", (row['identifier'],)]]
+        for property in node.properties:
+          value = node.properties[property]
+          queries.append(["insert into properties (identifier, property, value, number) values (%s, %s, %s, %s)", (row['identifier'], property, value, get_number(value))])
+        if isinstance(node, LinkNode):
+          queries.append(["update nodes set target = %s where id = %s", (node.target, row['id'])])
+        pool.execute(queries)
+      last = rows[-1]['id']
+
+
 class Register(Task):
   '''Backend file registration'''
   def __init__(self, admin):
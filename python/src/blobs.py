@@ -0,0 +1,103 @@
+#!/usr/bin/python -u
+# 2026/10/18
+# v0.1
+#
+# blobs.py
+# Python code to handle content addressed storage
+
+from config import TRANSFER_TIMEOUT
+from time import time
+import errno
+import os
+import uuid
+
+class BlobStore():
+  """
+  Class to keep bytes under their SHA-256 digest: nodes with the same 
+  content share one reference counted copy
+  """
+
+  def __init__(self, sm, root):
+    self.sm = sm
+    self.root = root.rstrip('/')
+    self.staging = self.root + '/staging'
+    if not os.path.exists(self.staging): os.makedirs(self.staging)
+
+  def contains(self, location):
+    """
+    Check whether the specified location is in the store
+    """
+    return bool(location) and location.startswith(self.root + '/') and not location.startswith(self.staging + '/')
+
+  def get_staging(self):
+    """
+    Get a location to write incoming bytes to before they are ingested
+    """
+    return '%s/%s' % (self.staging, uuid.uuid4().hex)
+
+  def get_location(self, digest):
+    """
+    Get the location of the bytes with the specified digest
+    """
+    return '%s/%s/%s' % (self.root, digest[:2], digest)
+
+  def ingest(self, path, digest, length):
+    """
+    Count a reference to the bytes with the specified digest and move the
+    staged bytes into the store once it is committed
+    """
+    location = self.get_location(digest)
+    self.sm.add_blob_ref(location, digest, length)
+    self.sm.after_commit(self._place, path, location)
+    return location
+
+  def _place(self, path, location):
+    """
+    Put staged bytes at their location in the store: an existing copy is
+    kept, its bytes may be being read, and the staged bytes are discarded
+    """
+    if not os.path.exists(os.path.dirname(location)): os.makedirs(os.path.dirname(location))
+    try:
+      # Unlike a rename, a link never replaces the target
+      os.link(path, location)
+    except OSError, e:
+      if e.errno != errno.EEXIST: raise
+    os.remove(path)
+
+  def add_ref(self, location):
+    """
+    Count another reference to the bytes at the specified location
+    """
+    self.sm.add_blob_ref(location)
+
+  def release(self, location):
+    """
+    Drop a reference to the bytes at the specified location
+    """
+    if self.contains(location): self.sm.release_blob(location)
+
+  def collect(self, limit):
+    """
+    Remove bytes which no node refers to any more: they are moved aside
+    first and put back if a new reference arrived in the meantime. Staged
+    bytes left by failed uploads are removed too
+    """
+    expired = time() - TRANSFER_TIMEOUT
+    for name in os.listdir(self.staging):
+      path = os.path.join(self.staging, name)
+      try:
+        if os.path.getmtime(path) < expired: os.remove(path)
+      except OSError:
+        pass
+    for location in self.sm.get_unused_blobs(limit):
+      aside = location + '.unused'
+      try:
+        os.rename(location, aside)
+      except OSError:
+        aside = None
+      if self.sm.delete_unused_blob(location):
+        if aside: os.remove(aside)
+      elif aside and not os.path.exists(location):
+        os.rename(aside, location)
+      elif aside:
+        os.remove(aside)
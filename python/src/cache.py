@@ -0,0 +1,80 @@
+#!/usr/bin/python -u
+# 2026/10/18
+# v0.1
+#
+# cache.py
+# Python code to handle in-memory caches
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+class LRUCache():
+  """
+  A bounded, thread-safe mapping which discards the least recently used
+  entries once it is full
+  """
+
+  def __init__(self, size, discard = None):
+    self.size = size
+    self.discard = discard
+    self.entries = OrderedDict()
+    self.lock = Lock()
+
+  def get(self, key, default = None):
+    """
+    Get the value for the specified key, marking it as recently used
+    """
+    with self.lock:
+      if key not in self.entries: return default
+      value = self.entries.pop(key)
+      self.entries[key] = value
+      return value
+
+  def put(self, key, value):
+    """
+    Store the value for the specified key, evicting the oldest entry if full
+    and passing it to any discard function
+    """
+    evicted = None
+    with self.lock:
+      if key in self.entries:
+        del self.entries[key]
+      elif len(self.entries) >= self.size:
+        evicted = self.entries.popitem(last = False)
+      self.entries[key] = value
+    if evicted is not None and self.discard is not None: self.discard(evicted[1])
+
+  def remove(self, key):
+    """
+    Discard any value for the specified key
+    """
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def __len__(self):
+    return len(self.entries)
+
+
+class TTLCache(LRUCache):
+  """
+  A bounded, thread-safe mapping whose entries also lapse at an expiry time
+  """
+
+  def get(self, key, default = None):
+    """
+    Get the unexpired value for the specified key
+    """
+    entry = LRUCache.get(self, key)
+    if entry is None: return default
+    if entry[0] <= time():
+      self.remove(key)
+      return default
+    return entry[1]
+
+  def put(self, key, value, expiry):
+    """
+    Store the value for the specified key until the expiry time (in seconds
+    since the epoch)
+    """
+    LRUCache.put(self, key, (expiry, value))
@@ -22,6 +22,15 @@ XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
 # VOSpace
 ROOT_NODE = 'vos://nvo.caltech!vospace'
 
+# Listings
+LISTING_PAGE_SIZE = 1000 # Number of children fetched per query when listing a container
+LISTING_TYPE = 'application/x-ndjson' # Media type of the line-delimited form of a container listing
+
+# Response caching
+NODE_CACHE_SIZE = 10000 # Number of rendered node documents kept in memory
+ENDPOINT_CACHE_SIZE = 10000 # Number of transfer endpoints kept in memory
+JOB_INFO_CACHE_SIZE = 1000 # Number of serialized job details kept in memory
+
 # Reserved URIs
 AUTO = '.auto'
 NULL = '.null'
@@ -60,21 +69,61 @@ RELATION = 'ivo://ivoa.net/vospace/core#relation'
 COVERAGE = 'ivo://ivoa.net/vospace/core#coverage'
 RIGHTS = 'ivo://ivoa.net/vospace/core#rights'
 AVAILABLE_SPACE = 'ivo://ivoa.net/vospace/core#availableSpace'
+MD5 = 'ivo://ivoa.net/vospace/core#MD5'
+LENGTH = 'ivo://ivoa.net/vospace/core#length'
+QUOTA = 'ivo://ivoa.net/vospace/core#quota'
 ACCEPTS_PROPERTIES = [DESCRIPTION]
-PROVIDES_PROPERTIES = [AVAILABLE_SPACE]  
-READ_ONLY_PROPERTIES = [AVAILABLE_SPACE]
+PROVIDES_PROPERTIES = [AVAILABLE_SPACE, MD5, LENGTH, DATE, QUOTA]  
+READ_ONLY_PROPERTIES = [AVAILABLE_SPACE, QUOTA, LENGTH, MD5]
 
 # Transfers
 TRANSFER_ENDPOINT = 'http://localhost:8000/data'
 STORAGE_LOCATION = '/Users/mjg/Projects/noao/vospace/vospace-2.0/python/data'
-hh = HttpHandler(TRANSFER_ENDPOINT, STORAGE_LOCATION)
+TRANSFER_BUFFER_SIZE = 1048576 # Size of read/write buffer for data transfers
+SYNC_FAST_PATH = False # Answer sync pullFromVoSpace and pushToVoSpace requests directly with signed endpoints rather than redirecting to a job: clients must accept the transfer document in the response instead of a 303
+SYNC_SECRET = '' # Key for signing endpoints, shared by all instances of the service: a random key is used if empty
+SYNC_LIFETIME = 3600 # Seconds a signed endpoint remains valid: each can be used once
+hh = HttpHandler(TRANSFER_ENDPOINT, STORAGE_LOCATION, TRANSFER_BUFFER_SIZE)
 CLIENT_PROTOCOLS = {'ivo://ivoa.net/vospace/core#httpget': hh, 'ivo://ivoa.net/vospace/core#httpput': hh}
 SERVER_PROTOCOLS = {'ivo://ivoa.net/vospace/core#httpget': hh, 'ivo://ivoa.net/vospace/core#httpput': hh}
+DATA_SENDER = FileSender() # Sends the bytes for data requests: SendfileSender() or AccelRedirectSender(STORAGE_LOCATION, '/protected') offload them to a front-end server
 
 # Jobs
-THREAD_POLLING_FREQ = 1
+JOB_RECOVERY_FREQ = 60 # Seconds between sweeps for queued jobs that were never dispatched
+JOB_WORKERS = 32 # Size of the job worker pool
+JOB_LIMITS = {'move_node': 4, 'copy_node': 4, 'push_to_vospace': 8, 'pull_to_vospace': 4, 'push_from_vospace': 4, 'pull_from_vospace': 8} # Maximum concurrent jobs per method
+JOB_QUEUE_LIMIT = 10000 # Number of waiting jobs beyond which new jobs are refused
+TRANSFER_TIMEOUT = 3600 # Seconds a client mediated transfer waits for its endpoint to be used
+JOB_WAIT = 60 # Maximum seconds a request with WAIT blocks for a job to change phase
+
+# Deletion
+TRASH_LOCATION = STORAGE_LOCATION + '/.trash' # Bytes of deleted nodes awaiting reclamation: must be on the same filesystem as STORAGE_LOCATION
+RECLAIM_FREQ = 60 # Seconds between sweeps for deleted nodes to reclaim
+RECLAIM_BATCH = 1000 # Number of rows or files removed at a time
+RECLAIM_PAUSE = 0.1 # Seconds to pause between batches
+
+# Copying
+COPY_WORKERS = 8 # Number of files copied in parallel when copying a container
+COPY_BUFFER = 1024 * 1024 # Bytes per read when a file cannot be cloned
+COPY_PROGRESS_FREQ = 5 # Seconds between progress updates in copy jobs
+COPY_CHECKPOINT = 1000 # Files copied between checkpoints from which an interrupted copy resumes
+
+# Change feed
+CHANGES_WAIT = 60 # Maximum seconds a change feed request waits for new changes
+CHANGES_SETTLE = 5 # Seconds after which a gap in the change sequence is taken to be a rolled back transaction
+CHANGES_RETENTION = 7 # Days changes are kept for: clients which fall further behind must start afresh
+CHANGES_LIMIT = 10000 # Maximum number of changes returned per request
+
+# Content addressed storage
+CONTENT_ADDRESSED = False # Keep bytes under their SHA-256 digest so that copies and identical uploads share them
+BLOB_LOCATION = STORAGE_LOCATION + '/.blobs' # Content addressed bytes: must be on the same filesystem as STORAGE_LOCATION
 
 # Persistence store
+MAX_WAITERS = 10 # Requests that may block at once waiting for changes or a job phase: beyond this they are answered at once
+THREAD_POOL = 10 + MAX_WAITERS # Size of the CherryPy request thread pool: waiting requests each hold a thread
+DB_POOL_SIZE = THREAD_POOL + JOB_WORKERS + 4 # Database connections for the request threads, job workers and background threads
+DB_AFFINITY = True # Pin each thread to the database connection it first uses
+STATEMENT_CACHE_SIZE = 100 # Prepared statements kept open per database connection: DB_POOL_SIZE times this must stay below the server's max_prepared_stmt_count
 class CONFIG(object):
 
   HOST = 'localhost'
@@ -102,6 +151,8 @@ INVALID_URI = "Invalid URI"
 MISSING_PARAMETER = "Missing Parameter"
 VIEW_NOT_SUPPORTED = "View Not Supported"
 PROTOCOL_NOT_SUPPORTED = "Protocol Not Supported"
+QUOTA_EXCEEDED = "Quota Exceeded"
+INVALID_ARGUMENT = "Invalid Argument"
 
 # VOSpaceError
 class VOSpaceError(Exception):
@@ -7,8 +7,9 @@
 
 import cgi
 import cherrypy
-from cherrypy.lib.static import serve_file
+import hashlib
 from datetime import datetime
+from functools import wraps
 import sys, string, os, re, errno, time, stat
 from os import path, environ
 from socket import gethostbyaddr, gethostname, gethostbyname
@@ -17,7 +18,8 @@ from subprocess import Popen, PIPE
 from time import localtime, strftime, asctime, gmtime
 from urllib import unquote
 
-from admin import NodeManager, TransferManager, JobManager
+from admin import NodeManager, TransferManager, JobManager, SearchManager, ChangeFeed, build_node
+from cache import LRUCache
 from config import *
 from datetime import datetime
 from store import LocalStoreManager
@@ -60,6 +62,27 @@ def noBodyProcess():
 cherrypy.tools.noBodyProcess = cherrypy.Tool('before_request_body', 
                                              noBodyProcess)
 # ----------------------------------------------------------
+def transactional(method):
+  """
+  Run a request handler as a single unit of work, committing on success or
+  redirect and rolling back on any other error
+  """
+  @wraps(method)
+  def handler(self, *args, **kwargs):
+    self.sm.begin()
+    try:
+      result = method(self, *args, **kwargs)
+    except cherrypy.HTTPRedirect:
+      self.sm.commit()
+      raise
+    except:
+      self.sm.rollback()
+      raise
+    self.sm.commit()
+    return result
+  return handler
+
+# ----------------------------------------------------------
 class Mapper():
   """
   Root class for VOSpace service
@@ -74,16 +97,21 @@ class Mapper():
     self.nm = NodeManager(self.sm)
     self.jm = JobManager(self.sm)
     self.tm = TransferManager(self.sm, self.nm, self.jm)
-    thread.start_new_thread(self._check_transfers, (THREAD_POLLING_FREQ,))
+    self.search = SearchManager(self.sm)
+    self.changes = ChangeFeed(self.sm)
+    self.jm.recover_jobs()
+    self.cache = LRUCache(NODE_CACHE_SIZE)
+    thread.start_new_thread(self._check_transfers, (JOB_RECOVERY_FREQ,))
 
   def _check_transfers(self, delay):
     """
-    Check the transfers list every specified delay
+    Recover undispatched transfers every specified delay
     """
     while 1:
       sleep(delay)
       self.jm.check_jobs()
 
+  @transactional
   def GET(self, *args, **kwargs):
     """
     Respond to HTTP GET requests
@@ -101,21 +129,29 @@ class Mapper():
         if 'view' in kwargs and kwargs['view'] == 'data':
           location = self.sm.get_node_location(ROOT_NODE + "/" + "/".join(args[1:]))
           if len(location) == 0: raise VOSpaceError(404, 'A Node does not exist with the requested URI.')
-          return serve_file(location[0]['location'])
+          return DATA_SENDER.send(location[0]['location'])
         else:
           return self._get_node(args[1:], kwargs)
       elif resource == 'transfers':
-        return self._get_transfers(args[1:])
+        return self._get_transfers(args[1:], kwargs)
       elif resource == 'searches':
-        return self._get_searches(args[1:])
+        return self._get_searches(args[1:], kwargs)
+      elif resource == 'changes':
+        return self._get_changes(kwargs)
+      elif resource == 'scheduler':
+        return self._get_scheduler()
       elif resource == 'data':
-        if not self._check_endpoint(args[1]):
+        endpoint = self.tm.get_endpoint(args[1], 'pullFromVoSpace')
+        if endpoint is None:
           raise cherrypy.HTTPError(404)
         else:
-          location = self._get_location(args[1])
-          self._complete_transfer(args[1])
           # Put in switch for correct content type based on view
-          return serve_file(location)
+          body = DATA_SENDER.send(endpoint['location'])
+          # Complete the transfer once all the bytes have been sent: a failed
+          # download leaves the endpoint for the client to retry
+          sent = []
+          cherrypy.request.hooks.attach('on_end_request', self._end_download, endpoint = endpoint, sent = sent)
+          return self._track_body(body, sent)
       else:
         raise cherrypy.HTTPError(404)
     except VOSpaceError, e:
@@ -128,33 +164,63 @@ class Mapper():
     if not self._check_user(args): raise VOSpaceError(401, "User does not have permissions to perform the operation.", summary = PERMISSION_DENIED)
     resource = args[0]
     if resource == 'nodes':
-      try:
-        # Check endpoint does not exist
-        if self._check_exists(args[1:]): raise VOSpaceError(409, "A Node already exists with the requested URI.", summary = DUPLICATE_NODE)
-        dataLength = int(cherrypy.request.headers.get('Content-Length') or 0)
-        data = cherrypy.request.rfile.read(dataLength)
-        xmldata = etree.fromstring(data)
-        # Check node URI and endpoint agree
-        if xmldata.get("uri") != ROOT_NODE + '/' + '/'.join(args[1:]): raise VOSpaceError(500, "A specified URI is invalid", summary = INVALID_URI)
-        node = self._create_node(xmldata)
-        cherrypy.response.status = 201
-        return etree.tostring(xmldata)
-      except VOSpaceError, e:
-        raise cherrypy.HTTPError(e.code, e.value)
-      except SyntaxError, e:
-        print e
-        raise cherrypy.HTTPError(500)
+      return self._put_node(args)
     elif resource == 'data':
-      # File upload
-      if not self._check_endpoint(args[1]):
-        raise cherrypy.HTTPError(404)
-      else:
-        location = self._get_location(args[1])
-        success = SERVER_PROTOCOLS['ivo://ivoa.net/vospace/core#httpput'].manage_file(location, cherrypy.request)
-        if not success: raise cherrypy.HTTPError(500)
+      # File upload: the bytes are stored between two units of work so no 
+      # transaction is held open while they arrive
+      endpoint = self._check_upload(args[1], int(cherrypy.request.headers.get('Content-Length') or 0))
+      location = self.tm.get_upload_location(endpoint['location'])
+      meta = SERVER_PROTOCOLS['ivo://ivoa.net/vospace/core#httpput'].manage_file(location, cherrypy.request)
+      if meta is None: raise cherrypy.HTTPError(500)
+      self._store_upload(endpoint, meta)
     else:
       raise cherrypy.HTTPError(404)
 
+  @transactional
+  def _put_node(self, args):
+    """
+    Create the node sent in the request body
+    """
+    try:
+      dataLength = int(cherrypy.request.headers.get('Content-Length') or 0)
+      data = cherrypy.request.rfile.read(dataLength)
+      xmldata = etree.fromstring(data)
+      # Check node URI and endpoint agree
+      if xmldata.get("uri") != ROOT_NODE + '/' + '/'.join(args[1:]): raise VOSpaceError(500, "A specified URI is invalid", summary = INVALID_URI)
+      node = self._create_node(xmldata)
+      cherrypy.response.status = 201
+      return etree.tostring(xmldata)
+    except VOSpaceError, e:
+      raise cherrypy.HTTPError(e.code, e.value)
+    except SyntaxError, e:
+      print e
+      raise cherrypy.HTTPError(500)
+
+  @transactional
+  def _check_upload(self, token, length):
+    """
+    Get the endpoint for an upload of the specified length, checking that
+    it fits within any quota
+    """
+    endpoint = self.tm.get_endpoint(token, 'pushToVoSpace')
+    if endpoint is None: raise cherrypy.HTTPError(404)
+    try:
+      self.nm.check_quota(endpoint['target'], length)
+    except VOSpaceError, e:
+      raise cherrypy.HTTPError(e.code, e.value)
+    return endpoint
+
+  @transactional
+  def _store_upload(self, endpoint, meta):
+    """
+    Record the uploaded bytes with the target node
+    """
+    try:
+      self._complete_transfer(endpoint, meta)
+    except VOSpaceError, e:
+      raise cherrypy.HTTPError(e.code, e.value)
+
+  @transactional
   def POST(self, *args, **kwargs):
     """
     Respond to HTTP POST requests
@@ -176,9 +242,13 @@ class Mapper():
           else:
             return self._update_node(args, request)
         elif resource == 'searches' and len(args) == 1:
-          jobid = self._find_nodes(request)
+          jobid = self.search.add_search(request)
           raise cherrypy.HTTPRedirect("%s/searches/%s" % (HOST, jobid))
         elif resource == 'sync' and len(args) == 1:
+          if not(self._parse_transfer(request)): raise VOSpaceError()
+          transfer = Transfer(request)
+          if SYNC_FAST_PATH and transfer.direction in self.tm.SIGNED:
+            return self.tm.sign_transfer(transfer)
           jobid = self._create_transfers(request, run = True)
           results = self.sm.get_results(jobid)
           raise cherrypy.HTTPRedirect("%s/transfers/%s/results/details" % (HOST, jobid))
@@ -208,6 +278,7 @@ class Mapper():
 #    except SyntaxError:
 #      raise cherrypy.HTTPError(500)
     
+  @transactional
   def DELETE(self, *args, **kwargs):
     """
     Respond to HTTP DELETE requests
@@ -289,6 +360,17 @@ class Mapper():
     provides += '</provides>\n'
     return baseResponse % (accepts, provides)
     
+  def _get_scheduler(self):
+    """
+    Return the state of the job queues
+    """
+    baseResponse = '''<scheduler queued="%s">\n %s</scheduler>\n'''
+    stats = self.jm.get_stats()
+    methods = ''
+    for method in sorted(stats):
+      methods += '''<method name="%s" limit="%s" running="%s" queued="%s" oldestWait="%.3f" meanWait="%.3f"/>\n''' % (method, stats[method]['limit'], stats[method]['running'], stats[method]['queued'], stats[method]['oldestWait'], stats[method]['meanWait'])
+    return baseResponse % (sum([stats[x]['queued'] for x in stats]), methods)
+
   def _create_node(self, xmldata):
     """
     Create a node from the specified data
@@ -303,27 +385,72 @@ class Mapper():
     uri = len(args) > 0 and (ROOT_NODE + "/" + "/".join(args)) or ROOT_NODE
     res = self.sm.get_node(uri)
     if len(res) > 0:
-      node = self.nf.get_node(res[0]['node'])
-      if node.TYPE == 'vos:ContainerNode':
-        children = self.sm.get_children(uri)
-        if 'uri' in kwargs:
-          match = False
-          count = 0
-          for child in children:
-            if child == kwargs['uri']: match = True
-            if match and count < int(kwargs['offset']):
-              node.add_node(child)
-              count += 1
+      detail = kwargs.get('detail', 'max')
+      # Rendered documents are reused until the stored node changes
+      # Space properties of containers are kept in the usage rollup
+      space = res[0]['type'] == CONTAINER_NODE and self.nm.get_space(uri) or {}
+      key = (uri, res[0]['id'], res[0]['version'], detail, tuple(sorted(space.items())))
+      cached = self.cache.get(key)
+      if cached is not None:
+        return self._send_node(*cached)
+      node = build_node(res[0])
+      node.properties.update(space)
+      if node.TYPE == 'vos:ContainerNode' and detail == 'max':
+        # Children are paged from the store starting at the requested uri
+        # and sent as they are read, as XML or as lines of JSON
+        limit = kwargs.get('limit', kwargs.get('offset'))
+        if limit is not None: limit = int(limit)
+        cherrypy.response.headers['Vary'] = 'Accept'
+        cherrypy.response.stream = True
+        listing = self._accepts(LISTING_TYPE)
+        etag = self._listing_etag(key, listing, kwargs.get('uri'), limit)
+        if listing:
+          cherrypy.response.headers['Content-Type'] = LISTING_TYPE
+          entries = self.nm.get_entries(node, start = kwargs.get('uri'), limit = limit)
         else:
-          for child in children:
-            node.add_node(child)
-      if 'detail' in kwargs:
-        return node.tostring(detail = kwargs['detail'])
-      else:
-        return node.tostring()
+          entries = node.iterstring(self.sm.iter_children(uri, start = kwargs.get('uri'), limit = limit))
+        if etag is None: return entries
+        return self._send_node(entries, etag)
+      rendered = self._render_node(node, detail)
+      self.cache.put(key, rendered)
+      return self._send_node(*rendered)
     else:
       raise VOSpaceError(404, "The specified node does not exist.") 
 
+  def _accepts(self, media):
+    """
+    Check whether the request names the specified media type as acceptable
+    """
+    return len([x for x in cherrypy.request.headers.elements('Accept') if x.value == media and x.qvalue > 0]) > 0
+
+  def _listing_etag(self, key, *variant):
+    """
+    Get the entity tag for a streamed container listing: every change to a
+    node is logged so the listing is the same while the log is, once the
+    latest change has settled and no earlier one can still commit
+    """
+    range = self.sm.get_change_range()
+    if range['latest'] is None or range['age'] < CHANGES_SETTLE: return None
+    return '"%s"' % hashlib.md5(repr(key + (range['oldest'], range['latest']) + variant)).hexdigest()
+
+  def _render_node(self, node, detail):
+    """
+    Serialize the node and compute its entity tag
+    """
+    xml = node.tostring(detail = detail)
+    return xml, '"%s"' % hashlib.md5(xml).hexdigest()
+
+  def _send_node(self, xml, etag):
+    """
+    Return the node document unless the client already holds this version
+    """
+    cherrypy.response.headers['ETag'] = etag
+    match = cherrypy.request.headers.get('If-None-Match')
+    if match is not None and (match.strip() == '*' or etag in [tag.strip() for tag in match.split(',')]):
+      cherrypy.response.status = 304
+      return ''
+    return xml
+
   def _update_node(self, args, request):
     """
     Update the specified node with the provided details
@@ -331,7 +458,7 @@ class Mapper():
     node = self.nm.update_node(ROOT_NODE + "/" + "/".join(args[1:]), request)
     return node
 
-  def _get_transfers(self, args):
+  def _get_transfers(self, args, kwargs):
     """
     Get the list of transfers
     """
@@ -343,15 +470,34 @@ class Mapper():
         xml = self.job.getResultsAsXml()
       return xml
     elif 'phase' in args:
-      phase = self.sm.get_phase(args[0])[0]['phase']
-      return phase
+      return self._wait_job(args[0], kwargs, lambda: self.sm.get_phase(args[0])[0]['phase'])
     else:
       if len(args) > 0:
-        job = self.sm.get_job(args[0])[0]['job']
+        job = self._wait_job(args[0], kwargs, lambda: self.sm.get_job(args[0])[0]['job'])
       else:
         job = self.jm.get_jobs(type = 'transfers')
       return job
 
+  def _wait_job(self, jobid, kwargs, render):
+    """
+    Render the response for the specified job, first waiting for it to
+    change phase if the request gives WAIT and optionally PHASE (UWS 1.1
+    blocking)
+    """
+    if 'WAIT' not in kwargs: return render()
+    try:
+      wait = int(kwargs['WAIT'])
+    except ValueError:
+      raise VOSpaceError(400, 'The WAIT parameter must be an integer.', summary = INVALID_ARGUMENT)
+    if wait < 0: wait = JOB_WAIT
+    if len(self.sm.get_phase(jobid)) == 0: raise VOSpaceError(404, 'The specified job does not exist.')
+    # Wait once the request has committed so that each check reads afresh
+    def stream():
+      self.jm.wait_job(jobid, kwargs.get('PHASE'), wait)
+      yield render()
+    cherrypy.response.stream = True
+    return stream()
+
   def _create_transfers(self, transfer, run = False):
     """
     Create the specified transfer
@@ -367,11 +513,13 @@ class Mapper():
     res = self.sm.get_job(id)
     if len(res) > 0:
       job = Job(res[0]['job'])
-      if phase == 'RUN':
-        if job.phase == 'PENDING': job.set_phase('QUEUED')
+      run = phase == 'RUN' and job.phase == 'PENDING'
+      if run:
+        job.set_phase('QUEUED')
       elif phase == 'ABORT':
         job.set_phase('ABORTED')
       self.sm.update_job(job = job)
+      if run: self.jm.queue_job(job.jobId)
     else:
       raise VOSpaceException(404, 'The specified transfer does not exist.')
 
@@ -385,58 +533,73 @@ class Mapper():
       return False
     return True
     
-  def _get_searches(self, args):
-    """
-    Get the list of searches
-    """
-    if 'results' in args:
-      xml = etree.parse('results.xml')
-      return etree.tostring(xml)
+  def _get_searches(self, args, kwargs):
+    """
+    Get the list of searches, a search or a page of its results
+    """
+    if len(args) == 0:
+      return self.jm.get_jobs(type = 'searches')
+    elif 'results' in args:
+      # Results are paged from the store as they are sent
+      limit = kwargs.get('limit')
+      results = self.search.get_results(args[0], start = kwargs.get('uri'), limit = limit is not None and int(limit) or None, detail = kwargs.get('detail', 'min'))
+      cherrypy.response.stream = True
+      return results
+    elif 'phase' in args:
+      return self._wait_job(args[0], kwargs, lambda: self.sm.get_phase(args[0])[0]['phase'])
     else:
-      job = self.sm.get_job(args[0])[0]['job']
-      return job
+      res = self.sm.get_job(args[0], type = 'searches')
+      if len(res) == 0: raise VOSpaceError(404, 'The specified search does not exist.')
+      return self._wait_job(args[0], kwargs, lambda: self.sm.get_job(args[0], type = 'searches')[0]['job'])
 
-  def _find_nodes(self, search):
+  def _get_changes(self, kwargs):
     """
-    Search for the specified nodes
+    Get the changes to nodes after a sequence number as lines of text, the
+    last holding the sequence number to ask for more from
     """
-    self.job = Job(search)
-    self.job.set_start_time(datetime.utcnow().isoformat())
-    self.job.set_phase('COMPLETED')
-    jobid = self._get_job_id()
-    self.job.set_job_id(jobid)
-    self.job.add_result('searchDetails', 'http://localhost:8000/searches/%s/results/listing1' % jobid)
-    self.job.set_end_time(datetime.utcnow().isoformat())
-    return jobid
+    since = None
+    try:
+      if 'since' in kwargs: since = int(kwargs['since'])
+      limit = int(kwargs.get('limit', CHANGES_LIMIT))
+      wait = float(kwargs.get('wait', 0))
+    except ValueError:
+      raise VOSpaceError(400, 'The since, limit and wait parameters must be numbers.', summary = INVALID_ARGUMENT)
+    prefix = kwargs.get('prefix')
+    if prefix is not None and not prefix.startswith('vos://'): prefix = ROOT_NODE + '/' + prefix.strip('/')
+    changes = self.changes.get_changes(since, prefix and prefix.rstrip('/'), limit, wait)
+    cherrypy.response.headers['Content-Type'] = 'text/plain'
+    cherrypy.response.stream = True
+    return changes
 
-  def _check_endpoint(self, uri):
+  def _track_body(self, body, sent):
     """
-    Check that the file endpoint is valid: it is unique and has not expired
+    Yield the response body, noting once all of it has been written
     """
-    result = self.sm.get_endpoint(uri)
-    if len(result) != 1: return False
-    if result[0]['completed'] is not None: return False
-    if (datetime.now() - result[0]['created']).seconds / 3600 > 0: return False
-    return True
+    for chunk in body:
+      yield chunk
+    sent.append(True)
 
-  def _get_location(self, endpoint):
-    """
-    Get the physical location corresponding to the transfer endpoint
-    """
-    result = self.sm.get_endpoint(endpoint)
-    jobid = result[0]['jobid']
-    job = self.sm.get_transfer(jobid)
-    transfer = Transfer(job.jobInfo)
-    location = self.sm.get_location(transfer.target)
-    return location[0]['location']
+  def _end_download(self, endpoint, sent):
+    """
+    Complete the transfer if the download sent the whole file, or the end
+    of it to a client resuming with a byte range
+    """
+    if not sent or cherrypy.request.method != 'GET': return
+    status = int(str(cherrypy.response.status).split()[0])
+    if status == 206:
+      match = re.match(r'bytes \d+-(\d+)/(\d+)$', cherrypy.response.headers.get('Content-Range', ''))
+      if match is None or int(match.group(1)) + 1 != int(match.group(2)): return
+    elif status != 200:
+      return
+    self._complete_transfer(endpoint)
 
-  def _complete_transfer(self, endpoint):
+  def _complete_transfer(self, endpoint, meta = None):
     """
-    Set the completion time on the transfer
+    Set the completion time on the transfer, record the details of any
+    uploaded bytes and signal the waiting job
     """
-    result = self.sm.get_endpoint(endpoint)
-    jobid = result[0]['jobid']
-    self.sm.complete_transfers(jobid)
+    self.tm.complete_endpoint(endpoint, meta)
+    if endpoint['jobid'] is not None: self.sm.after_commit(self.jm.signal_job, endpoint['jobid'])
 
   def _get_job_id(self):
     """
@@ -450,12 +613,6 @@ class Mapper():
     """
     return True
 
-  def _check_exists(self, args):
-    """
-    Check whether the specified node exists
-    """
-    return self.sm.already_exists('nodes', ROOT_NODE + '/' + '/'.join(args))    
-
 
 # Expose objects --------------------------------------------
 root = Mapper()
@@ -464,6 +621,7 @@ if __name__ == '__main__':
   cherrypy.config.update({'environment': 'production',
 			  'server.socket_host': '0.0.0.0',
 			  'server.socket_port': PORT,
+			  'server.thread_pool': THREAD_POOL,
                           'log.error_file': 'site.log',
                           'log.screen': True})
   conf = {"/": {"tools.staticdir.root": BASE_DIR},
@@ -474,6 +632,8 @@ if __name__ == '__main__':
           "/properties": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()},
           "/transfers": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()},
           "/searches": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()},
+          "/changes": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()},
+          "/scheduler": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()},
           "/nodes": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()},
           "/data": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()},
           "/sync": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()}
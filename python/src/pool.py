@@ -0,0 +1,238 @@
+#!/usr/bin/python -u
+# 2026/10/18
+# v0.1
+#
+# pool.py
+# Python code to handle pooled database connections
+
+from cache import LRUCache
+from config import STATEMENT_CACHE_SIZE
+import mysql.connector
+import Queue
+from threading import Lock, local
+
+# Errors after which a connection cannot be reused
+BROKEN = (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError)
+
+class Connection():
+  """
+  A database connection which keeps prepared statements for the query 
+  shapes most recently executed on it: queries with lists of values come
+  in many shapes so the least recently used statements are closed
+  """
+
+  def __init__(self, config, statements = STATEMENT_CACHE_SIZE):
+    self.cnx = mysql.connector.connect(**config)
+    self.cnx.autocommit = True
+    self.statements = LRUCache(statements, discard = self._close)
+
+  def _cursor(self, sql):
+    """
+    Get the prepared statement for the specified query
+    """
+    cursor = self.statements.get(sql)
+    if cursor is None:
+      cursor = self.cnx.cursor(buffered = False, prepared = True)
+      self.statements.put(sql, cursor)
+    return cursor
+
+  def _close(self, cursor):
+    """
+    Deallocate an evicted prepared statement on the server
+    """
+    try:
+      cursor.close()
+    except mysql.connector.Error:
+      pass
+
+  def _value(self, value):
+    """
+    Return text values as utf-8 encoded strings
+    """
+    if isinstance(value, unicode): return value.encode('utf-8')
+    if isinstance(value, bytearray): return str(value)
+    return value
+
+  def execute(self, sql, args = None):
+    """
+    Execute the specified query, returning any rows as dictionaries
+    """
+    cursor = self._cursor(sql)
+    cursor.execute(sql, args or ())
+    if cursor.description is None: return []
+    columns = cursor.column_names
+    return [dict(zip(columns, [self._value(x) for x in row])) for row in cursor.fetchall()]
+
+  def transaction(self, queries):
+    """
+    Execute the specified queries atomically, returning the rows for each
+    """
+    if len(queries) == 1: return [self.execute(*queries[0])]
+    self.cnx.start_transaction()
+    try:
+      results = [self.execute(sql, args) for sql, args in queries]
+      self.cnx.commit()
+    except:
+      self.cnx.rollback()
+      raise
+    return results
+
+  def close(self):
+    try:
+      self.cnx.close()
+    except mysql.connector.Error:
+      pass
+
+
+class ConnectionPool():
+  """
+  A bounded pool of database connections, optionally pinning each thread
+  to the connection it first acquires
+  """
+
+  def __init__(self, config, size, affinity = False):
+    self.config = config
+    self.size = size
+    self.affinity = affinity
+    self.created = 0
+    self.lock = Lock()
+    self.idle = Queue.LifoQueue()
+    self.local = local()
+
+  def acquire(self):
+    """
+    Get a connection, waiting for one to be released if the pool is full
+    """
+    cnx = self.affinity and getattr(self.local, 'cnx', None) or None
+    if cnx is not None: return cnx
+    while cnx is None:
+      try:
+        cnx = self.idle.get_nowait()
+      except Queue.Empty:
+        with self.lock:
+          create = self.created < self.size
+          if create: self.created += 1
+        if create:
+          cnx = self._connect()
+        else:
+          # Check again for free places left by discarded connections
+          try:
+            cnx = self.idle.get(timeout = 1)
+          except Queue.Empty:
+            pass
+    if self.affinity: self.local.cnx = cnx
+    return cnx
+
+  def _connect(self):
+    """
+    Open a new connection for a place already reserved in the pool
+    """
+    try:
+      return Connection(self.config)
+    except:
+      with self.lock:
+        self.created -= 1
+      raise
+
+  def release(self, cnx):
+    """
+    Return a connection to the pool unless it is pinned to this thread
+    """
+    if not self.affinity: self.idle.put(cnx)
+
+  def discard(self, cnx):
+    """
+    Close a broken connection and free its place in the pool
+    """
+    cnx.close()
+    if self.affinity: self.local.cnx = None
+    with self.lock:
+      self.created -= 1
+
+  def execute(self, queries):
+    """
+    Execute the specified queries atomically on a pooled connection,
+    returning the rows for each
+    """
+    if getattr(self.local, 'active', False):
+      work = self.local.work or self._start()
+      return [work.execute(sql, args) for sql, args in queries]
+    cnx = self.acquire()
+    try:
+      results = cnx.transaction(queries)
+    except BROKEN:
+      self.discard(cnx)
+      raise
+    except:
+      self.release(cnx)
+      raise
+    self.release(cnx)
+    return results
+
+  def begin(self):
+    """
+    Start a unit of work: queries from this thread share a single 
+    transaction until it is committed or rolled back
+    """
+    if getattr(self.local, 'active', False): raise RuntimeError('A unit of work is already in progress')
+    self.local.active = True
+    self.local.work = None
+    self.local.hooks = []
+
+  def _start(self):
+    """
+    Open the transaction for the current unit of work on its first query
+    """
+    cnx = self.acquire()
+    try:
+      cnx.cnx.start_transaction()
+    except BROKEN:
+      self.discard(cnx)
+      raise
+    self.local.work = cnx
+    return cnx
+
+  def after_commit(self, func, *args):
+    """
+    Call the function once the current unit of work commits, or now if 
+    there is none
+    """
+    if not getattr(self.local, 'active', False):
+      func(*args)
+    else:
+      self.local.hooks.append((func, args))
+
+  def commit(self):
+    """
+    Commit the current unit of work and run its deferred calls
+    """
+    cnx, hooks = self._end()
+    if cnx is not None:
+      try:
+        cnx.cnx.commit()
+      except:
+        self._rollback(cnx)
+        raise
+      self.release(cnx)
+    for func, args in hooks:
+      func(*args)
+
+  def rollback(self):
+    """
+    Discard the current unit of work and its deferred calls
+    """
+    cnx, hooks = self._end()
+    if cnx is not None: self._rollback(cnx)
+
+  def _end(self):
+    cnx, hooks = getattr(self.local, 'work', None), getattr(self.local, 'hooks', [])
+    self.local.active, self.local.work, self.local.hooks = False, None, []
+    return cnx, hooks
+
+  def _rollback(self, cnx):
+    try:
+      cnx.cnx.rollback()
+    except mysql.connector.Error:
+      self.discard(cnx)
+      return
+    self.release(cnx)
@@ -7,59 +7,121 @@
 
 import cgi
 import cherrypy
+from cherrypy.lib.static import serve_file
+import hashlib
+import mimetypes
 import os
 import pycurl
-import shutil
 import sys
 import tempfile
+import urllib
 import uuid
 
+# Temporary files are created 0600: stored files get the mode the umask gives
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 class HttpHandler():
   
-  def __init__(self, base_url, data_dir):
+  def __init__(self, base_url, data_dir, buffer_size = 1048576):
     self.LOCATION_ENDPOINT = base_url
     self.DATA_DIR = data_dir
+    self.BUFFER_SIZE = buffer_size
 
-  def get_endpoint(self):
+  def get_endpoint(self, token = None):
     """
-    Get a valid transfer endpoint 
+    Get a valid transfer endpoint, with a new token unless one is specified
     """
-    return self.LOCATION_ENDPOINT + "/" + uuid.uuid4().hex
+    return self.LOCATION_ENDPOINT + "/" + (token or uuid.uuid4().hex)
 
   def manage_file(self, location, request):
     """
-    Write the uploaded file (from the HTTP request) to disk
+    Write the uploaded file (from the HTTP request) to disk and return the
+    MD5, SHA-256, length and location of the stored bytes
     """
-    location = open(location, 'w')
     try:
       cherrypy.response.timeout = 3600
       lcHDRS = {}
-      for key, val in cherrypy.request.headers.iteritems():
+      for key, val in request.headers.iteritems():
         lcHDRS[key.lower()] = val
-      formFields = cgi.FieldStorage(fp=cherrypy.request.rfile,
-                                    headers=lcHDRS,
-                                    environ={'REQUEST_METHOD':'PUT'},
-                                    keep_blank_values=True)
-      location.write(formFields.file.read())
-      location.close()
+      if lcHDRS.get('content-type', '').startswith('multipart/'):
+        formFields = cgi.FieldStorage(fp=request.rfile,
+                                      headers=lcHDRS,
+                                      environ={'REQUEST_METHOD':'PUT'},
+                                      keep_blank_values=True)
+        meta = self._store_stream(formFields.file, location)
+      else:
+        # Raw body: copy straight from the socket
+        length = lcHDRS.get('content-length')
+        meta = self._store_stream(request.rfile, location, length = length and int(length) or None)
     except Exception, e:
       print "HttpHandler:", e
-      return False
-    return True
+      return None
+    return meta
+
+  def _store_stream(self, source, location, length = None):
+    """
+    Copy the stream to the specified location in fixed-size chunks via a 
+    temporary file in the target directory which is then renamed into place
+    """
+    fp = tempfile.NamedTemporaryFile(dir = os.path.dirname(location), delete = False)
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    total = 0
+    try:
+      remaining = length
+      while remaining is None or remaining > 0:
+        size = remaining is None and self.BUFFER_SIZE or min(self.BUFFER_SIZE, remaining)
+        chunk = source.read(size)
+        if not chunk: break
+        md5.update(chunk)
+        sha256.update(chunk)
+        fp.write(chunk)
+        total += len(chunk)
+        if remaining is not None: remaining -= len(chunk)
+      fp.close()
+      if remaining: raise IOError("Upload truncated: %s bytes missing" % remaining)
+      self._move_into_place(fp.name, location)
+    except:
+      fp.close()
+      os.remove(fp.name)
+      raise
+    return {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(), 'length': total, 'location': location}
+
+  def _move_into_place(self, path, location):
+    """
+    Rename the temporary file to the specified location with the mode a 
+    newly created file would have
+    """
+    os.chmod(path, 0666 & ~UMASK)
+    os.rename(path, location)
 
   def load_data(self, endpoint, location):
     """
-    Download the specified file and save to the specified location
+    Download the specified file and save to the specified location,
+    returning the MD5, SHA-256, length and location of the stored bytes
     """
-    fp = tempfile.NamedTemporaryFile(delete = False)
-    curl = pycurl.Curl()
-    curl.setopt(pycurl.URL, endpoint)
-    curl.setopt(pycurl.WRITEFUNCTION, fp.write)
-    curl.perform()
-    curl.close()
-    fp.close()
-    shutil.move(fp.name, location)
-    return True
+    fp = tempfile.NamedTemporaryFile(dir = os.path.dirname(location), delete = False)
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    def write(data):
+      md5.update(data)
+      sha256.update(data)
+      fp.write(data)
+    try:
+      curl = pycurl.Curl()
+      curl.setopt(pycurl.URL, endpoint)
+      curl.setopt(pycurl.WRITEFUNCTION, write)
+      try:
+        curl.perform()
+      finally:
+        curl.close()
+      length = fp.tell()
+      fp.close()
+      self._move_into_place(fp.name, location)
+    except:
+      fp.close()
+      os.remove(fp.name)
+      raise
+    return {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(), 'length': length, 'location': location}
       
   def send_data(self, endpoint, location):
     """
@@ -74,3 +136,52 @@ class HttpHandler():
     curl.perform()
     curl.close()
     return True
+
+
+class FileSender():
+  """
+  Send file contents from within the service, streaming them rather than
+  reading the whole file into memory
+  """
+
+  def send(self, location):
+    cherrypy.response.stream = True
+    return serve_file(location)
+
+
+class SendfileSender(FileSender):
+  """
+  Delegate sending file contents to a front-end server that honours the
+  X-Sendfile header (Apache mod_xsendfile, lighttpd): the service only
+  authorizes the request and the front-end sends the bytes, including
+  byte ranges
+  """
+
+  HEADER = 'X-Sendfile'
+
+  def send(self, location):
+    if not os.path.isfile(location): raise cherrypy.NotFound()
+    cherrypy.response.headers[self.HEADER] = self._path(location)
+    cherrypy.response.headers['Content-Type'] = mimetypes.guess_type(location)[0] or 'application/octet-stream'
+    return ''
+
+  def _path(self, location):
+    return location
+
+
+class AccelRedirectSender(SendfileSender):
+  """
+  Delegate sending file contents to nginx with the X-Accel-Redirect header:
+  the data directory must be served by nginx as the internal location with
+  the specified prefix
+  """
+
+  HEADER = 'X-Accel-Redirect'
+
+  def __init__(self, data_dir, prefix):
+    self.DATA_DIR = data_dir.rstrip('/')
+    self.PREFIX = prefix.rstrip('/')
+
+  def _path(self, location):
+    if not location.startswith(self.DATA_DIR + '/'): raise cherrypy.HTTPError(500, 'The location is outside the data directory.')
+    return self.PREFIX + urllib.quote(location[len(self.DATA_DIR):])
@@ -5,6 +5,10 @@
 # uws.py
 # Python code to handle resource representations
 
+from itertools import islice
+import re
+
+from cache import LRUCache
 from config import *
 
 try:
@@ -40,23 +44,160 @@ def toBoolean(val):
 
   return not str(val).strip().lower() in falseItems
 
+# ----------------------------------------------------------
+# Representations are written straight out from fixed templates rather than
+# built up as element trees: the bytes are the same as lxml would serialize
+
+XMLNS_NODE = ' xmlns:xsi="%s" xmlns="%s" xmlns:vos="%s"' % (XSI_NS, VOSPACE_NS, VOSPACE_NS)
+XMLNS_UWS = ' xmlns:uws="%s" xmlns:xlink="%s" xmlns:xsi="%s"' % (UWS_NS, XLINK_NS, XSI_NS)
+XMLNS_VOS = ' xmlns:vos="%s"' % VOSPACE_NS
+JOB_START = '<uws:job%s xsi:schemaLocation="%s UWS.xsd ">\n  ' % (XMLNS_UWS, UWS_NS)
+JOBS_START = '<uws:jobs%s xsi:schemaLocation="%s UWS.xsd ">\n' % (XMLNS_UWS, UWS_NS)
+JOB_INFO = '<uws:jobInfo%s/>' % XMLNS_UWS
+TRANSFER_START = '<vos:transfer%s>\n  ' % XMLNS_VOS
+NIL = ' xsi:nil="true"'
+
+XML_INCOMPATIBLE = 'All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters'
+# NUL is checked for separately: it joins values which are escaped together
+INCOMPATIBLE_BYTES = re.compile(r'[\x01-\x08\x0b\x0c\x0e-\x1f\x80-\xff]')
+INCOMPATIBLE_CHARS = re.compile(u'[\x01-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff]')
+TEXT = (re.compile(r'[&<>\r\x01-\x08\x0b\x0c\x0e-\x1f\x80-\xff]'), [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('\r', '&#13;')])
+ATTRIBUTE = (re.compile(r'[&<>"\n\r\t\x01-\x08\x0b\x0c\x0e-\x1f\x80-\xff]'), [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ('\n', '&#10;'), ('\r', '&#13;'), ('\t', '&#9;')])
+
+JOB_INFOS = LRUCache(JOB_INFO_CACHE_SIZE)
+
+def _escape(value, kind):
+  """
+  Escape the specified string as text or attribute value, rejecting what
+  lxml would not accept
+  """
+  special, entities = kind
+  if isinstance(value, str):
+    if not special.search(value): return value
+    if INCOMPATIBLE_BYTES.search(value): raise ValueError(XML_INCOMPATIBLE)
+  elif isinstance(value, unicode):
+    if INCOMPATIBLE_CHARS.search(value): raise ValueError(XML_INCOMPATIBLE)
+  else:
+    raise TypeError("Argument must be bytes or unicode, got '%s'" % type(value).__name__)
+  for char, entity in entities:
+    value = value.replace(char, entity)
+  if isinstance(value, unicode): value = value.encode('ascii', 'xmlcharrefreplace')
+  return value
+
+def _escape_all(values, escape, kind):
+  """
+  Escape the specified values in one go, joined by NUL, unless one of them
+  is not a string or already holds NUL
+  """
+  try:
+    joined = '\x00'.join(values)
+  except (TypeError, UnicodeDecodeError):
+    return [escape(value) for value in values]
+  if joined.count('\x00') != len(values) - 1: return [escape(value) for value in values]
+  return _escape(joined, kind).split('\x00')
+
+def escape_text(value):
+  """
+  Escape the specified value as element content: None is no content
+  """
+  if value is None: return None
+  value = _escape(value, TEXT)
+  if '\x00' in value: raise ValueError(XML_INCOMPATIBLE)
+  return value
+
+def escape_attribute(value):
+  """
+  Escape the specified value as an attribute value
+  """
+  value = _escape(value, ATTRIBUTE)
+  if '\x00' in value: raise ValueError(XML_INCOMPATIBLE)
+  return value
+
+def element(tag, content = None, attributes = ''):
+  """
+  Write an element around the specified escaped content, or an empty one
+  """
+  if content is None: return '<%s%s/>' % (tag, attributes)
+  return '<%s%s>%s</%s>' % (tag, attributes, content, tag)
+
+def elements(tag, key, values, collapse = False):
+  """
+  Write an element for each entry of the specified dictionary, with the
+  entry key as the named attribute and its value as content; empty values
+  are written as empty elements if collapse is set
+  """
+  names = _escape_all(values.keys(), escape_attribute, ATTRIBUTE)
+  contents = _escape_all(values.values(), escape_text, TEXT)
+  start, end = '<%s %s="' % (tag, key), '</%s>' % tag
+  written = []
+  for name, content in zip(names, contents):
+    if content is None or (collapse and content == ''):
+      written.append('%s%s"/>' % (start, name))
+    else:
+      written.append('%s%s">%s%s' % (start, name, content, end))
+  return ''.join(written)
+
+def references(tag, uris):
+  """
+  Write an empty element for each of the specified URIs
+  """
+  if not uris: return ''
+  start = '<%s uri="' % tag
+  return start + ('"/>' + start).join(_escape_all(uris, escape_attribute, ATTRIBUTE)) + '"/>'
+
+def pages(items, size = LISTING_PAGE_SIZE):
+  """
+  Split the specified items into lists of up to the page size
+  """
+  items = iter(items)
+  page = list(islice(items, size))
+  while len(page) > 0:
+    yield page
+    page = list(islice(items, size))
+
+def _job_info(xml):
+  """
+  Get the job details as they appear inside a job: namespace declarations
+  which the job already makes are dropped, so the details are normalized
+  through lxml once and remembered
+  """
+  fragment = JOB_INFOS.get(xml)
+  if fragment is None:
+    info = etree.fromstring(JOB_INFO)
+    info.append(etree.fromstring(xml))
+    fragment = etree.tostring(info)[len(JOB_INFO) - 1:-len('</uws:jobInfo>')]
+    JOB_INFOS.put(xml, fragment)
+  return fragment
+
+def _time(tag, value):
+  """
+  Write a time element, which is nil until the time is set
+  """
+  if value == '' or value is None: return element(tag, None, NIL)
+  return element(tag, escape_text(value))
+
+def write_job(job):
+  """
+  Write the XML representation of the specified job
+  """
+  content = [element('uws:jobId', escape_text(job.jobId)),
+    element('uws:ownerId', escape_text(job.ownerId), NIL),
+    element('uws:phase', escape_text(job.phase)),
+    _time('uws:startTime', job.startTime),
+    _time('uws:endTime', job.endTime),
+    element('uws:executionDuration', escape_text(str(job.executionDuration))),
+    element('uws:destruction', None, NIL),
+    element('uws:parameters', elements('uws:parameter', 'id', job.parameters) or None),
+    element('uws:results', ''.join(['<uws:result id="%s" xlink:href="%s"/>' % (escape_attribute(id), escape_attribute(href)) for id, href in job.results.items()]) or None)]
+  if job.errorSummary != '':
+    content.append(element('uws:errorSummary', element('uws:message', escape_text(job.errorSummary)), ' type="transient" hasDetail="true"'))
+  if job.jobInfo != '':
+    content.append(element('uws:jobInfo', _job_info(job.jobInfo)))
+  return JOB_START + '\n  '.join(content) + (job.jobInfo != '' and '\n' or '\n  ') + '</uws:job>'
+
 # ----------------------------------------------------------
 class Job():
 
-  blankJob = '''<uws:job xsi:schemaLocation="http://www.ivoa.net/xml/UWS/v1.0 UWS.xsd " xmlns:xml="http://www.w3.org/XML/1998/namespace" xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-  <uws:jobId/>
-  <uws:ownerId xsi:nil="true"/>
-  <uws:phase/>
-  <uws:startTime xsi:nil="true"/>
-  <uws:endTime xsi:nil="true"/>
-  <uws:executionDuration/>
-  <uws:destruction xsi:nil="true"/>
-  <uws:parameters/>
-  <uws:results/>
-  <uws:errorSummary type="transient" hasDetail="true"/>
-  <uws:jobInfo/>
-</uws:job>'''
-  
   def __init__(self, job = None):
     """
     Create a new Job or one around the specified Element.
@@ -65,6 +206,7 @@ class Job():
     self.results = {}
     self.errorSummary = ''
     self.jobInfo = ''
+    self.checkpoint = None
     if job == None:
       self.jobId = ''
       self.ownerId = ''
@@ -99,41 +241,7 @@ class Job():
     """
     Get a string representation of the Job
     """
-    job = etree.fromstring(self.blankJob)
-    job.find('{%s}jobId' % UWS_NS).text = self.jobId
-    job.find('{%s}ownerId' % UWS_NS).text = self.ownerId
-    job.find('{%s}phase' % UWS_NS).text = self.phase
-    startTime = job.find('{%s}startTime' % UWS_NS)
-    if self.startTime != '' and self.startTime != None:
-      startTime.text = self.startTime
-      del startTime.attrib['{%s}nil' % XSI_NS]
-    endTime = job.find('{%s}endTime' % UWS_NS)
-    if self.endTime != '' and self.endTime != None:
-      endTime.text = self.endTime
-      del endTime.attrib['{%s}nil' % XSI_NS]
-    job.find('{%s}executionDuration' % UWS_NS).text = str(self.executionDuration)
-    parameters = job.find('{%s}parameters' % UWS_NS)
-    for params in self.parameters:
-      param = etree.SubElement(parameters, '{%s}parameter' % UWS_NS)
-      param.set('id', params)
-      param.text = self.parameters[params]
-    results = job.find('{%s}results' % UWS_NS)
-    for res in self.results:
-      result = etree.SubElement(results, '{%s}result' % UWS_NS)
-      result.set('id', res)
-      result.set('{%s}href' % XLINK_NS, self.results[res])
-    errorSummary = job.find('{%s}errorSummary' % UWS_NS)
-    if self.errorSummary != '':
-      message = etree.SubElement(errorSummary, '{%s}message' % UWS_NS)
-      message.text = self.errorSummary
-    else:
-      job.remove(errorSummary)
-    jobInfo = job.find('{%s}jobInfo' % UWS_NS)
-    if self.jobInfo != '':
-      jobInfo.append(etree.fromstring(self.jobInfo)) 
-    else:
-      job.remove(jobInfo)
-    return etree.tostring(job)
+    return write_job(self)
 
   def set_job_id(self, jobid):
     self.jobId = jobid
@@ -157,7 +265,7 @@ class Job():
     self.parameters = parameters  
   
   def add_parameter(self, parameter, value):
-    self.parameter[parameter] = value
+    self.parameters[parameter] = value
 
   def set_results(self, results):
     self.results = results  
@@ -185,9 +293,6 @@ class Job():
 # ----------------------------------------------------------
 class JobList():
 
-  blankJobs = '''<uws:jobs xsi:schemaLocation="http://www.ivoa.net/xml/UWS/v1.0 UWS.xsd " xmlns:xml="http://www.w3.org/XML/1998/namespace" xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-</uws:jobs>'''
-  
   def __init__(self, job = None):
     """
     Create a new Job or one around the specified Element.
@@ -204,20 +309,17 @@ class JobList():
     """
     Return a string representation of the JobList
     """
-    joblist = etree.fromstring(self.blankJobs)
-    for job in self.jobs:
-      jobref = etree.SubElement(joblist, 'jobref')
-      jobref.set('id', job)
-      phase = etree.SubElement(jobref, 'phase')
-      phase.text = self.jobs[job]
-    return etree.tostring(joblist)
+    jobrefs = ['<jobref id="%s">%s</jobref>' % (escape_attribute(job), element('phase', escape_text(phase))) for job, phase in self.jobs.items()]
+    return JOBS_START + ''.join(jobrefs) + '</uws:jobs>'
 
 # ----------------------------------------------------------
 class NodeFactory():
 
   def get_node(self, xml):
     if isinstance(xml, str): xml = etree.fromstring(xml)
-    type = xml.get('{%s}type' % XSI_NS)
+    return self.new_node(xml.get('{%s}type' % XSI_NS), xml)
+
+  def new_node(self, type, xml = None):
     if type == 'vos:Node' or type == None:
       return Node(node = xml)
     elif type == 'vos:DataNode':
@@ -236,11 +338,6 @@ class NodeFactory():
 # ----------------------------------------------------------
 class Node():
 
-  blankNode = '''<node xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-  xmlns="%s" 
-  xmlns:vos="%s"
-  xsi:type="" uri="" />''' % (VOSPACE_NS, VOSPACE_NS)
-
   TYPE = 'vos:Node'
   
   def __init__(self, node = None):
@@ -266,11 +363,11 @@ class Node():
           self.capabilities.append(capability.get('uri'))
 
   def tostring(self, detail = 'max'):
-    node = etree.fromstring(self.blankNode)
-    self.print_node(node)
-    if detail != 'min': self.print_properties(node)
-    if detail == 'max': self.print_capabilities(node)
-    return etree.tostring(node)
+    attributes = self.print_node()
+    content = []
+    if detail != 'min': content.append(self.print_properties())
+    if detail == 'max': content.append(self.print_capabilities())
+    return element('node', ''.join(content) or None, attributes)
 
   def set_uri(self, uri):
     self.uri = uri
@@ -287,26 +384,14 @@ class Node():
   def clear_capabilities(self):
     self.capabilities = []
 
-  def print_node(self, node):
-    node.set('uri', self.uri)
-    node.set('{%s}type' % XSI_NS, self.TYPE)
-
-  def print_properties(self, node):
-    properties = node.find('{%s}properties' % VOSPACE_NS)
-    if properties is None:
-      properties = etree.SubElement(node, '{%s}properties' % VOSPACE_NS)
-    for property in self.properties:
-      prop = etree.SubElement(properties, '{%s}property' % VOSPACE_NS)
-      prop.set('uri', property)
-      prop.text = self.properties[property]
-
-  def print_capabilities(self, node):
-    capabilities = node.find('{%s}capabilities' % VOSPACE_NS)
-    if capabilities is None:
-      capabilities = etree.SubElement(node, '{%s}capabilities' % VOSPACE_NS)
-    for capability in self.capabilities:
-      view = etree.SubElement(capabilities, '{%s}capability' % VOSPACE_NS)
-      view.set('uri', capability)
+  def print_node(self):
+    return '%s xsi:type="%s" uri="%s"' % (XMLNS_NODE, self.TYPE, escape_attribute(self.uri))
+
+  def print_properties(self):
+    return element('properties', elements('property', 'uri', self.properties) or None)
+
+  def print_capabilities(self):
+    return element('capabilities', references('capability', self.capabilities) or None)
 
 # ----------------------------------------------------------
 class DataNode(Node):
@@ -334,18 +419,10 @@ class DataNode(Node):
       self.busy = toBoolean(node.get('busy'))
 
   def tostring(self, detail = 'max'):
-    node = etree.fromstring(self.blankNode)
-    self.print_node(node)
-    if detail != 'min': self.print_properties(node)
-    if detail == 'max':
-      if self.busy:  
-        node.set('busy', 'true')
-      else:
-        node.set('busy', 'false')
-      self.print_accepts(node)
-      self.print_provides(node)
-      self.print_capabilities(node)
-    return etree.tostring(node)
+    if detail != 'max': return Node.tostring(self, detail)
+    attributes = self.print_node() + self.print_busy()
+    content = [self.print_properties(), self.print_accepts(), self.print_provides(), self.print_capabilities()]
+    return element('node', ''.join(content), attributes)
 
   def add_accepts(self, uri):
     self.accepts.append(uri)
@@ -362,21 +439,15 @@ class DataNode(Node):
   def set_busy(self, busy):
     self.busy = busy
 
-  def print_accepts(self, node):
-    accepts = node.find('{%s}accepts' % VOSPACE_NS)
-    if accepts is None:
-      accepts = etree.SubElement(node, '{%s}accepts' % VOSPACE_NS)
-    for accept in self.accepts:
-      view = etree.SubElement(accepts, '{%s}view' % VOSPACE_NS)
-      view.set('uri', accept)
-
-  def print_provides(self, node):
-    provides = node.find('{%s}provides' % VOSPACE_NS)
-    if provides is None:
-      provides = etree.SubElement(node, '{%s}provides' % VOSPACE_NS)
-    for provide in self.provides:
-      view = etree.SubElement(provides, '{%s}view' % VOSPACE_NS)
-      view.set('uri', provide)
+  def print_busy(self):
+    if self.busy: return ' busy="true"'
+    return ' busy="false"'
+
+  def print_accepts(self):
+    return element('accepts', references('view', self.accepts) or None)
+
+  def print_provides(self):
+    return element('provides', references('view', self.provides) or None)
 
 # ----------------------------------------------------------
 class ContainerNode(DataNode):
@@ -399,19 +470,27 @@ class ContainerNode(DataNode):
         raise VOSpaceError(400, "There is no nodes element.", summary = MISSING_PARAMETER)
 
   def tostring(self, detail = 'max'):
-    node = etree.fromstring(self.blankNode)
-    self.print_node(node)
-    if detail != 'min': self.print_properties(node)
-    if detail == 'max':
-      if self.busy:  
-        node.set('busy', 'true')
-      else:
-        node.set('busy', 'false')
-      self.print_accepts(node)
-      self.print_provides(node)
-      self.print_capabilities(node)
-      self.print_nodes(node)
-    return etree.tostring(node)
+    if detail != 'max': return Node.tostring(self, detail)
+    attributes = self.print_node() + self.print_busy()
+    content = [self.print_properties(), self.print_accepts(), self.print_provides(), self.print_capabilities(), self.print_nodes()]
+    return element('node', ''.join(content), attributes)
+
+  def iterstring(self, children):
+    """
+    Write the node with the specified child URIs as a sequence of strings:
+    the children are read and written a page at a time
+    """
+    attributes = self.print_node() + self.print_busy()
+    content = ''.join([self.print_properties(), self.print_accepts(), self.print_provides(), self.print_capabilities()])
+    children = pages(children)
+    first = next(children, None)
+    if first is None:
+      yield element('node', content + element('nodes'), attributes)
+      return
+    yield '<node%s>%s<nodes>%s' % (attributes, content, references('node', first))
+    for page in children:
+      yield references('node', page)
+    yield '</nodes></node>'
 
   def add_node(self, uri):
     self.nodes.append(uri)
@@ -419,13 +498,8 @@ class ContainerNode(DataNode):
   def clear_nodes(self):
     del self.nodes[:]
 
-  def print_nodes(self, root):
-    nodes = etree.SubElement(root, '{%s}nodes' % VOSPACE_NS)
-    if nodes is None:
-      nodes = etree.SubElement(node, '{%s}nodes' % VOSPACE_NS)
-    for child in self.nodes:
-      node = etree.SubElement(nodes, '{%s}node' % VOSPACE_NS)
-      node.set('uri', child)
+  def print_nodes(self):
+    return element('nodes', references('node', self.nodes) or None)
 
 # ----------------------------------------------------------
 class UnstructuredDataNode(DataNode):
@@ -456,14 +530,10 @@ class LinkNode(Node):
         raise VOSpaceError(400, "No target is specified.", summary = MISSING_PARAMETER)
 
   def tostring(self, detail = 'max'):
-    node = etree.fromstring(self.blankNode)
-    self.print_node(node)
-    if detail != 'min': self.print_properties(node)
-    if detail == 'max':
-      self.print_capabilities(node)
-      target = etree.SubElement(node, '{%s}target' % VOSPACE_NS)
-      target.text = self.target
-    return etree.tostring(node)
+    if detail != 'max': return Node.tostring(self, detail)
+    attributes = self.print_node()
+    content = [self.print_properties(), self.print_capabilities(), element('target', escape_text(self.target))]
+    return element('node', ''.join(content), attributes)
 
   def set_target(self, target):
     self.target = target
@@ -471,12 +541,6 @@ class LinkNode(Node):
 # ------------------------------------------------------------  
 class Transfer():
 
-  blankTransfer = '''<vos:transfer xmlns:vos = "%s">
-  <vos:target/>
-  <vos:direction/>
-  <vos:keepBytes/>
-  </vos:transfer>''' % VOSPACE_NS
-
   def __init__(self, transfer = None):
     """
     Creates a new Transfer or one around the specified element.
@@ -504,17 +568,12 @@ class Transfer():
         raise VOSpaceError(500, "One of the specified parameters is invalid.")
 
   def tostring(self):
-    transfer = etree.fromstring(self.blankTransfer)
-    target = transfer.find('{%s}target' % VOSPACE_NS)
-    target.text = self.target
-    direction = transfer.find('{%s}direction' % VOSPACE_NS)
-    direction.text = self.direction
-    transfer.insert(2, etree.fromstring(self.view.tostring()))
-    keepBytes = transfer.find('{%s}keepBytes' % VOSPACE_NS)
-    keepBytes.text = str(self.keepBytes)
-    for protocol in self.protocols:
-      transfer.append(etree.fromstring(protocol.tostring()))
-    return etree.tostring(transfer)
+    target = element('vos:target', escape_text(self.target))
+    direction = element('vos:direction', escape_text(self.direction))
+    keepBytes = element('vos:keepBytes', escape_text(str(self.keepBytes)))
+    # Empty parameter values in the view and protocols are written as empty elements
+    protocols = ''.join([protocol.print_protocol(collapse = True) for protocol in self.protocols])
+    return '%s%s\n  %s\n  %s%s\n  %s</vos:transfer>' % (TRANSFER_START, target, direction, self.view.print_view(collapse = True), keepBytes, protocols)
 
   def set_protocols(self, protocols):
     self.protocols = protocols
@@ -529,8 +588,6 @@ class Transfer():
 # ------------------------------------------------------------  
 class Protocol():
 
-  blankProtocol = '''<vos:protocol xmlns:vos="%s" uri=""/>''' % VOSPACE_NS
-
   def __init__(self, protocol = None):
     """
     Creates a new Protocol or one around the specified element.
@@ -557,22 +614,17 @@ class Protocol():
     self.endpoint = uri
 
   def tostring(self):
-    protocol = etree.fromstring(self.blankProtocol)
-    protocol.set('uri', self.uri)
-    if self.endpoint != "":
-      endpoint = etree.SubElement(protocol, '{%s}endpoint' % VOSPACE_NS)
-      endpoint.text = self.endpoint
-    for param in self.params:
-      par = etree.SubElement(protocol, '{%s}param' % VOSPACE_NS)
-      par.set('uri', param)
-      par.text = self.params[par]
-    return etree.tostring(protocol)
+    return self.print_protocol(XMLNS_VOS)
+
+  def print_protocol(self, xmlns = '', collapse = False):
+    content = []
+    if self.endpoint != "": content.append(element('vos:endpoint', escape_text(self.endpoint)))
+    content.append(elements('vos:param', 'uri', self.params, collapse))
+    return element('vos:protocol', ''.join(content) or None, '%s uri="%s"' % (xmlns, escape_attribute(self.uri)))
 
 # ------------------------------------------------------------  
 class View():
 
-  blankView = '''<vos:view xmlns:vos="%s" uri=""/>''' % VOSPACE_NS
-
   def __init__(self, view = None):
     """
     Creates a new View or one around the specified element.
@@ -600,11 +652,8 @@ class View():
     self.original = value
 
   def tostring(self):
-    view = etree.fromstring(self.blankView)
-    view.set('uri', self.uri)
-    view.set('original', str(self.original))
-    for param in self.params:
-      par = etree.SubElement(view, '{%s}param' % VOSPACE_NS)
-      par.set('uri', param)
-      par.text = self.params[param]
-    return etree.tostring(view)
+    return self.print_view(XMLNS_VOS)
+
+  def print_view(self, xmlns = '', collapse = False):
+    attributes = '%s uri="%s" original="%s"' % (xmlns, escape_attribute(self.uri), escape_attribute(str(self.original)))
+    return element('vos:view', elements('vos:param', 'uri', self.params, collapse) or None, attributes)
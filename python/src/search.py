@@ -0,0 +1,57 @@
+#!/usr/bin/python -u
+# 2026/10/18
+# v0.1
+#
+# search.py
+# Python code to parse VOSpace search queries
+#
+# A query is one or more terms joined by 'and', each comparing a property
+# with a value:
+#
+#   format = "application/fits" and date > "2020-01-01" and length >= 1e6
+#
+# Properties are property URIs or the names of core properties. Values are
+# quoted strings or bare words. Operators are = != < <= > >= and ^= which
+# matches values starting with the given prefix. Range comparisons with a
+# number compare numerically.
+
+import math
+import re
+
+CORE = 'ivo://ivoa.net/vospace/core#'
+
+TERM = re.compile(r'\s*([^\s=<>!^"]+)\s*(<=|>=|!=|\^=|=|<|>)\s*("(?:[^"\\]|\\.)*"|[^\s"]+)\s*')
+AND = re.compile(r'and\s+', re.I)
+
+def parse_query(text):
+  """
+  Parse the specified query into a list of (property, operator, value)
+  terms, raising ValueError if it is not valid
+  """
+  terms = []
+  pos = 0
+  text = text.strip()
+  while True:
+    match = TERM.match(text, pos)
+    if match is None: raise ValueError('The search query is not valid at position %d.' % pos)
+    property, operator, value = match.groups()
+    if value.startswith('"'): value = re.sub(r'\\(.)', r'\1', value[1:-1])
+    if ':' not in property: property = CORE + property
+    terms.append((property, operator, value))
+    pos = match.end()
+    if pos == len(text): return terms
+    match = AND.match(text, pos)
+    if match is None: raise ValueError('The search query is not valid at position %d.' % pos)
+    pos = match.end()
+
+def get_number(value):
+  """
+  Get the numeric value of the specified string, or None if it is not a
+  number
+  """
+  try:
+    number = float(value)
+  except (TypeError, ValueError):
+    return None
+  if math.isinf(number) or math.isnan(number): return None
+  return number
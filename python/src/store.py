@@ -5,158 +5,541 @@
 # store.py
 # Python code to handle persistant store transactions
 
-from config import CONFIG
-#import mysql.connector
-import PySQLPool
+from config import CONFIG, DATE, DB_AFFINITY, DB_POOL_SIZE, LENGTH, LISTING_PAGE_SIZE, MAX_WAITERS, MD5, QUOTA, ROOT_NODE, TRASH_LOCATION
+from pool import ConnectionPool
+from search import get_number
 from resources import *
+from threading import BoundedSemaphore, Condition
 
 class LocalStoreManager():
   """
   Class to handle interactions with a local database
   """
 
-  def __init__(self):
-    config = CONFIG.dbinfo().copy()
-    self.db = PySQLPool.getNewConnection(host = config['host'], user = config['user'], password = config['password'], schema = 'vospace')
+  ASIDE = 'deleted:' # Prefix of the identifiers given to deleted rows moved out of the way
 
-  def query(self, sqlQuery):
-    query = PySQLPool.getNewQuery(connection = self.db, commitOnEnd = True)
-    query.Query(sqlQuery)
-    return query.record
+  def __init__(self, size = DB_POOL_SIZE, affinity = DB_AFFINITY):
+    self.pool = ConnectionPool(CONFIG.dbinfo().copy(), size, affinity)
+    self.changes = Condition()
+    self.phases = Condition()
+    self.waiters = BoundedSemaphore(MAX_WAITERS)
+
+  def query(self, sqlQuery, args = None):
+    return self.pool.execute([[sqlQuery, args]])[0]
+
+  def transaction(self, queries):
+    return self.pool.execute(queries)
+
+  def begin(self):
+    self.pool.begin()
+
+  def commit(self):
+    self.pool.commit()
+
+  def rollback(self):
+    self.pool.rollback()
+
+  def after_commit(self, func, *args):
+    self.pool.after_commit(func, *args)
+
+  def _log_change(self, identifier, operation):
+    return ['insert into changes (identifier, operation, created) values (%s, %s, now())', (identifier, operation)]
+
+  def _notify_changes(self):
+    with self.changes:
+      self.changes.notify_all()
+
+  def _notify_phases(self):
+    with self.phases:
+      self.phases.notify_all()
+
+  def get_changes(self, since, limit):
+    query = '''select seq, identifier, operation, timestampdiff(second, created, now()) as age from changes where seq > %s order by seq limit %s'''
+    return self.query(query, (since, limit))
+
+  def get_change_range(self):
+    return self.query('select min(seq) as oldest, max(seq) as latest, timestampdiff(second, max(created), now()) as age from changes')[0]
+
+  def prune_changes(self, days):
+    self.query('delete from changes where created < now() - interval %s day', (days,))
+
+  def use_token(self, signature, expiry):
+    # A concurrent use waits on the row and then counts a second use
+    results = self.transaction([['insert into signed_tokens (signature, uses, expires) values (%s, 1, from_unixtime(%s)) on duplicate key update uses = uses + 1', (signature, expiry)],
+                                ['select uses from signed_tokens where signature = %s', (signature,)]])
+    return results[1][0]['uses'] == 1
+
+  def token_used(self, signature):
+    return len(self.query('select uses from signed_tokens where signature = %s and uses > 0', (signature,))) > 0
+
+  def prune_tokens(self):
+    self.query('delete from signed_tokens where expires < now()')
+
+  def _escape_like(self, value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+  def _like_prefix(self, uri):
+    return self._escape_like(uri) + '/%'
+
+  def _split(self, uri):
+    parent, name = uri.rsplit('/', 1)
+    depth = uri[len(ROOT_NODE):].count('/')
+    return parent, name, depth
+
+  def _graves(self, identifiers):
+    # The highest node id deleted at each of the identifiers and their ancestors
+    paths = set()
+    for identifier in identifiers:
+      if identifier.startswith(ROOT_NODE + '/'): paths.update([identifier] + self._ancestors(identifier))
+    if len(paths) == 0: return {}
+    query = 'select identifier, max(maxid) as maxid from tombstones where identifier in (%s) group by identifier' % ', '.join(['%s'] * len(paths))
+    return dict([(row['identifier'], row['maxid']) for row in self.query(query, tuple(paths))])
+
+  def _buried(self, uri):
+    return len(self._graves([uri])) > 0
+
+  def _dead(self, uri, id, graves):
+    path = uri
+    while graves and len(path) > len(ROOT_NODE):
+      if id <= graves.get(path, 0): return True
+      path = path[:path.rfind('/')]
+    return False
+
+  def _live(self, uri, rows):
+    if len(rows) == 0: return rows
+    graves = self._graves([row.get('identifier', uri) for row in rows])
+    return [row for row in rows if not self._dead(row.get('identifier', uri), row['id'], graves)]
+
+  def _set_aside(self, uri, id, detach = False):
+    aside = '%s%d' % (self.ASIDE, id)
+    query = detach and 'update nodes set parent_id = null, identifier = %s, name = %s where id = %s' or 'update nodes set identifier = %s, name = %s where id = %s'
+    return [['update properties set identifier = %s where identifier = %s', (aside, uri)],
+            [query, (aside, aside, id)]]
+
+  def get_node_id(self, uri):
+    rows = self._live(uri, self.query('select id from nodes where identifier = %s', (uri,)))
+    return len(rows) > 0 and rows[0]['id'] or None
 
   def get_properties(self):
     query = 'select distinct property from properties'
     return self.query(query)
 
-  def create_node(self, node, identifier, type, view = None, status = None, owner = None, location = None):
+  def create_node(self, identifier, type, view = None, status = None, owner = None, location = None, parent_id = None, properties = None, target = None):
     view = (view == None) and '' or view
-    status = (status == None) and '' or status
+    status = (status == None) and 0 or status
     owner = (owner == None) and '' or owner
     location = (location == None) and '' or location
-    query = '''insert into nodes (identifier, type, view, status, owner, location, creationDate, node) values('%s', %s, '%s', '%s', '%s', '%s', now(), '%s')''' % (identifier, type, view, status, owner, location, node)
-    self.query(query)
+    parent, name, depth = self._split(identifier)
+    parent_id = (parent_id == None) and self.get_node_id(parent) or parent_id
+    # The parent is read with a lock: a concurrent delete of it either waits
+    # and counts the node as deleted too or has already detached the parent
+    if parent_id is not None and len(self.query('select id from nodes where id = %s and identifier = %s lock in share mode', (parent_id, parent))) == 0: return False
+    queries = []
+    # Deleted rows awaiting reclamation give up their identifier
+    graves = self._graves([identifier])
+    if graves:
+      for row in self.query('select id from nodes where identifier = %s', (identifier,)):
+        if self._dead(identifier, row['id'], graves): queries.extend(self._set_aside(identifier, row['id']))
+    query = '''insert into nodes (parent_id, name, depth, identifier, type, view, status, owner, location, target, creationDate) values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, now())'''
+    queries.append([query, (parent_id, name, depth, identifier, type, view, status, owner, location, target)])
+    if properties: queries.append(self._set_properties(identifier, properties))
+    queries.append(self._add_usage(identifier, 0, 1))
+    if properties and QUOTA in properties:
+      queries.append(['insert into usages (identifier, bytes, files, quota) values (%s, 0, 0, %s) on duplicate key update quota = values(quota)', (identifier, int(properties[QUOTA]))])
+    queries.append(self._log_change(identifier, 'create'))
+    self.transaction(queries)
+    self.after_commit(self._notify_changes)
+    return True
+
+  def _ancestors(self, uri):
+    paths = []
+    while len(uri) > len(ROOT_NODE):
+      uri = uri[:uri.rfind('/')]
+      paths.append(uri)
+    return paths
+
+  def _add_usage(self, uri, bytes, files):
+    paths = self._ancestors(uri)
+    query = 'insert into usages (identifier, bytes, files) values ' + ', '.join(['(%s, %s, %s)'] * len(paths)) + ' on duplicate key update bytes = bytes + values(bytes), files = files + values(files)'
+    args = []
+    for path in paths:
+      args.extend([path, bytes, files])
+    return [query, tuple(args)]
+
+  def get_size(self, uri):
+    query = '''select (select bytes from usages where identifier = %s) as bytes, (select files from usages where identifier = %s) as files,
+               (select value from properties where identifier = %s and property = %s limit 1) as length'''
+    row = self.query(query, (uri, uri, uri, LENGTH))[0]
+    bytes = row['bytes'] is not None and row['bytes'] or int(row['length'] or 0)
+    return {'bytes': bytes, 'files': row['files'] or 0}
+
+  def get_usage(self, uri):
+    paths = [uri] + self._ancestors(uri)
+    query = '''select identifier, bytes, files, quota from usages where identifier in (%s)''' % ', '.join(['%s'] * len(paths))
+    return self.query(query, tuple(paths))
 
   def get_node(self, uri):
-    query = '''select node from nodes where identifier = "%s"''' % uri
-    return self.query(query)
+    query = '''select n.id, n.identifier, n.type, n.target, n.version, p.property, p.value from nodes n left join properties p on p.identifier = n.identifier where n.identifier = %s'''
+    rows = self._live(uri, self.query(query, (uri,)))
+    if len(rows) == 0: return []
+    node = dict([(x, rows[0][x]) for x in ['id', 'identifier', 'type', 'target', 'version']])
+    node['properties'] = dict([(row['property'], row['value']) for row in rows if row['property'] is not None])
+    return [node]
+
+  def get_node_properties(self, identifiers):
+    properties = dict([(x, {}) for x in identifiers])
+    if len(identifiers) == 0: return properties
+    query = '''select identifier, property, value from properties where identifier in (%s)''' % ', '.join(['%s'] * len(identifiers))
+    for row in self.query(query, tuple(identifiers)):
+      properties[row['identifier']][row['property']] = row['value']
+    return properties
 
   def delete_node(self, uri):
-    query = 'delete from nodes where identifier like "%s%%"' % uri
-    self.query(query) 
-    query = 'delete from properties where identifier like "%s%%"' % uri
-    self.query(query)
+    # Locking reads: a concurrent create beneath the node has either
+    # committed, and is counted as deleted, or waits and fails
+    rows = self._live(uri, self.query('select id, location from nodes where identifier = %s for update', (uri,)))
+    if len(rows) == 0: return None
+    id = rows[0]['id']
+    maxid = self.query('select id from nodes order by id desc limit 1 lock in share mode')[0]['id']
+    trash = '%s/%d' % (TRASH_LOCATION, id)
+    size = self.get_size(uri)
+    # Only the root row changes: it is detached and its identifier freed
+    queries = self._set_aside(uri, id, detach = True)
+    queries.append(['insert into tombstones (identifier, rootid, maxid, location, created) values (%s, %s, %s, %s, now())', (uri, id, maxid, trash)])
+    queries.append(self._add_usage(uri, -size['bytes'], -size['files'] - 1))
+    queries.append(['delete from usages where identifier = %s or identifier like %s', (uri, self._like_prefix(uri))])
+    queries.append(self._log_change(uri, 'delete'))
+    self.transaction(queries)
+    self.after_commit(self._notify_changes)
+    return {'location': rows[0]['location'], 'trash': trash}
+
+  def get_tombstones(self):
+    query = '''select id, identifier, rootid, location from tombstones order by id'''
+    return self.query(query)
+
+  def delete_tombstone(self, id):
+    self.query('delete from tombstones where id = %s', (id,))
 
-  def update_node(self, target, destination, node):
-    query = '''update nodes set identifier = "%s", node = '%s' where identifier = "%s"''' % (destination, node, target)
-    self.query(query)
+  def get_nested_child(self, id):
+    query = '''select c.id from nodes c where c.parent_id = %s and exists (select 1 from nodes g where g.parent_id = c.id) limit 1'''
+    rows = self.query(query, (id,))
+    return len(rows) > 0 and rows[0]['id'] or None
+
+  def get_child_ids(self, id, limit):
+    query = '''select id from nodes where parent_id = %s limit %s'''
+    return [row['id'] for row in self.query(query, (id, limit))]
+
+  def purge_nodes(self, ids):
+    marks = ', '.join(['%s'] * len(ids))
+    self.transaction([['update blobs b join (select location, count(*) as refs from nodes where id in (%s) group by location) n on b.location = n.location set b.refcount = b.refcount - n.refs' % marks, tuple(ids)],
+                      ['delete p from properties p join nodes n on p.identifier = n.identifier where n.id in (%s)' % marks, tuple(ids)],
+                      ['delete from nodes where id in (%s)' % marks, tuple(ids)]])
+
+  def add_blob_ref(self, location, digest = None, length = None):
+    if digest is None:
+      self.query('update blobs set refcount = refcount + 1 where location = %s', (location,))
+    else:
+      query = '''insert into blobs (location, digest, length, refcount, created) values (%s, %s, %s, 1, now()) on duplicate key update refcount = refcount + 1'''
+      self.query(query, (location, digest, length))
+
+  def release_blob(self, location):
+    self.query('update blobs set refcount = refcount - 1 where location = %s', (location,))
+
+  def get_unused_blobs(self, limit):
+    rows = self.query('select location from blobs where refcount <= 0 limit %s', (limit,))
+    return [row['location'] for row in rows]
+
+  def delete_unused_blob(self, location):
+    results = self.transaction([['delete from blobs where location = %s and refcount <= 0', (location,)],
+                                ['select count(*) as count from blobs where location = %s', (location,)]])
+    return results[1][0]['count'] == 0
+
+  def update_node(self, uri, properties, deleted = None):
+    queries = []
+    if properties: queries.append(self._set_properties(uri, properties))
+    if deleted:
+      queries.append(['delete from properties where identifier = %%s and property in (%s)' % ', '.join(['%s'] * len(deleted)), tuple([uri] + list(deleted))])
+    if properties and QUOTA in properties:
+      queries.append(['insert into usages (identifier, bytes, files, quota) values (%s, 0, 0, %s) on duplicate key update quota = values(quota)', (uri, int(properties[QUOTA]))])
+    elif deleted and QUOTA in deleted:
+      queries.append(['update usages set quota = null where identifier = %s', (uri,)])
+    queries.append(['update nodes set version = version + 1 where identifier = %s', (uri,)])
+    queries.append(self._log_change(uri, 'update'))
+    self.transaction(queries)
+    self.after_commit(self._notify_changes)
+
+  def move_node(self, target, destination):
+    parent, name, depth = self._split(destination)
+    size = self.get_size(target)
+    # Identifiers are materialised so every row keyed by one beneath a
+    # moved container is rewritten, a statement per table; other nodes
+    # only have their own rows
+    container = self.get_node_type(target)[0]['type'] == CONTAINER_NODE
+    queries = [self._add_usage(target, -size['bytes'], -size['files'] - 1),
+               ['update nodes set identifier = %s, parent_id = %s, name = %s, depth = %s, version = version + 1 where identifier = %s', (destination, self.get_node_id(parent), name, depth, target)]]
+    if container:
+      prefix = self._like_prefix(target)
+      offset = depth - self._split(target)[2]
+      queries.extend([['update nodes set identifier = concat(%s, substring(identifier, char_length(%s) + 1)), depth = depth + %s where identifier like %s', (destination, target, offset, prefix)],
+                      ['update properties set identifier = concat(%s, substring(identifier, char_length(%s) + 1)) where identifier = %s or identifier like %s', (destination, target, target, prefix)],
+                      ['update tombstones set identifier = concat(%s, substring(identifier, char_length(%s) + 1)) where identifier like %s', (destination, target, prefix)],
+                      ['update usages set identifier = concat(%s, substring(identifier, char_length(%s) + 1)) where identifier = %s or identifier like %s', (destination, target, target, prefix)]])
+    else:
+      queries.extend([['update properties set identifier = %s where identifier = %s', (destination, target)],
+                      ['update usages set identifier = %s where identifier = %s', (destination, target)]])
+    queries.extend([self._add_usage(destination, size['bytes'], size['files'] + 1),
+                    self._log_change(target, 'move'),
+                    self._log_change(destination, 'move')])
+    self.transaction(queries)
+    self.after_commit(self._notify_changes)
+
+  def copy_tree(self, target, destination, parent_id, new_location):
+    parent, name, depth = self._split(destination)
+    prefix = self._like_prefix(target)
+    new_prefix = self._like_prefix(destination)
+    offset = depth - self._split(target)[2]
+    size = self.get_size(target)
+    # Every copy gets its own location under the new one, wherever the original's is; shared blobs are kept
+    rewrite = '''case when location = '' or exists (select 1 from blobs b where b.location = nodes.location) then location
+                 else concat(%s, substring(identifier, char_length(%s) + 1)) end'''
+    queries = [['''insert into nodes (parent_id, name, depth, identifier, type, view, status, owner, location, target, creationDate) 
+                  select if(identifier = %s, %s, null), if(identifier = %s, %s, name), depth + %s, concat(%s, substring(identifier, char_length(%s) + 1)), type, view, status, owner, ''' + rewrite + ''', target, now() 
+                  from nodes where identifier = %s or identifier like %s order by id''',
+                (target, parent_id, target, name, offset, destination, target, new_location, target, target, prefix)],
+               # Link each copied node to its copied parent
+               ['''update nodes c join nodes p on p.identifier = left(c.identifier, char_length(c.identifier) - char_length(c.name) - 1) 
+                  set c.parent_id = p.id where c.identifier like %s and c.parent_id is null''', (new_prefix,)],
+               ['''insert into properties (identifier, property, value, number) select concat(%s, substring(identifier, char_length(%s) + 1)), property, value, number from properties where identifier = %s or identifier like %s''', (destination, target, target, prefix)],
+               ['''update blobs b join (select location, count(*) as refs from nodes where identifier = %s or identifier like %s group by location) n on b.location = n.location set b.refcount = b.refcount + n.refs''', (target, prefix)],
+               ['''insert into usages (identifier, bytes, files, quota) select concat(%s, substring(identifier, char_length(%s) + 1)), bytes, files, quota from usages where identifier = %s or identifier like %s''', (destination, target, target, prefix)],
+               self._add_usage(destination, size['bytes'], size['files'] + 1),
+               self._log_change(destination, 'create'),
+               ['select count(*) as count from nodes where identifier = %s or identifier like %s', (destination, new_prefix)]]
+    count = self.transaction(queries)[-1][0]['count']
+    self.after_commit(self._notify_changes)
+    return count
+
+  def get_copied_locations(self, target, destination):
+    query = '''select c.identifier, c.type, c.location as copy, n.location from nodes c join nodes n on n.identifier = concat(%s, substring(c.identifier, char_length(%s) + 1))
+               where (c.identifier = %s or c.identifier like %s) and c.location <> n.location'''
+    return self.query(query, (target, destination, destination, self._like_prefix(destination)))
+
+  def update_progress(self, job, checkpoint):
+    query = '''update jobs set job = %s, checkpoint = %s where phase = 'EXECUTING' and identifier = %s'''
+    self.query(query, (job.tostring(), checkpoint, job.jobId))
 
   def get_job(self, id, type = 'transfers', phase = None):
-    query = '''select job from jobs where identifier like "%s" and type = "%s"''' % (id, type)
+    query = '''select job from jobs where identifier = %s and type = %s'''
+    args = [id, type]
     if phase is not None:
-      query += ''' and phase = "%s"''' % phase
-    return self.query(query)
+      query += ''' and phase = %s'''
+      args.append(phase)
+    return self.query(query, tuple(args))
+
+  def get_job_ids(self, type = 'transfers', phase = None):
+    query = '''select identifier from jobs where type = %s and phase = %s'''
+    return self.query(query, (type, phase))
 
   def get_aborted_jobs(self, type = 'transfers'):
-    query = '''select identifier from jobs where phase = "ABORTED" and type = "%s"''' % type
-    return self.query(query)
+    query = '''select identifier from jobs where phase = 'ABORTED' and type = %s'''
+    return self.query(query, (type,))
 
   def get_jobs(self, type = 'transfers'):
-    query = '''select identifier, phase from jobs where type = "%s"''' % type
-    return self.query(query)
+    query = '''select identifier, phase from jobs where type = %s'''
+    return self.query(query, (type,))
 
   def get_phase(self, identifier):
-    query = '''select phase from jobs where identifier = "%s"''' % identifier
-    return self.query(query)
+    query = '''select phase from jobs where identifier = %s'''
+    return self.query(query, (identifier,))
 
   def already_exists(self, type, uri):
-    query = '''select count(*) from %s where identifier = "%s"''' % (type, uri)
-    rows = self.query(query)
+    if type == 'nodes': return self.get_node_id(uri) is not None
+    query = '''select count(*) from %s where identifier = %%s''' % type
+    rows = self.query(query, (uri,))
     if rows[0]['count(*)'] > 0:
       return True
     else:
       return False
 
+  def get_node_and_parent(self, uri, parent):
+    query = '''select id, type, identifier = %s as target from nodes where identifier in (%s, %s)'''
+    rows = self.query(query, (uri, uri, parent))
+    graves = self._graves([uri])
+    return [row for row in rows if not self._dead(row['target'] and uri or parent, row['id'], graves)]
+
   def get_node_type(self, uri):
-    query = '''select type from nodes where identifier = "%s"''' % (uri)
-    return self.query(query)
+    query = '''select id, type from nodes where identifier = %s'''
+    return self._live(uri, self.query(query, (uri,)))
+
+  def get_children(self, uri, start = None, limit = None, inclusive = True):
+    # The children of a deleted container are deleted too
+    if self._buried(uri) and self.get_node_id(uri) is None: return []
+    query = '''select c.identifier from nodes c join nodes p on c.parent_id = p.id where p.identifier = %s'''
+    args = [uri]
+    if start is not None:
+      query += inclusive and ' and c.name >= %s' or ' and c.name > %s'
+      args.append(start[start.rfind('/') + 1:])
+    query += ' order by c.name'
+    if limit is not None:
+      query += ' limit %s'
+      args.append(int(limit))
+    rows = self.query(query, tuple(args))
+    return [row['identifier'] for row in rows]
 
-  def get_children(self, uri):
-    query = '''select identifier from nodes where identifier like "%s%%"''' % (uri)
-    rows = self.query(query)
-    children = [row['identifier'] for row in rows if row['identifier'] != uri and '/' not in row['identifier'][len(uri) + 1:]]
-    return children
+  def get_child_details(self, uri, start = None, limit = None, inclusive = True):
+    if self._buried(uri) and self.get_node_id(uri) is None: return []
+    # Containers take their length from the usage rollup
+    query = '''select c.identifier, c.type, coalesce(u.bytes, l.value) as length, d.value as date, m.value as md5 from nodes c join nodes p on c.parent_id = p.id
+               left join usages u on u.identifier = c.identifier
+               left join properties l on l.identifier = c.identifier and l.property = %s
+               left join properties d on d.identifier = c.identifier and d.property = %s
+               left join properties m on m.identifier = c.identifier and m.property = %s
+               where p.identifier = %s'''
+    args = [LENGTH, DATE, MD5, uri]
+    if start is not None:
+      query += inclusive and ' and c.name >= %s' or ' and c.name > %s'
+      args.append(start[start.rfind('/') + 1:])
+    query += ' order by c.name'
+    if limit is not None:
+      query += ' limit %s'
+      args.append(int(limit))
+    return self.query(query, tuple(args))
+
+  def iter_children(self, uri, start = None, limit = None, details = False):
+    count = 0
+    inclusive = True
+    while limit is None or count < limit:
+      size = limit is None and LISTING_PAGE_SIZE or min(LISTING_PAGE_SIZE, limit - count)
+      if details:
+        children = self.get_child_details(uri, start, size, inclusive)
+      else:
+        children = self.get_children(uri, start, size, inclusive)
+      for child in children:
+        yield child
+      count += len(children)
+      if len(children) < size: break
+      start = details and children[-1]['identifier'] or children[-1]
+      inclusive = False
 
   def get_all_children(self, uri):
-    query = '''select identifier from nodes where identifier like "%s%%"''' % (uri)
-    rows = self.query(query)
-    children = [row['identifier'] for row in rows if row['identifier'] != uri]
-    return children
+    query = '''select id, identifier from nodes where identifier like %s order by identifier'''
+    rows = self._live(uri, self.query(query, (self._like_prefix(uri),)))
+    return [row['identifier'] for row in rows]
+
+  def _set_properties(self, identifier, properties):
+    query = '''insert into properties (identifier, property, value, number) values ''' + ', '.join(['(%s, %s, %s, %s)'] * len(properties)) + ' on duplicate key update value = values(value), number = values(number)'
+    args = []
+    for p in properties:
+      args.extend([identifier, p, properties[p], get_number(properties[p])])
+    return [query, tuple(args)]
+
+  def find_nodes(self, scope, terms, start = None, limit = None):
+    # The first term drives the property index and the rest must also hold
+    args = []
+    query = '''select n.id, n.identifier, n.type, n.target from properties p0 join nodes n on n.identifier = p0.identifier where ''' + self._match('p0', terms[0], args)
+    for i in range(1, len(terms)):
+      query += ' and exists (select 1 from properties p%d where p%d.identifier = n.identifier and %s)' % (i, i, self._match('p%d' % i, terms[i], args))
+    if scope != ROOT_NODE:
+      query += ' and n.identifier like %s'
+      args.append(self._like_prefix(scope))
+    if start is not None:
+      query += ' and n.identifier > %s'
+      args.append(start)
+    query += ' order by n.identifier'
+    if limit is not None:
+      query += ' limit %s'
+      args.append(int(limit))
+    rows = self.query(query, tuple(args))
+    # The cursor continues after the last row read, whether it was live or not
+    cursor = (limit is not None and len(rows) == limit) and rows[-1]['identifier'] or None
+    return self._live(None, rows), cursor
+
+  def _match(self, alias, term, args):
+    property, operator, value = term
+    args.append(property)
+    if operator == '^=':
+      args.append(self._escape_like(value) + '%')
+      return '%s.property = %%s and %s.value like %%s' % (alias, alias)
+    number = get_number(value)
+    if operator not in ['=', '!='] and number is not None:
+      args.append(number)
+      return '%s.property = %%s and %s.number %s %%s' % (alias, alias, operator)
+    args.append(value)
+    return '%s.property = %%s and %s.value %s %%s' % (alias, alias, operator == '!=' and '<>' or operator)
 
   def register_properties(self, identifier, properties):
-    props = [(identifier, p, properties[p]) for p in properties]
-    query = '''insert into properties values (%s, %s, %s)'''
-    cursor = PySQLPool.getNewQuery(connection = self.db)
-    cursor.executeMany(query, tuple(props))
+    if len(properties) > 0:
+      self.transaction([self._set_properties(identifier, properties)])
 
-  def register_job(self, job, identifier, phase = 'QUEUED', userid = None, completed = None, resultid = None, method = None):
+  def register_job(self, job, identifier, phase = 'QUEUED', userid = None, completed = None, resultid = None, method = None, type = 'transfers'):
     userid = (userid == None) and '' or userid
     resultid = (resultid == None) and '' or resultid
     method = (method == None) and '' or method
-    if completed is None:
-      query = '''insert into jobs(identifier, type, phase, userid, method, completed, resultid, job) values('%s', 'transfers', '%s', '%s', '%s', null, '%s', '%s')''' % (identifier, phase, userid, method, resultid, job)
-    else:
-      query = '''insert into jobs(identifier, type, phase, userid, method, completed, resultid, job) values('%s', 'transfers', '%s', '%s', '%s', '%s', '%s', '%s')''' % (identifier, phase, userid, method, completed, resultid, job)
-    self.query(query)
+    query = '''insert into jobs(identifier, type, phase, userid, method, completed, resultid, job) values(%s, %s, %s, %s, %s, %s, %s, %s)'''
+    self.query(query, (identifier, type, phase, userid, method, completed, resultid, job))
 
-  def register_transfer(self, identifier, endpoint):
-    query = '''insert into transfers(jobid, endpoint, created) values('%s', '%s', now())''' % (identifier, endpoint)
-    self.query(query)
+  def register_transfer(self, identifier, endpoint, token = None):
+    query = '''insert into transfers(jobid, endpoint, token, created) values(%s, %s, %s, now())'''
+    self.query(query, (identifier, endpoint, token))
 
   def register_details(self, identifier, details):
-    query = '''insert into results(identifier, details) values ('%s', '%s')''' % (identifier, details)
-    self.query(query)
+    query = '''insert into results(identifier, details) values (%s, %s)'''
+    self.query(query, (identifier, details))
 
   def get_transfer(self, jobid):
-    query = '''select job from jobs where identifier = "%s"''' % jobid
-    rows = self.query(query)
+    query = '''select job from jobs where identifier = %s'''
+    rows = self.query(query, (jobid,))
     xmljob = etree.fromstring(rows[0]['job'])
     return Job(job = xmljob)
 
   def update_job(self, job = None, completed = False):
     if completed:
-      query = '''update jobs set job = '%s', phase = 'COMPLETED', completed = now() where identifier = "%s"''' % (job.tostring(), job.jobId)
+      query = '''update jobs set job = %s, phase = 'COMPLETED', completed = now() where identifier = %s'''
+      self.query(query, (job.tostring(), job.jobId))
     else: 
-      query = '''update jobs set job = '%s', phase = '%s' where identifier = "%s"''' % (job.tostring(), job.phase, job.jobId)
-    self.query(query)
+      query = '''update jobs set job = %s, phase = %s where identifier = %s'''
+      self.query(query, (job.tostring(), job.phase, job.jobId))
+    self.after_commit(self._notify_phases)
 
   def get_job_details(self, jobid):
-    query = '''select type, resultid, method from jobs j where identifier = "%s"''' % jobid
-    return self.query(query)
+    query = '''select type, resultid, method, userid, checkpoint from jobs j where identifier = %s'''
+    return self.query(query, (jobid,))
 
   def get_job_type(self, jobid):
-    query = '''select type from jobs where identifier = "%s"''' % jobid
-    return self.query(query)
+    query = '''select type from jobs where identifier = %s'''
+    return self.query(query, (jobid,))
 
   def get_location(self, identifier):
-    query = '''select location from nodes where identifier = "%s"''' % identifier
-    return self.query(query)
+    query = '''select id, location from nodes where identifier = %s'''
+    return self._live(identifier, self.query(query, (identifier,)))
 
   def get_results(self, identifier):
-    query = '''select details from results where identifier = "%s"''' % identifier
-    return self.query(query)
+    query = '''select details from results where identifier = %s'''
+    return self.query(query, (identifier,))
 
-  def get_endpoint(self, endpoint):
-    query = '''select jobid, created, completed from transfers where endpoint like "%%%s%%"''' % endpoint
-    return self.query(query)
+  def get_endpoint(self, token):
+    query = '''select jobid, created, completed, (select group_concat(o.token) from transfers o where o.jobid = t.jobid) as tokens from transfers t where token = %s'''
+    return self.query(query, (token,))
 
-  def complete_transfers(self, jobid):
-    query = '''update transfers set completed = now() where jobid = "%s"''' % jobid
-    self.query(query)
+  def complete_transfers(self, jobid, identifier = None, properties = None, location = None):
+    queries = []
+    if jobid is not None:
+      queries.append(['update transfers set completed = now() where jobid = %s', (jobid,)])
+    if identifier is not None:
+      if LENGTH in properties: queries.append(self._add_usage(identifier, int(properties[LENGTH]) - self.get_size(identifier)['bytes'], 0))
+      if location is None:
+        queries.append(['update nodes set version = version + 1 where identifier = %s', (identifier,)])
+      else:
+        queries.append(['update nodes set version = version + 1, location = %s where identifier = %s', (location, identifier)])
+      queries.append(self._set_properties(identifier, properties))
+      queries.append(self._log_change(identifier, 'update'))
+    self.transaction(queries)
+    if identifier is not None: self.after_commit(self._notify_changes)
 
   def get_transfer_completed(self, jobid):
-    query = '''select completed from transfers where jobid = "%s"''' % jobid
-    return self.query(query)
+    query = '''select completed from transfers where jobid = %s'''
+    return self.query(query, (jobid,))
 
   def get_node_location(self, node):
-    query = '''select location from nodes where identifier = "%s"''' % node
-    return self.query(query)
+    query = '''select id, location from nodes where identifier = %s'''
+    return self._live(node, self.query(query, (node,)))
@@ -6,6 +6,7 @@
 # Python code to handle UWS transactions
 
 from config import UWS_NS, XLINK_NS, XSI_NS
+from resources import write_job
 
 try:
   from lxml import etree
@@ -28,20 +29,6 @@ except ImportError:
         except ImportError:
           print("Failed to import ElementTree from any known place")
 
-blankJob = '''<uws:job xsi:schemaLocation="http://www.ivoa.net/xml/UWS/v1.0 UWS.xsd " xmlns:xml="http://www.w3.org/XML/1998/namespace" xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-  <uws:jobId/>
-  <uws:ownerId xsi:nil="true"/>
-  <uws:phase/>
-  <uws:startTime xsi:nil="true"/>
-  <uws:endTime xsi:nil="true"/>
-  <uws:executionDuration/>
-  <uws:destruction xsi:nil="true"/>
-  <uws:parameters/>
-  <uws:results/>
-  <uws:errorSummary type="transient" hasDetail="true"/>
-  <uws:jobInfo/>
-</uws:job>'''
-
 class Job():
   
   def __init__(self, job = None):
@@ -79,41 +66,7 @@ class Job():
     """
     Get a string representation of the Job
     """
-    job = etree.fromstring(blankJob)
-    job.find('{%s}jobId' % UWS_NS).text = self.jobId
-    job.find('{%s}ownerId' % UWS_NS).text = self.ownerId
-    job.find('{%s}phase' % UWS_NS).text = self.phase
-    startTime = job.find('{%s}startTime' % UWS_NS)
-    if self.startTime != '' and self.startTime != None:
-      startTime.text = self.startTime
-      del startTime.attrib['{%s}nil' % XSI_NS]
-    endTime = job.find('{%s}endTime' % UWS_NS)
-    if self.endTime != '' and self.endTime != None:
-      endTime.text = self.endTime
-      del endTime.attrib['{%s}nil' % XSI_NS]
-    job.find('{%s}executionDuration' % UWS_NS).text = str(self.executionDuration)
-    parameters = job.find('{%s}parameters' % UWS_NS)
-    for params in self.parameters:
-      param = etree.SubElement(parameters, '{%s}parameter' % UWS_NS)
-      param.set('id', params)
-      param.text = self.parameters[params]
-    results = job.find('{%s}results' % UWS_NS)
-    for res in self.results:
-      result = etree.SubElement(results, '{%s}result' % UWS_NS)
-      result.set('id', res)
-      result.set('{%s}href' % XLINK_NS, self.results[res])
-    errorSummary = job.find('{%s}errorSummary' % UWS_NS)
-    if self.errorSummary != '':
-      message = etree.SubElement(errorSummary, '{%s}message')
-      message.text = self.errorSummary
-    else:
-      job.remove(errorSummary)
-    jobInfo = job.find('{%s}jobInfo' % UWS_NS)
-    if self.jobInfo != '':
-      jobInfo.append(etree.fromstring(self.jobInfo)) 
-    else:
-      job.remove(jobInfo)
-    return etree.tostring(job)
+    return write_job(self)
 
   def set_job_id(self, jobid):
     self.jobId = jobid
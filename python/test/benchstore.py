@@ -0,0 +1,55 @@
+#!/usr/bin/python -u
+# 2026/10/18
+# v0.1
+#
+# benchstore.py
+# Micro-benchmark of the per-query overhead of the store layer
+#
+# Usage: benchstore.py [queries per thread] [threads]
+# Run from the src directory against a loaded database (see cleardb.sql)
+
+import sys
+from threading import Thread
+from time import time
+
+import PySQLPool
+from config import CONFIG, ROOT_NODE
+from pool import ConnectionPool
+
+def interpolated(count):
+  """
+  Per-call query objects with interpolated SQL on a shared connection, as
+  the store used to issue them
+  """
+  config = CONFIG.dbinfo()
+  db = PySQLPool.getNewConnection(host = config['host'], user = config['user'], password = config['password'], schema = config['database'])
+  def run():
+    for i in xrange(count):
+      query = PySQLPool.getNewQuery(connection = db, commitOnEnd = True)
+      query.Query('''select type, location from nodes where identifier = "%s"''' % ROOT_NODE)
+  return run
+
+def prepared(count, affinity):
+  """
+  Prepared statements on pooled connections
+  """
+  pool = ConnectionPool(CONFIG.dbinfo().copy(), 32, affinity)
+  def run():
+    for i in xrange(count):
+      pool.execute([['select type, location from nodes where identifier = %s', (ROOT_NODE,)]])
+  return run
+
+def timed(name, run, count, threads):
+  workers = [Thread(target = run) for i in range(threads)]
+  start = time()
+  for worker in workers: worker.start()
+  for worker in workers: worker.join()
+  elapsed = time() - start
+  print "%-24s %8.1f us/query %10.0f queries/s" % (name, elapsed * 1e6 / (count * threads), count * threads / elapsed)
+
+if __name__ == '__main__':
+  count = len(sys.argv) > 1 and int(sys.argv[1]) or 10000
+  threads = len(sys.argv) > 2 and int(sys.argv[2]) or 1
+  timed('interpolated (before)', interpolated(count), count, threads)
+  timed('prepared, pooled', prepared(count, False), count, threads)
+  timed('prepared, per-thread', prepared(count, True), count, threads)
@@ -0,0 +1,161 @@
+#!/usr/bin/python -u
+# 2026/10/18
+# v0.1
+#
+# benchxml.py
+# Micro-benchmark of writing node, job and transfer representations
+#
+# Usage: benchxml.py [repeats]
+# Run from the src directory
+
+import sys
+from time import time
+
+from lxml import etree
+from config import UWS_NS, VOSPACE_NS, XLINK_NS, XSI_NS
+from resources import Job, Protocol, Transfer, NodeFactory
+
+NODE_TYPES = ['vos:Node', 'vos:DataNode', 'vos:ContainerNode', 'vos:UnstructuredDataNode', 'vos:StructuredDataNode', 'vos:LinkNode']
+CHILDREN = [1, 100, 10000]
+
+BLANK_NODE = '''<node xmlns:xsi="%s" xmlns="%s" xmlns:vos="%s" xsi:type="" uri="" />''' % (XSI_NS, VOSPACE_NS, VOSPACE_NS)
+BLANK_JOB = '''<uws:job xsi:schemaLocation="%s UWS.xsd " xmlns:xml="http://www.w3.org/XML/1998/namespace" xmlns:uws="%s" xmlns:xlink="%s" xmlns:xsi="%s">
+  <uws:jobId/>
+  <uws:ownerId xsi:nil="true"/>
+  <uws:phase/>
+  <uws:startTime xsi:nil="true"/>
+  <uws:endTime xsi:nil="true"/>
+  <uws:executionDuration/>
+  <uws:destruction xsi:nil="true"/>
+  <uws:parameters/>
+  <uws:results/>
+  <uws:errorSummary type="transient" hasDetail="true"/>
+  <uws:jobInfo/>
+</uws:job>''' % (UWS_NS, UWS_NS, XLINK_NS, XSI_NS)
+BLANK_TRANSFER = '''<vos:transfer xmlns:vos = "%s">
+  <vos:target/>
+  <vos:direction/>
+  <vos:keepBytes/>
+  </vos:transfer>''' % VOSPACE_NS
+
+def vos(tag):
+  return '{%s}%s' % (VOSPACE_NS, tag)
+
+def uws(tag):
+  return '{%s}%s' % (UWS_NS, tag)
+
+def tree_node(node):
+  """
+  Build the node as an element tree, as the representations used to be
+  written
+  """
+  xml = etree.fromstring(BLANK_NODE)
+  xml.set('uri', node.uri)
+  xml.set('{%s}type' % XSI_NS, node.TYPE)
+  properties = etree.SubElement(xml, vos('properties'))
+  for uri in node.properties:
+    property = etree.SubElement(properties, vos('property'), uri = uri)
+    property.text = node.properties[uri]
+  if hasattr(node, 'accepts'):
+    xml.set('busy', node.busy and 'true' or 'false')
+    for name in ('accepts', 'provides'):
+      views = etree.SubElement(xml, vos(name))
+      for uri in getattr(node, name): etree.SubElement(views, vos('view'), uri = uri)
+  capabilities = etree.SubElement(xml, vos('capabilities'))
+  for uri in node.capabilities: etree.SubElement(capabilities, vos('capability'), uri = uri)
+  if hasattr(node, 'nodes'):
+    nodes = etree.SubElement(xml, vos('nodes'))
+    for uri in node.nodes: etree.SubElement(nodes, vos('node'), uri = uri)
+  if hasattr(node, 'target'): etree.SubElement(xml, vos('target')).text = node.target
+  return etree.tostring(xml)
+
+def tree_job(job):
+  """
+  Build the job as an element tree
+  """
+  xml = etree.fromstring(BLANK_JOB)
+  xml.find(uws('jobId')).text = job.jobId
+  xml.find(uws('ownerId')).text = job.ownerId
+  xml.find(uws('phase')).text = job.phase
+  for name in ('startTime', 'endTime'):
+    if getattr(job, name):
+      element = xml.find(uws(name))
+      element.text = getattr(job, name)
+      del element.attrib['{%s}nil' % XSI_NS]
+  xml.find(uws('executionDuration')).text = str(job.executionDuration)
+  parameters = xml.find(uws('parameters'))
+  for id in job.parameters: etree.SubElement(parameters, uws('parameter'), id = id).text = job.parameters[id]
+  xml.remove(xml.find(uws('errorSummary')))
+  xml.find(uws('jobInfo')).append(etree.fromstring(job.jobInfo))
+  return etree.tostring(xml)
+
+def tree_transfer(transfer):
+  """
+  Build the transfer as an element tree, each part parsed back in
+  """
+  xml = etree.fromstring(BLANK_TRANSFER)
+  xml.find(vos('target')).text = transfer.target
+  xml.find(vos('direction')).text = transfer.direction
+  view = etree.Element(vos('view'), nsmap = {'vos': VOSPACE_NS})
+  view.set('uri', transfer.view.uri)
+  view.set('original', str(transfer.view.original))
+  xml.insert(2, etree.fromstring(etree.tostring(view)))
+  xml.find(vos('keepBytes')).text = str(transfer.keepBytes)
+  for protocol in transfer.protocols:
+    element = etree.Element(vos('protocol'), nsmap = {'vos': VOSPACE_NS}, uri = protocol.uri)
+    etree.SubElement(element, vos('endpoint')).text = protocol.endpoint
+    xml.append(etree.fromstring(etree.tostring(element)))
+  return etree.tostring(xml)
+
+def make_node(type, children):
+  node = NodeFactory().new_node(type)
+  node.set_uri('vos://nvo.caltech!vospace/bench/node')
+  for i in range(children):
+    node.properties['ivo://ivoa.net/vospace/core#p%d' % i] = 'value & <%d>' % i
+  if hasattr(node, 'nodes'):
+    node.nodes = ['vos://nvo.caltech!vospace/bench/node/child%d' % i for i in range(children)]
+  if hasattr(node, 'target'): node.set_target('vos://nvo.caltech!vospace/bench/target')
+  return node
+
+def make_transfer(children):
+  transfer = Transfer()
+  transfer.target = 'vos://nvo.caltech!vospace/bench/node'
+  transfer.direction = 'pullFromVoSpace'
+  for i in range(children):
+    protocol = Protocol()
+    protocol.uri = 'ivo://ivoa.net/vospace/core#httpget'
+    protocol.set_endpoint('http://localhost:8000/data/%032d' % i)
+    transfer.add_protocol(protocol)
+  return transfer
+
+def make_job(children):
+  job = Job()
+  job.set_job_id('bench')
+  job.set_owner_id('bench')
+  job.set_phase('EXECUTING')
+  job.set_start_time('2026-10-18T00:00:00')
+  for i in range(children): job.add_parameter('p%d' % i, 'value %d' % i)
+  job.set_job_info(make_transfer(1).tostring())
+  return job
+
+def timed(name, before, after, repeats):
+  if before() != after(): raise AssertionError('%s: the representations differ' % name)
+  times = []
+  for write in (before, after):
+    start = time()
+    for i in xrange(repeats): write()
+    times.append((time() - start) * 1e6 / repeats)
+  print "%-34s %12.1f us %12.1f us %6.1fx" % (name, times[0], times[1], times[0] / times[1])
+
+if __name__ == '__main__':
+  repeats = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+  print "%-34s %15s %15s" % ('', 'element tree', 'templates')
+  for children in CHILDREN:
+    count = max(5, repeats / children)
+    for type in NODE_TYPES:
+      node = make_node(type, children)
+      timed('%s (%d)' % (type, children), lambda: tree_node(node), lambda: node.tostring(), count)
+    job = make_job(children)
+    timed('job (%d)' % children, lambda: tree_job(job), job.tostring, count)
+    transfer = make_transfer(children)
+    timed('transfer (%d)' % children, lambda: tree_transfer(transfer), transfer.tostring, count)
@@ -4,23 +4,37 @@ truncate table properties;
 truncate table jobs;
 truncate table transfers;
 truncate table results;
+truncate table tombstones;
+truncate table blobs;
+truncate table usages;
+truncate table changes;
+truncate table signed_tokens;
 truncate table capabilities;
-insert into nodes(identifier, type, location, creationDate, node) values('vos://nvo.caltech!vospace', 3, 'file:///Users/mjg/Projects/test/data', now(), '<node xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="vos:ContainerNode" uri="vos://nvo.caltech!vospace" xmlns="http://www.ivoa.net/xml/VOSpace/v2.0" busy="false"> <properties> <property uri="ivo://ivoa.net/vospace/core#date">2015-01-01T00:00:00.000-0800</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#ispublic">true</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#groupread">quest</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#groupwrite">quest</property> <property readOnly="true" uri="ivo://ivoa.net/vospace/core#quota">5000000</property></properties> <accepts/> <provides/> <capabilities/> <nodes/> </node>');
-insert into properties values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#date', '2015-01-01T00:00:00.000-0800');
-insert into properties values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#groupread', 'quest');
-insert into properties values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#groupwrite', 'quest');
-insert into properties values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#ispublic', 'true');
-insert into properties values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#quota', '5000000');
-insert into nodes(identifier, type, location, creationDate, node) values('vos://nvo.caltech!vospace/node12', 1, 'file:///Users/mjg/Projects/test/data/node12', now(), '<node xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="vos:DataNode" uri="vos://nvo.caltech!vospace/node12" xmlns="http://www.ivoa.net/xml/VOSpace/v2.0" busy="false"> <properties> <property uri="ivo://ivoa.net/vospace/core#date">2015-01-01T00:00:00.000-0800</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#ispublic">true</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#groupread">quest</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#groupwrite">quest</property> </properties> <accepts/> <provides/> <capabilities/> </node>');
-insert into properties values('vos://nvo.caltech!vospace/node12', 'ivo://ivoa.net/vospace/core#date', '2015-01-01T00:00:00.000-0800');
-insert into properties values('vos://nvo.caltech!vospace/node12', 'ivo://ivoa.net/vospace/core#groupread', 'quest');
-insert into properties values('vos://nvo.caltech!vospace/node12', 'ivo://ivoa.net/vospace/core#groupwrite', 'quest');
-insert into properties values('vos://nvo.caltech!vospace/node12', 'ivo://ivoa.net/vospace/core#ispublic', 'true');
-insert into nodes(identifier, type, location, creationDate, node) values('vos://nvo.caltech!vospace/sarah', 3, 'file:///Users/mjg/Projects/test/data/sarah', now(), '<node xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="vos:ContainerNode" uri="vos://nvo.caltech!vospace/sarah" xmlns="http://www.ivoa.net/xml/VOSpace/v2.0" busy="false"> <properties> <property uri="ivo://ivoa.net/vospace/core#date">2015-01-01T00:00:00.000-0800</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#ispublic">true</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#groupread">quest</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#groupwrite">quest</property> <property readOnly="true" uri="ivo://ivoa.net/vospace/core#quota">5000000</property></properties> <accepts/> <provides/> <capabilities/> <nodes/> </node>');
-insert into properties values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#date', '2015-01-01T00:00:00.000-0800');
-insert into properties values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#groupread', 'quest');
-insert into properties values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#groupwrite', 'quest');
-insert into properties values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#ispublic', 'true');
-insert into nodes(identifier, type, location, creationDate, node) values('vos://nvo.caltech!vospace/siawork', 3, 'file:///Users/mjg/Projects/test/data/siawork', now(), '<node xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="vos:ContainerNode" uri="vos://nvo.caltech!vospace/siawork" xmlns="http://www.ivoa.net/xml/VOSpace/v2.0" busy="false"> <properties> <property uri="ivo://ivoa.net/vospace/core#date">2015-01-01T00:00:00.000-0800</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#ispublic">true</property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#groupread"></property> <property readOnly="false" uri="ivo://ivoa.net/vospace/core#groupwrite"></property> <property readOnly="true" uri="ivo://ivoa.net/vospace/core#quota">5000000</property></properties> <accepts/> <provides/> <capabilities/> <nodes/> </node>');
+insert into nodes(name, depth, identifier, type, location, creationDate) values('nvo.caltech!vospace', 0, 'vos://nvo.caltech!vospace', 3, 'file:///Users/mjg/Projects/test/data', now());
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#date', '2015-01-01T00:00:00.000-0800');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#groupread', 'quest');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#groupwrite', 'quest');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#ispublic', 'true');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace', 'ivo://ivoa.net/vospace/core#quota', '5000000');
+insert into nodes(name, depth, identifier, type, location, creationDate) values('node12', 1, 'vos://nvo.caltech!vospace/node12', 1, 'file:///Users/mjg/Projects/test/data/node12', now());
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/node12', 'ivo://ivoa.net/vospace/core#date', '2015-01-01T00:00:00.000-0800');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/node12', 'ivo://ivoa.net/vospace/core#groupread', 'quest');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/node12', 'ivo://ivoa.net/vospace/core#groupwrite', 'quest');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/node12', 'ivo://ivoa.net/vospace/core#ispublic', 'true');
+insert into nodes(name, depth, identifier, type, location, creationDate) values('sarah', 1, 'vos://nvo.caltech!vospace/sarah', 3, 'file:///Users/mjg/Projects/test/data/sarah', now());
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#date', '2015-01-01T00:00:00.000-0800');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#groupread', 'quest');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#groupwrite', 'quest');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#ispublic', 'true');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/sarah', 'ivo://ivoa.net/vospace/core#quota', '5000000');
+insert into nodes(name, depth, identifier, type, location, creationDate) values('siawork', 1, 'vos://nvo.caltech!vospace/siawork', 3, 'file:///Users/mjg/Projects/test/data/siawork', now());
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/siawork', 'ivo://ivoa.net/vospace/core#date', '2015-01-01T00:00:00.000-0800');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/siawork', 'ivo://ivoa.net/vospace/core#groupread', '');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/siawork', 'ivo://ivoa.net/vospace/core#groupwrite', '');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/siawork', 'ivo://ivoa.net/vospace/core#ispublic', 'true');
+insert into properties (identifier, property, value) values('vos://nvo.caltech!vospace/siawork', 'ivo://ivoa.net/vospace/core#quota', '5000000');
+update nodes n join nodes p on p.identifier = substring(n.identifier, 1, char_length(n.identifier) - char_length(n.name) - 1) set n.parent_id = p.id;
+insert into usages (identifier, bytes, files) select 'vos://nvo.caltech!vospace', 0, count(*) from nodes where identifier like 'vos://nvo.caltech!vospace/%';
+insert into usages (identifier, bytes, files, quota) select identifier, 0, 0, cast(value as unsigned) from properties where property = 'ivo://ivoa.net/vospace/core#quota' on duplicate key update quota = values(quota);
 drop database mydb;
 create database mydb;
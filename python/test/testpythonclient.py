@@ -80,6 +80,16 @@ def suite():
   suite.addTest(unittest.TestLoader().loadTestsFromTestCase(PullToVoSpaceTestCase))
   suite.addTest(unittest.TestLoader().loadTestsFromTestCase(PullFromVoSpaceTestCase))
   suite.addTest(unittest.TestLoader().loadTestsFromTestCase(PushFromVoSpaceTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(NodeETagTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(CreateNodeCheckTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TransferEndpointTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SignedSyncTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TombstoneTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(CopyContainerDataTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(QuotaTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SearchTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ChangeFeedTestCase))
+  suite.addTest(unittest.TestLoader().loadTestsFromTestCase(WaitTestCase))
   return suite
 
 def set_node_uri(node, uri):
@@ -235,6 +245,35 @@ def md5(filename):
   fd.close()
   return m.hexdigest()
 
+def get_transfer_endpoint(h, jobid, protocol):
+  """
+  Wait for the specified transfer job to start and get the endpoint it
+  offers for the specified protocol
+  """
+  content = 'QUEUED'
+  while content in ['PENDING', 'QUEUED']:
+    sleep(1)
+    resp, content = h.request(BASE_URI + 'transfers/%s/phase' % jobid)
+  resp, content = h.request(BASE_URI + 'transfers/%s' % jobid)
+  job = Job(content)
+  resp, content = h.request(job.results['transferDetails'])
+  for endpoint in Transfer(content).protocols:
+    if endpoint.uri == protocol: return endpoint.endpoint
+  return None
+
+def start_push(h, target):
+  """
+  Start a pushToVoSpace job for the specified node and get the endpoint
+  to upload to
+  """
+  transfer = etree.parse('test/transfer.xml')
+  set_transfer_target(transfer, target)
+  set_transfer_direction(transfer, 'pushToVoSpace')
+  set_transfer_view(transfer, 'ivo://ivoa.net/vospace/core#votable')
+  set_transfer_protocol(transfer, 'ivo://ivoa.net/vospace/core#httpput')
+  jobid = test_start_uws(h, 'transfers', etree.tostring(transfer))
+  return get_transfer_endpoint(h, jobid, 'ivo://ivoa.net/vospace/core#httpput')
+
 
 class XMLMatcher():
 
@@ -1149,6 +1188,20 @@ class SetNodeTestCase(unittest.TestCase):
     newnode = self.nf.get_node(content)
     self.assertEqual(newnode.properties[DESCRIPTION], "My award winning image")
 
+  def test_set_non_ascii_value(self):
+    """
+    Test setting a property to a non-ASCII value and reading it back: node16
+    """
+    node = StructuredDataNode()
+    node.uri = ROOT_NODE + '/node16'
+    node.add_property(DESCRIPTION, u"Caf\xe9 \u2603")
+    resp, content = self.h.request(BASE_URI + 'nodes/node16', 'POST', body = node.tostring())
+    self.assertEqual(int(resp['status']), 200)
+    resp, content = self.h.request(BASE_URI + 'nodes/node16', 'GET')
+    self.assertEqual(int(resp['status']), 200)
+    newnode = self.nf.get_node(content)
+    self.assertEqual(newnode.properties[DESCRIPTION], u"Caf\xe9 \u2603")
+
   def test_set_empty_value(self):
     """
     Test setting a property to empty: node16
@@ -1650,6 +1703,734 @@ class PushFromVoSpaceTestCase(unittest.TestCase):
     test_uws(self.h, 'transfers', etree.tostring(self.transfer), fail = True, summary = 'Destination URI is invalid')  
 
 
+class NodeETagTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case
+    """
+    self.h = httplib2.Http()
+    self.nf = NodeFactory()
+    node = StructuredDataNode()
+    node.uri = ROOT_NODE + '/nodee1'
+    node.add_property(DESCRIPTION, "Tagged")
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 201)
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1', 'DELETE')
+    self.assertEqual(int(resp['status']), 200)
+
+  def test_not_modified(self):
+    """
+    Test revalidating an unchanged node: nodee1
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1')
+    self.assertEqual(int(resp['status']), 200)
+    etag = resp['etag']
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1', headers = {'If-None-Match': etag})
+    self.assertEqual(int(resp['status']), 304)
+    self.assertEqual(content, '')
+    self.assertEqual(resp['etag'], etag)
+
+  def test_modified(self):
+    """
+    Test revalidating a node which has changed: nodee1
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1')
+    self.assertEqual(int(resp['status']), 200)
+    etag = resp['etag']
+    node = StructuredDataNode()
+    node.uri = ROOT_NODE + '/nodee1'
+    node.add_property(DESCRIPTION, "Retagged")
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1', 'POST', body = node.tostring())
+    self.assertEqual(int(resp['status']), 200)
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1', headers = {'If-None-Match': etag})
+    self.assertEqual(int(resp['status']), 200)
+    self.assertNotEqual(resp['etag'], etag)
+    newnode = self.nf.get_node(content)
+    self.assertEqual(newnode.properties[DESCRIPTION], "Retagged")
+
+  def test_detail_tags(self):
+    """
+    Test that each level of detail has its own entity tag: nodee1
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1?detail=max')
+    self.assertEqual(int(resp['status']), 200)
+    etag = resp['etag']
+    resp, content = self.h.request(BASE_URI + 'nodes/nodee1?detail=min', headers = {'If-None-Match': etag})
+    self.assertEqual(int(resp['status']), 200)
+    self.assertNotEqual(resp['etag'], etag)
+
+
+class CreateNodeCheckTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case
+    """
+    self.h = httplib2.Http()
+    node = DataNode()
+    node.uri = ROOT_NODE + '/nodev1'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodev1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 201)
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodev1', 'DELETE')
+    self.assertEqual(int(resp['status']), 200)
+
+  def test_create_existing_node(self):
+    """
+    Test creating a node which already exists: nodev1
+    """
+    node = DataNode()
+    node.uri = ROOT_NODE + '/nodev1'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodev1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 409)
+    self.assertEqual(get_error_message(content), 'A Node already exists with the requested URI.')
+
+  def test_create_node_in_data_node(self):
+    """
+    Test creating a node whose parent is not a container: nodev1/nodev2
+    """
+    node = DataNode()
+    node.uri = ROOT_NODE + '/nodev1/nodev2'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodev1/nodev2', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 500)
+    self.assertEqual(get_error_message(content), 'The parent node is not valid.')
+
+  def test_create_node_without_parent(self):
+    """
+    Test creating a node whose parent does not exist: nodev3/nodev2
+    """
+    node = DataNode()
+    node.uri = ROOT_NODE + '/nodev3/nodev2'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodev3/nodev2', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 500)
+    self.assertEqual(get_error_message(content), 'The parent node is not valid.')
+
+
+class TransferEndpointTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case
+    """
+    self.h = httplib2.Http()
+    self.endpoint = start_push(self.h, ROOT_NODE + '/nodet1')
+    assert self.endpoint is not None
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodet1', 'DELETE')
+
+  def test_endpoint_used_once(self):
+    """
+    Test that an endpoint cannot be used again: nodet1
+    """
+    file = open('test/burbidge.vot').read()
+    resp, content = self.h.request(self.endpoint, 'PUT', body = file)
+    self.assertEqual(int(resp['status']), 200)
+    resp, content = self.h.request(self.endpoint, 'PUT', body = file)
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_endpoint_direction(self):
+    """
+    Test that an upload endpoint cannot be read from: nodet1
+    """
+    resp, content = self.h.request(self.endpoint)
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_unknown_endpoint(self):
+    """
+    Test uploading to an endpoint no transfer has
+    """
+    endpoint = self.endpoint[:self.endpoint.rfind('/') + 1] + uuid.uuid4().hex
+    resp, content = self.h.request(endpoint, 'PUT', body = open('test/burbidge.vot').read())
+    self.assertEqual(int(resp['status']), 404)
+
+
+class SignedSyncTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case
+    """
+    self.h = httplib2.Http()
+    self.transfer = etree.parse('test/transfer.xml')
+    set_transfer_view(self.transfer, 'ivo://ivoa.net/vospace/core#votable')
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodes1', 'DELETE')
+
+  def sign(self, direction, protocol):
+    """
+    Get a signed endpoint for the specified transfer of nodes1, skipping
+    the test if the service answers sync transfers with a job instead
+    """
+    set_transfer_target(self.transfer, ROOT_NODE + '/nodes1')
+    set_transfer_direction(self.transfer, direction)
+    set_transfer_protocol(self.transfer, protocol)
+    resp, content = self.h.request(BASE_URI + 'sync', 'POST', body = etree.tostring(self.transfer))
+    if resp.previous is not None: self.skipTest('The service answers sync transfers with a job')
+    self.assertEqual(int(resp['status']), 200)
+    endpoints = [x.endpoint for x in Transfer(content).protocols if x.uri == protocol]
+    self.assertEqual(len(endpoints), 1)
+    return endpoints[0]
+
+  def test_signed_push_used_once(self):
+    """
+    Test that a signed upload endpoint can be used once only: nodes1
+    """
+    endpoint = self.sign('pushToVoSpace', 'ivo://ivoa.net/vospace/core#httpput')
+    file = open('test/burbidge.vot').read()
+    resp, content = self.h.request(endpoint, 'PUT', body = file)
+    self.assertEqual(int(resp['status']), 200)
+    resp, content = self.h.request(endpoint, 'PUT', body = file)
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_signed_pull_used_once(self):
+    """
+    Test that a signed download endpoint is used up by a completed download: nodes1
+    """
+    endpoint = self.sign('pushToVoSpace', 'ivo://ivoa.net/vospace/core#httpput')
+    resp, content = self.h.request(endpoint, 'PUT', body = open('test/burbidge.vot').read())
+    self.assertEqual(int(resp['status']), 200)
+    endpoint = self.sign('pullFromVoSpace', 'ivo://ivoa.net/vospace/core#httpget')
+    resp, content = self.h.request(endpoint)
+    self.assertEqual(int(resp['status']), 200)
+    self.assertEqual(hashlib.md5(content).hexdigest(), md5('test/burbidge.vot'))
+    sleep(1)
+    resp, content = self.h.request(endpoint)
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_signed_pull_resumed(self):
+    """
+    Test that a signed download endpoint can be used again after a partial download: nodes1
+    """
+    endpoint = self.sign('pushToVoSpace', 'ivo://ivoa.net/vospace/core#httpput')
+    resp, content = self.h.request(endpoint, 'PUT', body = open('test/burbidge.vot').read())
+    self.assertEqual(int(resp['status']), 200)
+    endpoint = self.sign('pullFromVoSpace', 'ivo://ivoa.net/vospace/core#httpget')
+    resp, head = self.h.request(endpoint, headers = {'Range': 'bytes=0-9'})
+    self.assertEqual(int(resp['status']), 206)
+    sleep(1)
+    resp, tail = self.h.request(endpoint, headers = {'Range': 'bytes=10-'})
+    self.assertEqual(int(resp['status']), 206)
+    self.assertEqual(hashlib.md5(head + tail).hexdigest(), md5('test/burbidge.vot'))
+    sleep(1)
+    resp, content = self.h.request(endpoint)
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_signed_endpoint_direction(self):
+    """
+    Test that a signed upload endpoint cannot be read from: nodes1
+    """
+    endpoint = self.sign('pushToVoSpace', 'ivo://ivoa.net/vospace/core#httpput')
+    resp, content = self.h.request(endpoint)
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_tampered_endpoint(self):
+    """
+    Test that a signed endpoint with a changed signature is refused: nodes1
+    """
+    endpoint = self.sign('pushToVoSpace', 'ivo://ivoa.net/vospace/core#httpput')
+    endpoint = endpoint[:-1] + (endpoint[-1] == '0' and '1' or '0')
+    resp, content = self.h.request(endpoint, 'PUT', body = open('test/burbidge.vot').read())
+    self.assertEqual(int(resp['status']), 404)
+
+
+class TombstoneTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case
+    """
+    self.h = httplib2.Http()
+    self.nf = NodeFactory()
+    self.create_tree()
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1', 'DELETE')
+
+  def create_tree(self):
+    """
+    Create a container holding a data node and a container: nodeb1
+    """
+    for uri, node in [('nodeb1', ContainerNode()), ('nodeb1/nodeb2', DataNode()), ('nodeb1/nodeb3', ContainerNode())]:
+      node.uri = ROOT_NODE + '/' + uri
+      resp, content = self.h.request(BASE_URI + 'nodes/' + uri, 'PUT', body = node.tostring())
+      self.assertEqual(int(resp['status']), 201)
+
+  def test_delete_container(self):
+    """
+    Test that the nodes beneath a deleted container are gone at once: nodeb1
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1', 'DELETE')
+    self.assertEqual(int(resp['status']), 200)
+    for uri in ['nodeb1', 'nodeb1/nodeb2', 'nodeb1/nodeb3']:
+      resp, content = self.h.request(BASE_URI + 'nodes/' + uri)
+      self.assertEqual(int(resp['status']), 404)
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1', 'DELETE')
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_recreate_container(self):
+    """
+    Test that a container created in place of a deleted one starts empty: nodeb1
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1', 'DELETE')
+    self.assertEqual(int(resp['status']), 200)
+    node = ContainerNode()
+    node.uri = ROOT_NODE + '/nodeb1'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 201)
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1')
+    self.assertEqual(int(resp['status']), 200)
+    self.assertEqual(self.nf.get_node(content).nodes, [])
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1/nodeb2')
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_recreate_tree(self):
+    """
+    Test recreating a deleted tree under the same URIs: nodeb1
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1', 'DELETE')
+    self.assertEqual(int(resp['status']), 200)
+    self.create_tree()
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeb1')
+    self.assertEqual(int(resp['status']), 200)
+    container = self.nf.get_node(content)
+    self.assertEqual(sorted(container.nodes), [ROOT_NODE + '/nodeb1/nodeb2', ROOT_NODE + '/nodeb1/nodeb3'])
+
+
+class CopyContainerDataTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case
+    """
+    self.h = httplib2.Http()
+    self.nf = NodeFactory()
+    node = ContainerNode()
+    node.uri = ROOT_NODE + '/nodek1'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 201)
+    endpoint = start_push(self.h, ROOT_NODE + '/nodek1/nodek2')
+    resp, content = self.h.request(endpoint, 'PUT', body = open('test/burbidge.vot').read())
+    self.assertEqual(int(resp['status']), 200)
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek1', 'DELETE')
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek3', 'DELETE')
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek4', 'DELETE')
+
+  def test_copy_container_data(self):
+    """
+    Test that copying a container copies the bytes and details of its data nodes: nodek1 -> nodek3
+    """
+    transfer = etree.parse('test/transfer.xml')
+    set_transfer_target(transfer, ROOT_NODE + '/nodek1')
+    set_transfer_direction(transfer, ROOT_NODE + '/nodek3')
+    set_transfer_keepBytes(transfer, True)
+    test_uws(self.h, 'transfers', etree.tostring(transfer))
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek1/nodek2')
+    self.assertEqual(int(resp['status']), 200)
+    original = self.nf.get_node(content)
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek3/nodek2')
+    self.assertEqual(int(resp['status']), 200)
+    copy = self.nf.get_node(content)
+    for property in ['ivo://ivoa.net/vospace/core#MD5', 'ivo://ivoa.net/vospace/core#length']:
+      self.assertEqual(copy.properties[property], original.properties[property])
+    # The copy keeps its bytes once the original is gone
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek1', 'DELETE')
+    self.assertEqual(int(resp['status']), 200)
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek3/nodek2?view=data')
+    self.assertEqual(int(resp['status']), 200)
+    self.assertEqual(hashlib.md5(content).hexdigest(), md5('test/burbidge.vot'))
+
+  def test_copy_moved_data(self):
+    """
+    Test that a copy of a node moved into a container has its own bytes: nodek4 -> nodek1/nodek4, nodek1 -> nodek3
+    """
+    endpoint = start_push(self.h, ROOT_NODE + '/nodek4')
+    resp, content = self.h.request(endpoint, 'PUT', body = open('test/burbidge.vot').read())
+    self.assertEqual(int(resp['status']), 200)
+    transfer = etree.parse('test/transfer.xml')
+    set_transfer_target(transfer, ROOT_NODE + '/nodek4')
+    set_transfer_direction(transfer, ROOT_NODE + '/nodek1/nodek4')
+    set_transfer_keepBytes(transfer, False)
+    test_uws(self.h, 'transfers', etree.tostring(transfer))
+    set_transfer_target(transfer, ROOT_NODE + '/nodek1')
+    set_transfer_direction(transfer, ROOT_NODE + '/nodek3')
+    set_transfer_keepBytes(transfer, True)
+    test_uws(self.h, 'transfers', etree.tostring(transfer))
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek1', 'DELETE')
+    self.assertEqual(int(resp['status']), 200)
+    resp, content = self.h.request(BASE_URI + 'nodes/nodek3/nodek4?view=data')
+    self.assertEqual(int(resp['status']), 200)
+    self.assertEqual(hashlib.md5(content).hexdigest(), md5('test/burbidge.vot'))
+
+
+class QuotaTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case: siawork has a quota of 5000000 bytes
+    """
+    self.h = httplib2.Http()
+    self.nf = NodeFactory()
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork/nodeq1', 'DELETE')
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork/nodeq2', 'DELETE')
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeq3', 'DELETE')
+
+  def test_space_properties(self):
+    """
+    Test that a container reports its quota and the space left: siawork
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork')
+    self.assertEqual(int(resp['status']), 200)
+    node = self.nf.get_node(content)
+    self.assertEqual(node.properties['ivo://ivoa.net/vospace/core#quota'], '5000000')
+    assert 0 <= int(node.properties['ivo://ivoa.net/vospace/core#availableSpace']) <= 5000000
+
+  def test_upload_within_quota(self):
+    """
+    Test that an upload counts against the quota: siawork/nodeq1
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork')
+    available = int(self.nf.get_node(content).properties['ivo://ivoa.net/vospace/core#availableSpace'])
+    endpoint = start_push(self.h, ROOT_NODE + '/siawork/nodeq1')
+    file = open('test/burbidge.vot').read()
+    resp, content = self.h.request(endpoint, 'PUT', body = file)
+    self.assertEqual(int(resp['status']), 200)
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork')
+    self.assertEqual(int(self.nf.get_node(content).properties['ivo://ivoa.net/vospace/core#availableSpace']), available - len(file))
+
+  def test_upload_over_quota(self):
+    """
+    Test that an upload which would exceed the quota is refused: siawork/nodeq1
+    """
+    endpoint = start_push(self.h, ROOT_NODE + '/siawork/nodeq1')
+    resp, content = self.h.request(endpoint, 'PUT', body = 'x' * 5000001)
+    self.assertEqual(int(resp['status']), 413)
+
+  def test_copy_over_quota(self):
+    """
+    Test that a copy which would exceed the quota fails: siawork/nodeq1 -> siawork/nodeq2
+    """
+    endpoint = start_push(self.h, ROOT_NODE + '/siawork/nodeq1')
+    resp, content = self.h.request(endpoint, 'PUT', body = 'x' * 3000000)
+    self.assertEqual(int(resp['status']), 200)
+    transfer = etree.parse('test/transfer.xml')
+    set_transfer_target(transfer, ROOT_NODE + '/siawork/nodeq1')
+    set_transfer_direction(transfer, ROOT_NODE + '/siawork/nodeq2')
+    set_transfer_keepBytes(transfer, True)
+    test_uws(self.h, 'transfers', etree.tostring(transfer), fail = True, summary = 'The data would exceed the quota of %s/siawork.' % ROOT_NODE)
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork/nodeq2')
+    self.assertEqual(int(resp['status']), 404)
+
+  def test_move_over_quota(self):
+    """
+    Test that a move into a container which would exceed its quota fails: nodeq3 -> siawork/nodeq3
+    """
+    endpoint = start_push(self.h, ROOT_NODE + '/siawork/nodeq1')
+    resp, content = self.h.request(endpoint, 'PUT', body = 'x' * 3000000)
+    self.assertEqual(int(resp['status']), 200)
+    endpoint = start_push(self.h, ROOT_NODE + '/nodeq3')
+    resp, content = self.h.request(endpoint, 'PUT', body = 'x' * 3000000)
+    self.assertEqual(int(resp['status']), 200)
+    transfer = etree.parse('test/transfer.xml')
+    set_transfer_target(transfer, ROOT_NODE + '/nodeq3')
+    set_transfer_direction(transfer, ROOT_NODE + '/siawork/nodeq3')
+    set_transfer_keepBytes(transfer, False)
+    test_uws(self.h, 'transfers', etree.tostring(transfer), fail = True, summary = 'The data would exceed the quota of %s/siawork.' % ROOT_NODE)
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeq3')
+    self.assertEqual(int(resp['status']), 200)
+
+  def test_set_quota(self):
+    """
+    Test that a client cannot set a quota: siawork
+    """
+    node = ContainerNode()
+    node.uri = ROOT_NODE + '/siawork'
+    node.properties['ivo://ivoa.net/vospace/core#quota'] = '10000000'
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork', 'POST', body = node.tostring())
+    self.assertEqual(int(resp['status']), 401)
+    self.assertEqual(get_error_message(content), 'User does not have permissions to set a readonly property.')
+
+  def test_delete_quota(self):
+    """
+    Test that a client cannot remove a quota: siawork
+    """
+    node = ContainerNode()
+    node.uri = ROOT_NODE + '/siawork'
+    node.properties['ivo://ivoa.net/vospace/core#quota'] = ''
+    nodexml = etree.fromstring(node.tostring())
+    prop = nodexml.find('.//{%s}property' % VOS_NS)
+    prop.set('{%s}nil' % XSI_NS, 'true')
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork', 'POST', body = etree.tostring(nodexml))
+    self.assertEqual(int(resp['status']), 401)
+
+  def test_set_length(self):
+    """
+    Test that a client cannot set the length of a data node: siawork/nodeq1
+    """
+    node = DataNode()
+    node.uri = ROOT_NODE + '/siawork/nodeq1'
+    node.properties['ivo://ivoa.net/vospace/core#length'] = '1'
+    resp, content = self.h.request(BASE_URI + 'nodes/siawork/nodeq1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 401)
+
+
+class SearchTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case
+    """
+    self.h = httplib2.Http()
+    node = ContainerNode()
+    node.uri = ROOT_NODE + '/nodef1'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodef1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 201)
+    for name, description in [('nodef2', 'Spiral galaxy'), ('nodef3', 'Spiral arm'), ('nodef4', 'Elliptical galaxy')]:
+      node = DataNode()
+      node.uri = ROOT_NODE + '/nodef1/' + name
+      node.add_property(DESCRIPTION, description)
+      resp, content = self.h.request(BASE_URI + 'nodes/nodef1/' + name, 'PUT', body = node.tostring())
+      self.assertEqual(int(resp['status']), 201)
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodef1', 'DELETE')
+
+  def search(self, query, target = ROOT_NODE + '/nodef1'):
+    """
+    Run the specified search and get the URIs of the nodes found
+    """
+    body = '<uws:job xmlns:uws="%s"><uws:parameters><uws:parameter id="query">%s</uws:parameter><uws:parameter id="target">%s</uws:parameter></uws:parameters></uws:job>' % (UWS_NS, escape_text(query), target)
+    resp, content = self.h.request(BASE_URI + 'searches', 'POST', body = body)
+    self.assertEqual(int(resp.previous['status']), 303)
+    self.assertEqual(int(resp['status']), 200)
+    job = Job(content)
+    self.assertEqual(job.phase, 'COMPLETED')
+    resp, content = self.h.request(job.results['searchDetails'])
+    self.assertEqual(int(resp['status']), 200)
+    return sorted([x.get('uri') for x in etree.fromstring(content).iter('{%s}node' % VOS_NS)])
+
+  def test_search_equal(self):
+    """
+    Test finding nodes with a property value: nodef1
+    """
+    self.assertEqual(self.search('description = "Spiral arm"'), [ROOT_NODE + '/nodef1/nodef3'])
+
+  def test_search_prefix(self):
+    """
+    Test finding nodes with a property value prefix: nodef1
+    """
+    self.assertEqual(self.search('description ^= Spiral'), [ROOT_NODE + '/nodef1/nodef2', ROOT_NODE + '/nodef1/nodef3'])
+
+  def test_search_terms(self):
+    """
+    Test finding nodes matching several terms: nodef1
+    """
+    self.assertEqual(self.search('description ^= Spiral and description != "Spiral arm"'), [ROOT_NODE + '/nodef1/nodef2'])
+
+  def test_search_target(self):
+    """
+    Test that only nodes beneath the target are found: nodef1/nodef5
+    """
+    for uri, node in [('nodef1/nodef5', ContainerNode()), ('nodef1/nodef5/nodef6', DataNode())]:
+      node.uri = ROOT_NODE + '/' + uri
+      node.add_property(DESCRIPTION, 'Spiral nebula')
+      resp, content = self.h.request(BASE_URI + 'nodes/' + uri, 'PUT', body = node.tostring())
+      self.assertEqual(int(resp['status']), 201)
+    self.assertEqual(self.search('description ^= Spiral', target = ROOT_NODE + '/nodef1/nodef5'), [ROOT_NODE + '/nodef1/nodef5/nodef6'])
+
+  def test_invalid_query(self):
+    """
+    Test submitting a search which cannot be parsed
+    """
+    body = '<uws:job xmlns:uws="%s"><uws:parameters><uws:parameter id="query">description galaxy</uws:parameter></uws:parameters></uws:job>' % UWS_NS
+    resp, content = self.h.request(BASE_URI + 'searches', 'POST', body = body)
+    self.assertEqual(int(resp['status']), 400)
+
+
+class ChangeFeedTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case
+    """
+    self.h = httplib2.Http()
+    resp, content = self.h.request(BASE_URI + 'changes')
+    self.assertEqual(int(resp['status']), 200)
+    self.since = int(content.strip())
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeh1', 'DELETE')
+
+  def changes(self, **kwargs):
+    """
+    Get the changes after the sequence number read in setUp as a list of
+    (operation, URI) and the sequence number to continue from
+    """
+    kwargs.setdefault('since', self.since)
+    resp, content = self.h.request(BASE_URI + 'changes?' + urlencode(kwargs))
+    self.assertEqual(int(resp['status']), 200)
+    lines = content.splitlines()
+    return [tuple(line.split('\t')[1:]) for line in lines[:-1]], int(lines[-1])
+
+  def test_follow_changes(self):
+    """
+    Test that creating, updating and deleting a node are logged in order: nodeh1
+    """
+    node = DataNode()
+    node.uri = ROOT_NODE + '/nodeh1'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeh1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 201)
+    node.add_property(DESCRIPTION, "Changed")
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeh1', 'POST', body = node.tostring())
+    self.assertEqual(int(resp['status']), 200)
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeh1', 'DELETE')
+    self.assertEqual(int(resp['status']), 200)
+    changes, since = self.changes(prefix = 'nodeh1')
+    uri = ROOT_NODE + '/nodeh1'
+    self.assertEqual(changes, [('create', uri), ('update', uri), ('delete', uri)])
+    assert since > self.since
+    # Nothing is repeated
+    changes, after = self.changes(since = since, prefix = 'nodeh1')
+    self.assertEqual(changes, [])
+    self.assertEqual(after, since)
+
+  def test_prefix(self):
+    """
+    Test that only changes at or below the prefix are returned: nodeh1
+    """
+    node = ContainerNode()
+    node.uri = ROOT_NODE + '/nodeh1'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeh1', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 201)
+    node = DataNode()
+    node.uri = ROOT_NODE + '/nodeh1/nodeh2'
+    resp, content = self.h.request(BASE_URI + 'nodes/nodeh1/nodeh2', 'PUT', body = node.tostring())
+    self.assertEqual(int(resp['status']), 201)
+    changes, since = self.changes(prefix = 'nodeh1/nodeh2')
+    self.assertEqual(changes, [('create', ROOT_NODE + '/nodeh1/nodeh2')])
+
+  def test_wait_for_changes(self):
+    """
+    Test that a request waits for a change and returns when there is none
+    """
+    start = datetime.now()
+    changes, since = self.changes(prefix = 'nodeh1', wait = 2)
+    self.assertEqual(changes, [])
+    assert (datetime.now() - start).total_seconds() >= 1.5
+
+  def test_invalid_since(self):
+    """
+    Test asking for changes after a sequence number which is not a number
+    """
+    resp, content = self.h.request(BASE_URI + 'changes?since=latest')
+    self.assertEqual(int(resp['status']), 400)
+
+
+class WaitTestCase(unittest.TestCase):
+
+  def setUp(self):
+    """
+    Initialize the test case: a push to nodew1 waits for its upload
+    """
+    self.h = httplib2.Http()
+    transfer = etree.parse('test/transfer.xml')
+    set_transfer_target(transfer, ROOT_NODE + '/nodew1')
+    set_transfer_direction(transfer, 'pushToVoSpace')
+    set_transfer_view(transfer, 'ivo://ivoa.net/vospace/core#votable')
+    set_transfer_protocol(transfer, 'ivo://ivoa.net/vospace/core#httpput')
+    self.jobid = test_start_uws(self.h, 'transfers', etree.tostring(transfer))
+
+  def tearDown(self):
+    """
+    Tidy up after test
+    """
+    resp, content = self.h.request(BASE_URI + 'nodes/nodew1', 'DELETE')
+
+  def phase(self, **kwargs):
+    """
+    Get the phase of the job, with the specified blocking parameters
+    """
+    resp, content = self.h.request(BASE_URI + 'transfers/%s/phase?%s' % (self.jobid, urlencode(kwargs)))
+    self.assertEqual(int(resp['status']), 200)
+    return content
+
+  def test_wait_for_phase_change(self):
+    """
+    Test waiting for a job to leave the phase it is in: nodew1
+    """
+    phase = self.phase(WAIT = 30, PHASE = 'QUEUED')
+    assert phase != 'QUEUED'
+
+  def test_wait_while_active(self):
+    """
+    Test that waiting on an active job returns once the wait is over: nodew1
+    """
+    endpoint = get_transfer_endpoint(self.h, self.jobid, 'ivo://ivoa.net/vospace/core#httpput')
+    start = datetime.now()
+    self.assertEqual(self.phase(WAIT = 2), 'EXECUTING')
+    assert (datetime.now() - start).total_seconds() >= 1.5
+    # The upload completes the job, ending the wait
+    resp, content = self.h.request(endpoint, 'PUT', body = open('test/burbidge.vot').read())
+    self.assertEqual(int(resp['status']), 200)
+    self.assertEqual(self.phase(WAIT = 30), 'COMPLETED')
+
+  def test_wait_on_finished_job(self):
+    """
+    Test that waiting on a finished job returns at once: nodew1
+    """
+    endpoint = get_transfer_endpoint(self.h, self.jobid, 'ivo://ivoa.net/vospace/core#httpput')
+    resp, content = self.h.request(endpoint, 'PUT', body = open('test/burbidge.vot').read())
+    self.assertEqual(self.phase(WAIT = 30), 'COMPLETED')
+    start = datetime.now()
+    resp, content = self.h.request(BASE_URI + 'transfers/%s?WAIT=30' % self.jobid)
+    self.assertEqual(int(resp['status']), 200)
+    self.assertEqual(Job(content).phase, 'COMPLETED')
+    assert (datetime.now() - start).total_seconds() < 5
+
+  def test_invalid_wait(self):
+    """
+    Test waiting with a WAIT which is not a number: nodew1
+    """
+    resp, content = self.h.request(BASE_URI + 'transfers/%s/phase?WAIT=soon' % self.jobid)
+    self.assertEqual(int(resp['status']), 400)
+
+
 
 if __name__ == '__main__':
   suite = suite()
@@ -9,6 +9,10 @@ CREATE SCHEMA IF NOT EXISTS `VOSPACE` ;
 -- Table `VOSPACE`.`nodes`
 -- -----------------------------------------------------
 CREATE  TABLE IF NOT EXISTS `VOSPACE`.`nodes` (
+  `id` INT NOT NULL AUTO_INCREMENT ,
+  `parent_id` INT NULL DEFAULT NULL ,
+  `name` VARCHAR(128) NOT NULL ,
+  `depth` SMALLINT NOT NULL DEFAULT 0 ,
   `identifier` VARCHAR(128) NOT NULL ,
   `type` TINYINT NOT NULL ,
   `view` VARCHAR(128) NULL DEFAULT NULL ,
@@ -17,8 +21,15 @@ CREATE  TABLE IF NOT EXISTS `VOSPACE`.`nodes` (
   `location` VARCHAR(128) NULL DEFAULT NULL ,
   `creationDate` DATETIME NULL DEFAULT NULL ,
   `lastModificationDate` TIMESTAMP NOT NULL ,
-  `node` TEXT NULL DEFAULT NULL ,
-  PRIMARY KEY (`identifier`) );
+  `target` TEXT NULL DEFAULT NULL ,
+  `version` INT NOT NULL DEFAULT 0 ,
+  PRIMARY KEY (`id`) ,
+  UNIQUE INDEX `identifier_UNIQUE` (`identifier` ASC) ,
+  UNIQUE INDEX `parent_name` (`parent_id` ASC, `name` ASC) ,
+  CONSTRAINT `fk_nodes_parent`
+    FOREIGN KEY (`parent_id` )
+    REFERENCES `VOSPACE`.`nodes` (`id` ) )
+ENGINE = InnoDB;
 
 
 -- -----------------------------------------------------
@@ -34,6 +45,7 @@ CREATE  TABLE IF NOT EXISTS `VOSPACE`.`jobs` (
   `completed` DATETIME NULL DEFAULT NULL ,
   `resultid` VARCHAR(45) NULL ,
   `job` TEXT NULL ,
+  `checkpoint` TEXT NULL ,
   PRIMARY KEY (`identifier`) );
 
 
@@ -53,7 +65,11 @@ CREATE  TABLE IF NOT EXISTS `VOSPACE`.`metaproperties` (
 CREATE  TABLE IF NOT EXISTS `VOSPACE`.`properties` (
   `identifier` VARCHAR(128) NOT NULL ,
   `property` VARCHAR(128) NOT NULL ,
-  `value` VARCHAR(256) NULL DEFAULT NULL );
+  `value` VARCHAR(256) NULL DEFAULT NULL ,
+  `number` DOUBLE NULL DEFAULT NULL ,
+  PRIMARY KEY (`identifier`, `property`) ,
+  INDEX `property_value` (`property` ASC, `value`(128) ASC) ,
+  INDEX `property_number` (`property` ASC, `number` ASC) );
 
 
 -- -----------------------------------------------------
@@ -75,12 +91,80 @@ CREATE  TABLE IF NOT EXISTS `VOSPACE`.`transfers` (
   `identifier` INT NOT NULL AUTO_INCREMENT ,
   `jobid` VARCHAR(128) NULL ,
   `endpoint` VARCHAR(128) NOT NULL ,
+  `token` VARCHAR(32) NULL ,
   `created` DATETIME NULL ,
   `completed` DATETIME NULL ,
+  PRIMARY KEY (`identifier`) ,
+  INDEX `token_INDEX` (`token` ASC) )
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `VOSPACE`.`tombstones`
+-- -----------------------------------------------------
+CREATE  TABLE IF NOT EXISTS `VOSPACE`.`tombstones` (
+  `id` INT NOT NULL AUTO_INCREMENT ,
+  `identifier` VARCHAR(128) NOT NULL ,
+  `rootid` INT NOT NULL ,
+  `maxid` INT NOT NULL ,
+  `location` VARCHAR(128) NOT NULL ,
+  `created` DATETIME NULL ,
+  PRIMARY KEY (`id`) ,
+  INDEX `identifier_INDEX` (`identifier` ASC) )
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `VOSPACE`.`usages`
+-- -----------------------------------------------------
+CREATE  TABLE IF NOT EXISTS `VOSPACE`.`usages` (
+  `identifier` VARCHAR(128) NOT NULL ,
+  `bytes` BIGINT NOT NULL DEFAULT 0 ,
+  `files` INT NOT NULL DEFAULT 0 ,
+  `quota` BIGINT NULL DEFAULT NULL ,
   PRIMARY KEY (`identifier`) )
 ENGINE = InnoDB;
 
 
+-- -----------------------------------------------------
+-- Table `VOSPACE`.`changes`
+-- -----------------------------------------------------
+CREATE  TABLE IF NOT EXISTS `VOSPACE`.`changes` (
+  `seq` BIGINT NOT NULL AUTO_INCREMENT ,
+  `identifier` VARCHAR(128) NOT NULL ,
+  `operation` VARCHAR(16) NOT NULL ,
+  `created` DATETIME NULL ,
+  PRIMARY KEY (`seq`) ,
+  INDEX `created_INDEX` (`created` ASC) )
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `VOSPACE`.`blobs`
+-- -----------------------------------------------------
+CREATE  TABLE IF NOT EXISTS `VOSPACE`.`blobs` (
+  `location` VARCHAR(128) NOT NULL ,
+  `digest` CHAR(64) NOT NULL ,
+  `length` BIGINT NOT NULL ,
+  `refcount` INT NOT NULL DEFAULT 0 ,
+  `created` DATETIME NULL ,
+  PRIMARY KEY (`location`) ,
+  INDEX `refcount_INDEX` (`refcount` ASC) )
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `VOSPACE`.`signed_tokens`
+-- -----------------------------------------------------
+CREATE  TABLE IF NOT EXISTS `VOSPACE`.`signed_tokens` (
+  `signature` CHAR(64) NOT NULL ,
+  `uses` INT NOT NULL DEFAULT 0 ,
+  `expires` DATETIME NOT NULL ,
+  PRIMARY KEY (`signature`) ,
+  INDEX `expires_INDEX` (`expires` ASC) )
+ENGINE = InnoDB;
+
+
 -- -----------------------------------------------------
 -- Table `VOSPACE`.`results`
 -- -----------------------------------------------------